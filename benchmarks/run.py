@@ -0,0 +1,372 @@
+"""Benchmarks of the S3 operations of the bot against a local S3 stand-in.
+
+Starts a moto server (or uses an S3-compatible endpoint like MinIO given with --endpoint-url) and
+a fake Telegram file server, then measures uploads across file sizes, listings across prefix
+sizes, copies, ACL calls and a concurrent mixed workload. Results are written as JSON, and can
+be compared against a previous run to catch regressions.
+
+Usage:
+    pip install -r benchmarks/requirements.txt
+    python -m benchmarks.run --output results.json
+    python -m benchmarks.run --baseline results.json
+"""
+import os
+import sys
+import json
+import time
+import socket
+import random
+import shutil
+import asyncio
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+from datetime import datetime, timezone
+
+BUCKET_NAME = 'benchmarks'
+
+UPLOAD_SIZES = ['64K', '1M', '8M', '32M']
+LIST_SIZES = [10, 100, 1000]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--endpoint-url', help='S3 endpoint to use instead of starting a moto server')
+    parser.add_argument('--access-key', default='benchmarks')
+    parser.add_argument('--secret-key', default='benchmarks')
+    parser.add_argument('--iterations', type=int, default=5, help='Runs of every measurement')
+    parser.add_argument('--sizes', default=','.join(UPLOAD_SIZES), help='Upload file sizes, e.g. 64K,1M,8M')
+    parser.add_argument('--list-sizes', default=','.join(map(str, LIST_SIZES)), help='Numbers of objects to list')
+    parser.add_argument('--concurrency', type=int, default=16, help='Concurrent clients of the mixed workload')
+    parser.add_argument('--duration', type=float, default=10, help='Seconds the mixed workload runs')
+    parser.add_argument('--only', help='Comma-separated benchmark names to run')
+    parser.add_argument('--output', help='Write the results to this JSON file')
+    parser.add_argument('--baseline', help='Compare with the results of a previous run')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='Relative slowdown against the baseline reported as a regression')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_moto_server():
+    """Start a moto server on a free port.
+
+    :return: (process, endpoint URL)
+    """
+    port = free_port()
+    command = [shutil.which('moto_server') or sys.executable, '-p', str(port)]
+    if command[0] == sys.executable:
+        command[1:1] = ['-m', 'moto.server']
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return process, f'http://127.0.0.1:{port}'
+        except OSError:
+            if process.poll() is not None:
+                break
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError('moto server did not start, install it with pip install -r benchmarks/requirements.txt')
+
+
+def configure(args, endpoint_url, state_path):
+    """Point the bot at the stand-in. Must run before s3_bucket_bot is imported, it reads its settings on import."""
+    os.environ.update({
+        'AWS_SERVER_PUBLIC_KEY': args.access_key,
+        'AWS_SERVER_SECRET_KEY': args.secret_key,
+        'AWS_REGION': 'us-east-1',
+        'ENDPOINT_URL': endpoint_url,
+        'BUCKET_NAME': BUCKET_NAME,
+        'STATE_PATH': state_path,
+        'TEMP_PATH': state_path,
+        'DEDUP_ENABLED': '0',
+    })
+
+
+def summarize(name, params, latencies, size=None):
+    latencies = sorted(latencies)
+    result = {
+        'name': name,
+        'params': params,
+        'iterations': len(latencies),
+        'latency': {
+            'mean': statistics.fmean(latencies),
+            'p50': latencies[len(latencies) // 2],
+            'p95': latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+            'min': latencies[0],
+            'max': latencies[-1],
+        },
+    }
+    if size is not None:
+        result['throughput_bytes_per_s'] = size / statistics.fmean(latencies)
+    print(f'{name:<24} {json.dumps(params):<40} p50 {result["latency"]["p50"] * 1000:9.1f} ms'
+          + (f'  {result["throughput_bytes_per_s"] / 1024 ** 2:8.1f} MB/s' if size is not None else ''))
+    return result
+
+
+async def measure(func, iterations):
+    """Time iterations of a coroutine function called with the iteration number, after one warm-up call."""
+    latencies = []
+    for i in range(-1, iterations):
+        start = time.perf_counter()
+        await func(i)
+        if i >= 0:
+            latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+class FakeTelegram:
+    """Serves random files like the Telegram file API, at /file/<size>."""
+
+    def __init__(self, sizes):
+        from s3_bucket_bot.httpserver import HTTPServer, Response
+        self.server = HTTPServer('127.0.0.1', free_port())
+        for size in sizes:
+            body = random.randbytes(size)
+            self.server.route('GET', f'/file/{size}', lambda request, body=body: self._serve(Response, body))
+
+    @staticmethod
+    async def _serve(response_class, body):
+        return response_class(body, content_type='application/octet-stream')
+
+    def url(self, size):
+        return f'http://127.0.0.1:{self.server.port}/file/{size}'
+
+
+async def bench_upload_file(args, sizes, workdir):
+    """Uploads of local files, as in local Bot API mode."""
+    from s3_bucket_bot import transfer
+    results = []
+    for size in sizes:
+        file_name = os.path.join(workdir, f'upload-{size}')
+        with open(file_name, 'wb') as f:
+            f.write(random.randbytes(size))
+        latencies = await measure(lambda i: transfer.upload_file(file_name, f'upload_file/{size}/{i}'),
+                                  args.iterations)
+        results.append(summarize('upload_file', {'size': size}, latencies, size))
+    return results
+
+
+async def bench_stream_upload(args, sizes, telegram):
+    """Downloads from the fake Telegram streamed into S3, as with the public Bot API."""
+    from s3_bucket_bot import transfer
+    results = []
+    for size in sizes:
+        latencies = await measure(
+            lambda i: transfer.stream_upload(transfer.iter_url(telegram.url(size)), f'stream_upload/{size}/{i}'),
+            args.iterations)
+        results.append(summarize('stream_upload', {'size': size}, latencies, size))
+    return results
+
+
+async def populate(prefix, count):
+    from s3_bucket_bot import aio, s3bucket
+    slots = asyncio.Semaphore(32)
+
+    async def put(i):
+        async with slots:
+            await aio.run(aio.METADATA, s3bucket.put_object, f'{prefix}{i:06d}', b'x')
+
+    await asyncio.gather(*(put(i) for i in range(count)))
+
+
+async def bench_list_files(args, list_sizes):
+    from s3_bucket_bot import aio, s3bucket
+    results = []
+    for count in list_sizes:
+        prefix = f'list/{count}/'
+        await populate(prefix, count)
+        latencies = await measure(lambda i: aio.list_files_page(prefix, 10), args.iterations)
+        results.append(summarize('list_files_page', {'objects': count, 'limit': 10}, latencies))
+
+        async def list_all(i):
+            await aio.run(aio.METADATA, lambda: sum(1 for _ in s3bucket.iter_files(prefix)))
+
+        latencies = await measure(list_all, args.iterations)
+        results.append(summarize('iter_files', {'objects': count}, latencies))
+    return results
+
+
+async def bench_copy_file(args, sizes):
+    from s3_bucket_bot import aio, s3bucket
+    results = []
+    for size in sizes:
+        src = f'copy/{size}/src'
+        await aio.run(aio.UPLOAD, s3bucket.put_object, src, random.randbytes(size))
+        latencies = await measure(lambda i: aio.copy_file(src, f'copy/{size}/{i}', size), args.iterations)
+        results.append(summarize('copy_file', {'size': size}, latencies, size))
+    return results
+
+
+async def bench_acl(args):
+    from s3_bucket_bot import aio, s3bucket
+    key = 'acl/object'
+    await aio.run(aio.UPLOAD, s3bucket.put_object, key, b'x')
+    results = []
+    for name, func in [('make_public', aio.make_public), ('make_private', aio.make_private),
+                       ('get_file_acl', aio.get_file_acl)]:
+        async def call(i, func=func):
+            # Measure the requests, not the metadata cache
+            s3bucket.metadata_cache.clear()
+            await func(key)
+
+        results.append(summarize(name, {}, await measure(call, args.iterations)))
+    return results
+
+
+async def bench_mixed(args):
+    """Concurrent clients running a random mix of small uploads, lookups, listings, copies and deletes."""
+    from s3_bucket_bot import aio, s3bucket
+    prefix = 'mixed/'
+    await populate(prefix, 100)
+    rng = random.Random(args.seed)
+    body = random.randbytes(64 * 1024)
+    operations = {
+        'put': lambda n: aio.run(aio.UPLOAD, s3bucket.put_object, f'{prefix}new/{n}', body),
+        'exist': lambda n: aio.file_exist(f'{prefix}{rng.randrange(100):06d}'),
+        'list': lambda n: aio.list_files_page(prefix, 10),
+        'copy': lambda n: aio.copy_file(f'{prefix}{rng.randrange(100):06d}', f'{prefix}copies/{n}', 1),
+        'delete': lambda n: aio.delete_file(f'{prefix}new/{rng.randrange(max(n, 1))}'),
+    }
+    weights = {'put': 2, 'exist': 4, 'list': 2, 'copy': 1, 'delete': 1}
+    latencies = {name: [] for name in operations}
+    counter = 0
+    deadline = time.monotonic() + args.duration
+
+    async def client():
+        nonlocal counter
+        while time.monotonic() < deadline:
+            name = rng.choices(list(weights), list(weights.values()))[0]
+            counter += 1
+            start = time.perf_counter()
+            await operations[name](counter)
+            latencies[name].append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - start
+    results = [summarize(f'mixed.{name}', {'concurrency': args.concurrency}, values)
+               for name, values in latencies.items() if values]
+    total = sum(len(values) for values in latencies.values())
+    results.append({'name': 'mixed', 'params': {'concurrency': args.concurrency, 'duration': args.duration},
+                    'operations': total, 'operations_per_s': total / elapsed})
+    print(f'{"mixed":<24} {json.dumps({"concurrency": args.concurrency}):<40} {total / elapsed:9.1f} ops/s')
+    return results
+
+
+async def run_benchmarks(args, workdir):
+    from s3_bucket_bot import aio, s3bucket, transfer
+
+    sizes = [transfer.parse_size(size) for size in args.sizes.split(',')]
+    list_sizes = [int(count) for count in args.list_sizes.split(',')]
+    only = set(args.only.split(',')) if args.only else None
+    s3bucket.get_s3_client().create_bucket(Bucket=BUCKET_NAME)
+
+    telegram = FakeTelegram(sizes)
+    await telegram.server.start()
+    benchmarks = {
+        'upload_file': lambda: bench_upload_file(args, sizes, workdir),
+        'stream_upload': lambda: bench_stream_upload(args, sizes, telegram),
+        'list_files': lambda: bench_list_files(args, list_sizes),
+        'copy_file': lambda: bench_copy_file(args, sizes),
+        'acl': lambda: bench_acl(args),
+        'mixed': lambda: bench_mixed(args),
+    }
+    results = []
+    try:
+        for name, bench in benchmarks.items():
+            if only is None or name in only:
+                results.extend(await bench())
+    finally:
+        await telegram.server.stop()
+        await transfer.close_http_client()
+        aio.shutdown()
+    return results
+
+
+def result_key(result):
+    return f'{result["name"]} {json.dumps(result["params"], sort_keys=True)}'
+
+
+def compare(results, baseline, threshold):
+    """Print the changes against a baseline run.
+
+    :return: Number of regressions
+    """
+    previous = {result_key(result): result for result in baseline['results']}
+    regressions = 0
+    print(f'\nCompared with {baseline["meta"].get("commit") or "the baseline"}:')
+    for result in results:
+        before = previous.get(result_key(result))
+        if before is None:
+            continue
+        if 'latency' in result:
+            old, new = before['latency']['p50'], result['latency']['p50']
+            change = (new - old) / old if old else 0
+        else:
+            old, new = before['operations_per_s'], result['operations_per_s']
+            change = (old - new) / old if old else 0
+        regressed = change > threshold
+        regressions += regressed
+        print(f'{"REGRESSION" if regressed else "":<11}{result_key(result):<60} {change:+7.1%}')
+    return regressions
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    args = parse_args()
+    random.seed(args.seed)
+    process = None
+    endpoint_url = args.endpoint_url
+    if endpoint_url is None:
+        process, endpoint_url = start_moto_server()
+    workdir = tempfile.mkdtemp(prefix='s3-bot-benchmarks-')
+    try:
+        configure(args, endpoint_url, workdir)
+        results = asyncio.run(run_benchmarks(args, workdir))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    report = {
+        'meta': {
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'endpoint': 'moto' if process is not None else endpoint_url,
+            'iterations': args.iterations,
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,10 @@
-from s3_bucket_bot.bot import main
+import sys
 
 if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        # Commands like sync, the bot runs without arguments
+        from s3_bucket_bot.cli import main as cli_main
+        sys.exit(cli_main())
+
+    from s3_bucket_bot.bot import main
     main()
@@ -0,0 +1,121 @@
+"""Async facade over s3bucket.
+
+boto3 is blocking, so every call is handed to a bounded thread pool instead of running on the
+event loop. Uploads and copies get their own pool so that a long transfer never starves quick
+metadata calls like /exist or /list.
+"""
+import os
+import asyncio
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+from . import metrics, s3bucket
+
+S3_UPLOAD_WORKERS = int(os.getenv('S3_UPLOAD_WORKERS') or 4)
+S3_METADATA_WORKERS = int(os.getenv('S3_METADATA_WORKERS') or 16)
+S3_BULK_WORKERS = int(os.getenv('S3_BULK_WORKERS') or 16)
+
+# Operation classes, each backed by its own executor
+UPLOAD = 'upload'
+METADATA = 'metadata'
+# Many small transfers, e.g. the files of a directory sync
+BULK = 'bulk'
+
+_max_workers = {
+    UPLOAD: S3_UPLOAD_WORKERS,
+    METADATA: S3_METADATA_WORKERS,
+    BULK: S3_BULK_WORKERS,
+}
+_executors = {}
+_executors_lock = threading.Lock()
+
+
+def get_executor(kind):
+    """Get the executor for an operation class, created lazily."""
+    executor = _executors.get(kind)
+    if executor is not None:
+        return executor
+    with _executors_lock:
+        executor = _executors.get(kind)
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=_max_workers[kind], thread_name_prefix=f's3-{kind}')
+            _executors[kind] = executor
+    return executor
+
+
+async def run(kind, func, *args, **kwargs):
+    """Run a blocking callable in the executor of the given operation class."""
+    loop = asyncio.get_running_loop()
+    # Carry context variables over to the worker thread, like asyncio.to_thread does
+    ctx = contextvars.copy_context()
+
+    def call():
+        metrics.EXECUTOR_ACTIVE.inc(executor=kind)
+        try:
+            return ctx.run(func, *args, **kwargs)
+        finally:
+            metrics.EXECUTOR_ACTIVE.dec(executor=kind)
+
+    return await loop.run_in_executor(get_executor(kind), call)
+
+
+def queue_depths():
+    """Number of calls waiting for a thread, by operation class."""
+    # ThreadPoolExecutor has no public accessor for its backlog
+    return {(kind,): executor._work_queue.qsize() for kind, executor in list(_executors.items())}
+
+
+metrics.EXECUTOR_QUEUED.callback = queue_depths
+
+
+def shutdown(wait=False):
+    """Shut down all executors."""
+    with _executors_lock:
+        for executor in _executors.values():
+            executor.shutdown(wait=wait, cancel_futures=not wait)
+        _executors.clear()
+
+
+async def upload_file(file_name, object_name=None, mime_type=None, acl=None, config=None, callback=None):
+    return await run(UPLOAD, s3bucket.upload_file, file_name, object_name, mime_type, acl, config, callback)
+
+
+async def put_object(object_name, body, mime_type=None, acl=None, content_encoding=None):
+    return await run(UPLOAD, s3bucket.put_object, object_name, body, mime_type, acl, content_encoding)
+
+
+async def copy_file(src, dest, size=None):
+    return await run(UPLOAD, s3bucket.copy_file, src, dest, size)
+
+
+async def delete_file(file_name):
+    return await run(METADATA, s3bucket.delete_file, file_name)
+
+
+async def make_public(file_name):
+    return await run(METADATA, s3bucket.make_public, file_name)
+
+
+async def make_private(file_name):
+    return await run(METADATA, s3bucket.make_private, file_name)
+
+
+async def file_exist(file_name):
+    return await run(METADATA, s3bucket.file_exist, file_name)
+
+
+async def get_file_acl(file_name):
+    return await run(METADATA, s3bucket.get_file_acl, file_name)
+
+
+async def list_files(prefix, limit=10):
+    return await run(METADATA, s3bucket.list_files, prefix, limit=limit)
+
+
+async def list_files_page(prefix, limit=10, continuation_token=None, start_after=None):
+    return await run(METADATA, s3bucket.list_files_page, prefix, limit, continuation_token, start_after)
+
+
+async def get_meta(file_name):
+    return await run(METADATA, s3bucket.get_meta, file_name)
@@ -0,0 +1,81 @@
+"""Reading the members of zip and tar archives one after the other.
+
+Members are read in archive order, so compressed tar files are decompressed in a single pass.
+Member names are normalized to relative POSIX paths, and members that would escape the target
+prefix (absolute paths, ..) are skipped, as well as directories, links and devices.
+"""
+import time
+import tarfile
+import zipfile
+import posixpath
+import logging
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_EXTENSIONS = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+
+
+class Member:
+    def __init__(self, name, size, mtime):
+        self.name = name
+        self.size = size
+        # Seconds since the epoch
+        self.mtime = mtime
+
+
+def is_archive(file_name):
+    return file_name.lower().endswith(ARCHIVE_EXTENSIONS)
+
+
+def is_streamable(file_name):
+    """Whether the archive can be read as it is downloaded: zip files list their members at the end."""
+    return is_archive(file_name) and not file_name.lower().endswith('.zip')
+
+
+def safe_name(name):
+    """Normalize a member name to a relative POSIX path, or None if it is unsafe or a directory."""
+    name = name.replace('\\', '/')
+    if name.startswith('/') or name.endswith('/'):
+        return None
+    name = posixpath.normpath(name)
+    if name in ('.', '') or name == '..' or name.startswith('../'):
+        return None
+    return name
+
+
+def _zip_mtime(info):
+    # Zip files store local time without a time zone
+    return time.mktime(datetime(*info.date_time).timetuple())
+
+
+def iter_members(file_name, fileobj=None):
+    """Iterate over the regular files of an archive, in archive order.
+
+    Each file object must be read before the next member is requested.
+
+    :param file_name: Path of the archive
+    :param fileobj: Binary stream of a tar archive to read instead, which is never seeked
+    :return: Iterator of (Member, binary file object) tuples
+    """
+    if fileobj is None and zipfile.is_zipfile(file_name):
+        with zipfile.ZipFile(file_name) as archive:
+            for info in archive.infolist():
+                name = safe_name(info.filename)
+                if info.is_dir() or name is None:
+                    continue
+                with archive.open(info) as f:
+                    yield Member(name, info.file_size, _zip_mtime(info)), f
+        return
+
+    # Stream mode reads compressed tar files in a single pass, without seeking back
+    with tarfile.open(None if fileobj is not None else file_name, mode='r|*', fileobj=fileobj) as archive:
+        for info in archive:
+            name = safe_name(info.name)
+            if not info.isfile() or name is None:
+                if not info.isdir():
+                    logger.debug(f'Skipping archive member {info.name}')
+                continue
+            f = archive.extractfile(info)
+            yield Member(name, info.size, info.mtime), f
+
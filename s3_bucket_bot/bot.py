@@ -1,22 +1,41 @@
 import os
 import html
+import hashlib
+import asyncio
 import json
 import logging
-import shutil
 import traceback
+import time
 import uuid
+import dataclasses
+from datetime import datetime, timedelta, timezone
 from os import path
 import mimetypes
-import requests
 
-from telegram import Update, LinkPreviewOptions
-from telegram.constants import ParseMode
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, Defaults
+from telegram import Update, LinkPreviewOptions, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.constants import ParseMode, MessageLimit
+from telegram.error import TelegramError, BadRequest, Forbidden
+from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes, \
+    Defaults
 
-from .s3bucket import upload_file as s3_upload_file, get_obj_url as s3_get_obj_url, delete_file as s3_delete_file, \
+from . import aio, cdn, compression, images, metrics, ratelimit, tracing, webhook
+from .aio import delete_file as s3_delete_file, \
     make_public as s3_make_public, make_private as s3_make_private, file_exist as s3_file_exist, \
-    copy_file as s3_copy_file, get_file_acl as s3_get_file_acl, list_files as s3_list_files, \
-    get_meta as s3_get_meta, ACLNotSupportedError
+    copy_file as s3_copy_file, get_file_acl as s3_get_file_acl, list_files_page as s3_list_files_page, \
+    get_meta as s3_get_meta, put_object as s3_put_object
+from .s3bucket import get_obj_url as s3_get_obj_url, presign_get as s3_presign_get, \
+    presign_put as s3_presign_put, presign_post as s3_presign_post, get_extra_args as s3_get_extra_args, \
+    ACLNotSupportedError, PRESIGN_DEFAULT_TTL, PRESIGN_MAX_TTL
+from .archive import is_archive, is_streamable
+from .bulk import delete_files as bulk_delete_files, delete_prefix as bulk_delete_prefix, \
+    copy_prefix as bulk_copy_prefix
+from .dedup import dedup_index, hash_file, DEDUP_ENABLED
+from .inventory import inventory, INVENTORY_ENABLED, run_sync as run_inventory_sync, last_sync as inventory_last_sync, \
+    format_time
+from .sync import sync_path, extract_archive, SyncReport
+from .jobs import job_queue, JOB_QUEUE_ENABLED, JOB_POLL_INTERVAL, DONE as JOB_DONE
+from .transfer import upload_file as s3_upload_file, stream_upload, iter_url, iter_file, close_http_client, parse_size, format_size, \
+    resume_uploads, abort_stale_uploads, TransferProgress, TransferSettings, DEFAULT_SETTINGS
 
 # Enable logging
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
@@ -38,13 +57,35 @@ DEVELOPER_CHAT_ID = os.getenv('DEVELOPER_CHAT_ID')
 
 TEMP_PATH = os.getenv('TEMP_PATH', '/tmp')
 
-DIGITALOCEAN_TOKEN = os.getenv('DIGITALOCEAN_TOKEN')
-BUCKET_NAME = None
-if os.getenv('BUCKET_NAME', '').strip():
-    BUCKET_NAME = os.getenv('BUCKET_NAME')
-ENDPOINT_URL = None
-if os.getenv('ENDPOINT_URL', '').strip():
-    ENDPOINT_URL = os.getenv('ENDPOINT_URL')
+# Uploads of at least PROGRESS_MIN_SIZE bytes report their progress by editing a single message,
+# at most once every PROGRESS_INTERVAL seconds
+PROGRESS_MIN_SIZE = parse_size(os.getenv('PROGRESS_MIN_SIZE') or '8M')
+PROGRESS_INTERVAL = float(os.getenv('PROGRESS_INTERVAL') or 3)
+
+# Albums: items are collected until none arrived for MEDIA_GROUP_WAIT seconds,
+# then uploaded by up to MEDIA_GROUP_WORKERS concurrent uploads
+MEDIA_GROUP_WAIT = float(os.getenv('MEDIA_GROUP_WAIT') or 1.5)
+MEDIA_GROUP_WORKERS = int(os.getenv('MEDIA_GROUP_WORKERS') or 4)
+
+# /list: maximum number of entries per page, and number of listings per chat whose pages can still be browsed
+LIST_PAGE_MAX_SIZE = int(os.getenv('LIST_PAGE_MAX_SIZE') or 50)
+LIST_MAX_CACHED = int(os.getenv('LIST_MAX_CACHED') or 20)
+
+MAX_MESSAGE_LENGTH = MessageLimit.MAX_TEXT_LENGTH
+
+# Number of updates processed at the same time, so a long upload does not hold up other commands
+TELEGRAM_CONCURRENT_UPDATES = int(os.getenv('TELEGRAM_CONCURRENT_UPDATES') or 32)
+
+# Bot API requests per second sent by the process, Telegram allows about 30 messages per second.
+# Requests refused with RetryAfter are sent again after the delay, up to TELEGRAM_MAX_RETRIES times.
+TELEGRAM_RATE_LIMIT = float(os.getenv('TELEGRAM_RATE_LIMIT') or 25)
+TELEGRAM_MAX_RETRIES = int(os.getenv('TELEGRAM_MAX_RETRIES') or 3)
+
+
+def create_rate_limiter():
+    """Rate limiter of the Bot API requests, for the bot and the workers."""
+    limiter = ratelimit.Limiter('telegram', TELEGRAM_RATE_LIMIT, max_concurrency=TELEGRAM_CONCURRENT_UPDATES)
+    return ratelimit.TelegramRateLimiter(limiter, TELEGRAM_MAX_RETRIES)
 
 
 # Define a few command handlers. These usually take the two arguments update and
@@ -66,16 +107,25 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     help_text = (
         "<b>Available commands:</b>\n\n"
         "/exist &lt;path&gt; - Check if file exists\n"
-        "/delete &lt;path&gt; - Delete a file\n"
+        "/delete &lt;path&gt; [path...] - Delete files, or everything under &lt;prefix&gt;*\n"
         "/make_public &lt;path&gt; - Make file public\n"
         "/make_private &lt;path&gt; - Make file private\n"
-        "/copy_file &lt;src&gt; &lt;dest&gt; - Copy file\n"
-        "/list &lt;prefix&gt; [limit] - List files\n"
+        "/copy_file &lt;src&gt; &lt;dest&gt; - Copy a file, or a folder when src ends with /\n"
+        "/move &lt;src&gt; &lt;dest&gt; - Move a file, or a folder when src ends with /\n"
+        "/list &lt;prefix&gt; [limit] - List files, page by page\n"
+        "/find &lt;pattern&gt; - Find files by glob pattern, e.g. images/*.png\n"
+        "/du [prefix] - Number and size of files under a prefix\n"
         "/get_file_acl &lt;path&gt; - Get file ACL\n"
         "/get_meta &lt;path&gt; - Get file metadata\n"
-        "/purge_cache &lt;path&gt; - Purge CDN cache (DigitalOcean)\n\n"
+        "/sync &lt;prefix&gt; [--delete] - In reply to a zip or tar archive, upload its new and changed files "
+        "to the prefix, --delete removes the files missing from the archive\n"
+        "/presign &lt;path&gt; [ttl] [--put|--post] - Temporary link to download a private file, "
+        "or to upload one straight to S3\n"
+        "/purge_cache &lt;path&gt; [path...] - Purge CDN cache (DigitalOcean), paths may end with *\n\n"
         "<b>Upload:</b> Send any file to upload to S3.\n"
-        "Use caption to set custom path."
+        "Use caption to set custom path.\n"
+        "Add --extract to a zip or tar archive to upload its files under the caption prefix instead.\n"
+        "Transfer options: --part-size, --concurrency, --bandwidth, --buffers, --compress[=gzip,br|off]."
     )
     await update.effective_message.reply_html(help_text)
 
@@ -90,8 +140,84 @@ async def bad_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     raise Exception("Something went wrong, please try again later.")
 
 
-async def upload_file(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    message = update.effective_message
+_DURATION_UNITS = {'': 1, 's': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def parse_duration(value):
+    """Parse a duration like 90, 15m, 2h or 7d into seconds."""
+    value = value.strip().lower()
+    unit = value[-1:] if value[-1:].isalpha() else ''
+    number = value[:len(value) - len(unit)]
+    if unit not in _DURATION_UNITS or not number.isdigit():
+        raise ValueError(f'Invalid duration: {value}')
+    return int(number) * _DURATION_UNITS[unit]
+
+
+# Options accepted at the end of upload captions
+UPLOAD_OPTIONS = frozenset(TransferSettings.OPTIONS) | {'extract'}
+
+
+def parse_caption(caption, known_options=UPLOAD_OPTIONS):
+    """Split an upload caption into the target path and its trailing options.
+
+    E.g. 'videos/ --part-size=64M --concurrency=8' gives ('videos/', {'part-size': '64M', 'concurrency': '8'}).
+    Only known options are taken, so 'report --final.pdf' is a file name.
+
+    :param known_options: Names of the options to take, None to take any
+    """
+    file_name = caption.strip()
+    options = {}
+    while True:
+        head, _, last = file_name.rpartition(' ')
+        if not last.startswith('--'):
+            break
+        name, _, value = last[2:].partition('=')
+        if known_options is not None and name not in known_options:
+            break
+        options[name] = value
+        file_name = head.rstrip()
+    return file_name, options
+
+
+async def report_progress(status_message, file_name, progress):
+    """Edit the status message with the upload progress until cancelled."""
+    last_text = None
+    while True:
+        await asyncio.sleep(PROGRESS_INTERVAL)
+        text = f'Uploading {file_name}\n{progress}'
+        if text == last_text:
+            continue
+        try:
+            await status_message.edit_text(text=text)
+        except TelegramError as e:
+            logger.warning(e)
+        last_text = text
+
+
+class UploadError(Exception):
+    """Raised when an attachment cannot be uploaded, with a message for the user."""
+
+
+class Upload:
+    """A Telegram attachment resolved to its S3 destination."""
+
+    def __init__(self, message, attachment, file, file_name, mime_type, settings, extract=None):
+        self.message = message
+        self.attachment = attachment
+        self.file = file
+        self.file_name = file_name
+        self.mime_type = mime_type
+        self.settings = settings
+        # Name of the archive whose files are uploaded under the file_name prefix, None to upload the file as is
+        self.extract = extract
+
+
+async def prepare_upload(message, default_prefix=None) -> Upload:
+    """Resolve the attachment of a message, its target path and transfer settings.
+
+    :param default_prefix: Path prefix used when the message has no caption (e.g. the folder of an album)
+    :raises UploadError: If the attachment cannot be uploaded
+    """
     attachment = message.effective_attachment
     if isinstance(attachment, (list, tuple)):
         attachment = attachment[-1]
@@ -101,69 +227,566 @@ async def upload_file(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     max_file_size = 2000 * 1024 * 1024 if TELEGRAM_BASE_URL else 20 * 1024 * 1024
     if attachment.file_size > max_file_size:
         limit = "2GB" if TELEGRAM_BASE_URL else "20MB"
-        await message.reply_html(
-            f'<b>File is too big</b>\n\n'
-            f'Bots can download files of up to {limit} in size.\n'
-        )
-        return
+        raise UploadError(f'File is too big. Bots can download files of up to {limit} in size.')
 
-    file = await attachment.get_file()
+    with tracing.span('telegram.get_file', **{'telegram.file_size': attachment.file_size}):
+        file = await attachment.get_file()
 
     def get_original_file_name():
         original_file_name = path.basename(file.file_path)
-        if hasattr(attachment, 'file_name'):
+        if hasattr(attachment, 'file_name') and attachment.file_name:
             original_file_name = attachment.file_name
         return original_file_name
 
     file_name = get_original_file_name()
+    options = {}
+    caption = None
     if message.caption is not None:
-        if message.caption.strip():
-            # Trim spaces and remove leading slash
-            file_name = message.caption.strip().lstrip('/')
-            if file_name.endswith('/'):
-                file_name += get_original_file_name()
+        caption, options = parse_caption(message.caption)
+    if not caption and default_prefix:
+        caption = default_prefix
+    extract = None
+    if options.pop('extract', None) is not None:
+        extract = get_original_file_name()
+        if not is_archive(extract):
+            raise UploadError('Only zip and tar archives can be extracted.')
+        # The caption is the prefix the files of the archive are uploaded under
+        file_name = (caption or '').lstrip('/')
+        if file_name and not file_name.endswith('/'):
+            file_name += '/'
+    elif caption:
+        # Remove leading slash
+        file_name = caption.lstrip('/')
+        if file_name.endswith('/'):
+            file_name += get_original_file_name()
+
+    try:
+        settings = DEFAULT_SETTINGS.with_options(options)
+    except ValueError as e:
+        raise UploadError(f'Error: {e}')
 
     mime_type = mimetypes.MimeTypes().guess_type(file_name)[0]
-    if hasattr(attachment, 'mime_type'):
+    if hasattr(attachment, 'mime_type') and attachment.mime_type:
         mime_type = attachment.mime_type
 
-    tmp_file_name = f'{TEMP_PATH}/{uuid.uuid4()}'
-
-    # In local mode, file_path is a local path - copy directly instead of HTTP download
-    if TELEGRAM_LOCAL and file.file_path.startswith('/'):
-        shutil.copy(file.file_path, tmp_file_name)
+    return Upload(message, attachment, file, file_name, mime_type, settings, extract)
+
+
+@tracing.traced('dedup.lookup')
+async def reuse_previous_upload(upload: Upload, content_hash=None) -> bool:
+    """Skip the transfer if the same Telegram file, or a file with the same content, was uploaded before and
+    is still in the bucket.
+
+    A repeat upload to the same key completes right away, a repeat to a new key becomes a server-side copy.
+    Objects whose headers or ACL differ from those of a new upload are not reused.
+
+    :param content_hash: SHA-256 of the file if known before the transfer, i.e. of a local file
+    :return: True if the upload is done
+    """
+    records = await aio.run(aio.METADATA, dedup_index.lookup, upload.file.file_unique_id)
+    if content_hash is not None:
+        records += await aio.run(aio.METADATA, dedup_index.lookup, content_hash=content_hash)
+    checked = set()
+    for record in records:
+        if record['key'] in checked:
+            continue
+        checked.add(record['key'])
+        head = await s3_get_meta(record['key'])
+        if head is None or head.get('ETag') != record['etag']:
+            # Deleted or overwritten since
+            await aio.run(aio.METADATA, dedup_index.forget, record['file_unique_id'], record['key'])
+            continue
+        if not await has_upload_headers(upload, record['key'], head):
+            continue
+        if record['key'] == upload.file_name:
+            logger.info(f'{upload.file_name} is already uploaded')
+            metrics.DEDUPLICATED_UPLOADS.inc(outcome='skipped')
+            tracing.set_attributes(**{'dedup.outcome': 'skipped'})
+            return True
+        logger.info(f'Copying {record["key"]} to {upload.file_name} instead of uploading it again')
+        if await s3_copy_file(record['key'], upload.file_name, record['size']):
+            metrics.DEDUPLICATED_UPLOADS.inc(outcome='copied')
+            tracing.set_attributes(**{'dedup.outcome': 'copied', 'dedup.source': record['key']})
+            await remember_upload(upload, record['content_hash'])
+            schedule_purge(upload.file_name)
+            return True
+    return False
+
+
+# Headers of an object that a copy keeps, and an upload sets
+_REUSED_HEADERS = ('ContentType', 'ContentEncoding', 'CacheControl', 'ContentDisposition', 'ContentLanguage',
+                   'Expires', 'Metadata')
+
+
+async def has_upload_headers(upload: Upload, key, head) -> bool:
+    """Whether an object has the headers and ACL an upload of the file would get, so that it can be reused.
+
+    :param key: Key of the object
+    :param head: Metadata of the object
+    """
+    expected = s3_get_extra_args(upload.mime_type, None, upload.file_name)
+    if any((head.get(name) or None) != expected.get(name) for name in _REUSED_HEADERS):
+        return False
+    # Uploads are public, None if the storage provider has no ACLs
+    return await s3_get_file_acl(key) in ('public-read', None)
+
+
+@tracing.traced('dedup.record')
+async def remember_upload(upload: Upload, content_hash=None) -> None:
+    """Record an uploaded file in the dedup index."""
+    head = await s3_get_meta(upload.file_name)
+    if head is not None:
+        await aio.run(aio.METADATA, dedup_index.record, upload.file.file_unique_id, upload.file_name,
+                      head.get('ETag'), head['ContentLength'], content_hash)
+
+
+@tracing.traced('upload.transfer')
+async def transfer_upload(upload: Upload, progress=None, status_message=None, job_id=None, job_item=None) -> str:
+    """Upload an attachment to S3.
+
+    :param job_id: Id of the queued job running the upload, in a worker process
+    :param job_item: Index of the upload in the items of that job
+    :return: Object URL
+    """
+    tracing.set_attributes(**{'s3.key': upload.file_name, 'file.size': upload.file.file_size,
+                              'transfer.part_size': upload.settings.part_size})
+    file = upload.file
+    local = TELEGRAM_LOCAL and file.file_path.startswith('/')
+    encodings = compression.choose_encodings(upload.settings.compress, upload.mime_type, file.file_size)
+    if encodings:
+        tracing.set_attributes(**{'upload.compressed_variants': ','.join(encodings)})
+    deduplicate = DEDUP_ENABLED
+    content_hash = None
+    if deduplicate and local:
+        with tracing.span('dedup.hash'):
+            content_hash = await aio.run(aio.BULK, hash_file, file.file_path)
+    # A previous upload may lack the variants asked for now
+    if deduplicate and not encodings and not images.wants_variants(upload.mime_type, file.file_size) \
+            and await reuse_previous_upload(upload, content_hash):
+        return s3_get_obj_url(upload.file_name)
+
+    start = time.monotonic()
+    # Recorded in the upload journal: the chat to report back to if the upload is resumed after a
+    # restart, or the job that resumes it when it is run again
+    if job_id is not None:
+        meta = {'job_id': job_id, 'item': job_item}
+    else:
+        meta = {
+            'chat_id': upload.message.chat_id,
+            'message_id': status_message.message_id if status_message is not None else None,
+        }
+    # Source of the image and compressed variants: the local file, or the downloaded data kept in memory
+    variants_source = None
+    compressed = None
+    if local:
+        variants_source = compressed = file.file_path
+        # In local mode, file_path is a local path - upload it directly, without a temporary copy.
+        await s3_upload_file(file.file_path, upload.file_name, upload.mime_type, 'public-read',  # Make public by default
+                             settings=upload.settings, progress=progress, meta=meta)
+        metrics.UPLOAD_DURATION.observe(time.monotonic() - start, source='local')
+        tracing.set_attributes(**{'upload.source': 'local'})
     else:
-        await file.download_to_drive(tmp_file_name)
+        # Otherwise feed the download stream straight into the S3 upload, hashing it on the way
+        digest = hashlib.sha256()
+        chunks_kept = [] if images.wants_variants(upload.mime_type, file.file_size) else None
+        # Only the compressed data is kept, it is a fraction of the size of compressible files
+        compressors = compression.Compressors(encodings) if encodings else None
+
+        download_wait = 0
+
+        async def hashed(chunks):
+            # Also measure the time spent waiting for Telegram, to tell slow downloads from slow uploads
+            nonlocal download_wait
+            waiting_since = time.monotonic()
+            async for chunk in chunks:
+                download_wait += time.monotonic() - waiting_since
+                metrics.TELEGRAM_DOWNLOAD_BYTES.inc(len(chunk))
+                digest.update(chunk)
+                if chunks_kept is not None:
+                    chunks_kept.append(chunk)
+                if compressors is not None:
+                    await aio.run(aio.BULK, compressors.compress, chunk)
+                yield chunk
+                waiting_since = time.monotonic()
+            download_wait += time.monotonic() - waiting_since
+
+        await stream_upload(hashed(iter_url(file.file_path)), upload.file_name, upload.mime_type, 'public-read',
+                            settings=upload.settings, progress=progress, meta=meta, size=file.file_size)
+        content_hash = digest.hexdigest()
+        if chunks_kept is not None:
+            variants_source = b''.join(chunks_kept)
+        if compressors is not None:
+            compressed = await aio.run(aio.BULK, compressors.finish)
+        metrics.UPLOAD_DURATION.observe(time.monotonic() - start, source='telegram')
+        metrics.TELEGRAM_DOWNLOAD_WAIT.observe(download_wait)
+        tracing.set_attributes(**{'upload.source': 'telegram', 'telegram.download_wait_seconds': download_wait})
+    return await finish_upload(upload, deduplicate, content_hash, variants_source, compressed)
+
+
+async def finish_upload(upload: Upload, deduplicate, content_hash=None, variants_source=None,
+                        compressed=None) -> str:
+    """Purge, record and derive the variants of an uploaded file.
+
+    :param deduplicate: Whether to record the upload in the dedup index
+    :param variants_source: Image data, or path of a local file, to create the image variants from
+    :param compressed: Compressed data by encoding, or path of a local file, to create the compressed variants from
+    :return: Object URL, followed by the URLs of the variants
+    """
+    # The upload may have overwritten a cached object
+    schedule_purge(upload.file_name)
+    if deduplicate:
+        await remember_upload(upload, content_hash)
+    urls = [s3_get_obj_url(upload.file_name)]
+    encodings = compression.choose_encodings(upload.settings.compress, upload.mime_type, upload.file.file_size)
+    if compressed is not None and encodings:
+        urls += await upload_compressed_variants(upload, encodings, compressed)
+    if variants_source is not None and images.wants_variants(upload.mime_type, upload.file.file_size):
+        urls += await upload_variants(upload, variants_source)
+    return '\n'.join(urls)
+
+
+async def finish_resumed_upload(upload: Upload) -> str:
+    """Finish an upload of a local file completed by resume_uploads().
+
+    :return: Object URL, followed by the URLs of the variants
+    """
+    content_hash = None
+    if DEDUP_ENABLED:
+        with tracing.span('dedup.hash'):
+            content_hash = await aio.run(aio.BULK, hash_file, upload.file.file_path)
+    return await finish_upload(upload, DEDUP_ENABLED, content_hash, upload.file.file_path, upload.file.file_path)
+
+
+@tracing.traced('upload.compressed_variants')
+async def upload_compressed_variants(upload: Upload, encodings, source) -> list:
+    """Upload precompressed copies of an upload next to it, e.g. app.js.gz and app.js.br.
+
+    The copies keep the Content-Type of the original and get a Content-Encoding header.
+
+    :param source: Compressed data by encoding, or path of a local file, compressed as it is streamed
+    :return: Lines for the reply, the URLs of the variants or their errors
+    """
+    async def upload_variant(encoding):
+        key = compression.variant_key(upload.file_name, encoding)
+        try:
+            if isinstance(source, dict):
+                await s3_put_object(key, source[encoding], upload.mime_type, 'public-read', encoding)
+            else:
+                await stream_upload(compression.compress_stream(iter_file(source), encoding), key, upload.mime_type,
+                                    'public-read', settings=upload.settings, content_encoding=encoding,
+                                    size=upload.file.file_size)
+        except Exception as e:
+            logger.error(f'Cannot create {key}: {e}')
+            return f'{key}: {e}'
+        schedule_purge(key)
+        return s3_get_obj_url(key)
+
+    return list(await asyncio.gather(*(upload_variant(encoding) for encoding in encodings)))
+
+
+@tracing.traced('upload.variants')
+async def upload_variants(upload: Upload, source) -> list:
+    """Create the image variants of an upload.
+
+    :param source: Image data, or path of a local file
+    :return: Lines for the reply, the URLs of the variants or their errors
+    """
+    results = await images.create_variants(upload.file_name, source)
+    schedule_purge(*(key for key, error in results if error is None))
+    return [s3_get_obj_url(key) if error is None else f'{key}: {error}' for key, error in results]
+
+
+@metrics.track_handler('upload')
+async def upload_file(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    message = update.effective_message
+    if message.media_group_id is not None:
+        await collect_media_group(message)
+        return
+
+    try:
+        upload = await prepare_upload(message)
+    except UploadError as e:
+        await message.reply_text(text=str(e))
+        return
+    if JOB_QUEUE_ENABLED:
+        await enqueue_job(message, 'upload', {'items': [upload_job_item(upload)]},
+                          f'Queued {upload.extract or upload.file_name}')
+        return
+    if upload.extract is not None:
+        await upload_archive_files(upload)
+        return
+
+    file_size = upload.attachment.file_size
+    progress = TransferProgress(file_size)
+    status_message = None
+    reporter = None
+    if file_size >= PROGRESS_MIN_SIZE:
+        status_message = await message.reply_text(text=f'Uploading {upload.file_name}')
+        reporter = asyncio.create_task(report_progress(status_message, upload.file_name, progress))
     try:
-        s3_upload_file(tmp_file_name, file_name, mime_type, 'public-read')  # Make public by default
+        s3_file_path = await transfer_upload(upload, progress, status_message)
     except Exception as e:
         logger.error(e)
-        await message.reply_text(f"Upload failed: {e}")
+        if status_message is not None:
+            await status_message.edit_text(text=f"Upload failed: {e}")
+        else:
+            await message.reply_text(f"Upload failed: {e}")
         return
     finally:
+        if reporter is not None:
+            reporter.cancel()
+    with tracing.span('telegram.reply'):
+        if status_message is not None:
+            await status_message.edit_text(text=s3_file_path)
+        else:
+            await message.reply_text(text=s3_file_path)
+
+
+async def upload_archive_files(upload: Upload) -> None:
+    """Extract an archive attachment to S3, editing a status message with the progress."""
+    status_message = await upload.message.reply_text(text=f'Extracting {upload.extract}')
+    report = SyncReport()
+    reporter = asyncio.create_task(report_progress(status_message, f'files of {upload.extract}', report))
+    try:
+        text = await extract_upload(upload, report)
+    except Exception as e:
+        logger.error(e)
+        text = f'Upload failed: {e}'
+    finally:
+        reporter.cancel()
+    with tracing.span('telegram.reply'):
+        await status_message.edit_text(text=text)
+
+
+@tracing.traced('upload.extract')
+async def extract_upload(upload: Upload, report=None) -> str:
+    """Upload the files of an archive attachment under the prefix of its caption.
+
+    Tar archives are extracted while they are downloaded. Zip archives list their files at the end,
+    so they are downloaded to TEMP_PATH first, but their files are never written to disk either.
+
+    :return: Report for the user
+    """
+    report = report if report is not None else SyncReport()
+    file = upload.file
+    options = {'acl': 'public-read', 'settings': upload.settings, 'report': report}
+    if is_streamable(upload.extract) and not (TELEGRAM_LOCAL and file.file_path.startswith('/')):
+        tracing.set_attributes(**{'upload.source': 'telegram'})
+        await extract_archive(upload.extract, upload.file_name, chunks=iter_url(file.file_path), **options)
+    else:
+        local_path, temporary = await download_file(file, upload.extract)
         try:
-            os.unlink(tmp_file_name)
-        except Exception as e:
-            logger.error(e)
-    s3_file_path = s3_get_obj_url(file_name)
-    await message.reply_text(text=s3_file_path)
+            await extract_archive(local_path, upload.file_name, **options)
+        finally:
+            if temporary:
+                os.unlink(local_path)
+    tracing.set_attributes(**{'extract.files': len(report.uploaded), 'extract.bytes': report.bytes_uploaded})
+    if report.uploaded:
+        schedule_purge(*(upload.file_name + name for name in report.uploaded))
+    text = (f'Extracted {len(report.uploaded)} files ({format_size(report.bytes_uploaded)}) of {upload.extract} '
+            f'to {s3_get_obj_url(upload.file_name)}')
+    return format_failures(text, report.failed)
+
+
+# Messages of albums being received, by media group id
+_media_groups = {}
+
+
+async def collect_media_group(message) -> None:
+    """Collect the messages of an album and upload them together once no more arrive.
+
+    Telegram delivers every item of an album as a separate message sharing a media_group_id. The
+    handler call that receives the first item waits until the album is complete, the others only
+    add their message to it. The other items are handled while the first call waits, which requires
+    concurrent updates, see main().
+    """
+    group = _media_groups.get(message.media_group_id)
+    if group is not None:
+        group.append(message)
+        return
+
+    group = _media_groups[message.media_group_id] = [message]
+    try:
+        size = 0
+        while size != len(group):
+            size = len(group)
+            await asyncio.sleep(MEDIA_GROUP_WAIT)
+    finally:
+        del _media_groups[message.media_group_id]
+    await upload_media_group(sorted(group, key=lambda item: item.message_id))
+
+
+async def upload_media_group(messages) -> None:
+    """Upload the items of an album concurrently and answer with a single message."""
+    # A caption ending with a slash on any item is the folder of the items without a caption
+    default_prefix = None
+    for message in messages:
+        if message.caption:
+            caption, _ = parse_caption(message.caption)
+            if caption.endswith('/'):
+                default_prefix = caption
+                break
+
+    if JOB_QUEUE_ENABLED:
+        items = []
+        for message in messages:
+            try:
+                items.append(upload_job_item(await prepare_upload(message, default_prefix)))
+            except UploadError as e:
+                items.append({'error': str(e)})
+        await enqueue_job(messages[0], 'upload', {'items': items}, f'Queued {len(items)} files')
+        return
+
+    workers = asyncio.Semaphore(MEDIA_GROUP_WORKERS)
+
+    async def upload_item(message):
+        async with workers:
+            try:
+                upload = await prepare_upload(message, default_prefix)
+                if upload.extract is not None:
+                    return await extract_upload(upload)
+                return await transfer_upload(upload)
+            except UploadError as e:
+                return str(e)
+            except Exception as e:
+                logger.error(e)
+                return f'Upload failed: {e}'
+
+    results = await asyncio.gather(*(upload_item(message) for message in messages))
+    await messages[0].reply_text(text='\n'.join(results))
+
 
+def schedule_purge(*file_names):
+    """Queue changed paths for an automatic CDN purge, if enabled."""
+    cdn.purge_queue.enqueue(file_names)
 
+
+def edge_cache_note():
+    if cdn.purge_queue.running:
+        return 'Edge caches will be cleared automatically.'
+    return 'Do not forget to clear all of your edge caches.'
+
+
+def format_failures(text, failed):
+    """Append the (item, error) tuples of failed items to a message, as many as fit."""
+    if failed:
+        text += f'\nFailed {len(failed)}:'
+        for item, error in failed:
+            # Copies report (src, dest, size) tuples
+            key = item[0] if isinstance(item, tuple) else item
+            line = f'\n{key}: {error}'
+            if len(text) + len(line) > MAX_MESSAGE_LENGTH - 4:
+                text += '\n...'
+                break
+            text += line
+    return text
+
+
+def format_bulk_report(action, report):
+    """Summarize a BulkReport in one message."""
+    return format_failures(f'{action} {len(report.succeeded)} files.', report.failed)
+
+
+@metrics.track_handler('delete')
 async def delete_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if len(context.args) == 0:
         return
 
-    file_name = context.args[0].strip().lstrip('/')
+    file_names = [arg.strip().lstrip('/') for arg in context.args]
+    if len(file_names) == 1 and file_names[0].endswith('*'):
+        await confirm_delete_prefix(update, context, file_names[0][:-1])
+        return
+
+    if len(file_names) > 1:
+        if JOB_QUEUE_ENABLED:
+            await enqueue_job(update.effective_message, 'delete', {'keys': file_names},
+                              f'Queued deleting {len(file_names)} files')
+            return
+        try:
+            await update.effective_message.reply_text(text=await delete_keys(file_names))
+        except Exception as e:
+            logger.error(e)
+            await update.effective_message.reply_text(text=f'Error: {e}')
+        return
+
+    file_name = file_names[0]
     try:
         s3_file_path = s3_get_obj_url(file_name)
-        s3_delete_file(file_name)
-        await update.effective_message.reply_text(
-            text=f'File {s3_file_path} has been deleted. Do not forget to clear all of your edge caches.')
+        await s3_delete_file(file_name)
+        schedule_purge(file_name)
+        await update.effective_message.reply_text(text=f'File {s3_file_path} has been deleted. {edge_cache_note()}')
     except Exception as e:
         logger.error(e)
         await update.effective_message.reply_text(text=f'Error: {e}')
 
 
+async def delete_keys(file_names) -> str:
+    """Delete several files in bulk.
+
+    :return: Report for the user
+    """
+    report = await bulk_delete_files(file_names)
+    schedule_purge(*report.succeeded)
+    return f"{format_bulk_report('Deleted', report)} {edge_cache_note()}"
+
+
+async def delete_prefix(prefix) -> str:
+    """Delete everything under a prefix.
+
+    :return: Report for the user
+    """
+    report = await bulk_delete_prefix(prefix)
+    schedule_purge(f'{prefix}*')
+    return f"{format_bulk_report('Deleted', report)} {edge_cache_note()}"
+
+
+async def confirm_delete_prefix(update: Update, context: ContextTypes.DEFAULT_TYPE, prefix):
+    """Ask for a confirmation before deleting everything under a prefix."""
+    if not prefix:
+        await update.effective_message.reply_text(text='Refusing to delete the whole bucket, specify a prefix.')
+        return
+
+    pending = context.chat_data.setdefault('pending_deletes', {})
+    pending_id = uuid.uuid4().hex[:8]
+    pending[pending_id] = prefix
+    reply_markup = InlineKeyboardMarkup([[
+        InlineKeyboardButton('Delete', callback_data=f'delete:{pending_id}:yes'),
+        InlineKeyboardButton('Cancel', callback_data=f'delete:{pending_id}:no'),
+    ]])
+    await update.effective_message.reply_text(text=f'Delete all files under {prefix}?', reply_markup=reply_markup)
+
+
+@metrics.track_handler('delete_prefix')
+async def delete_prefix_confirmed(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Delete everything under a prefix once the deletion has been confirmed."""
+    query = update.callback_query
+    if update.effective_user is None or update.effective_user.username != TELEGRAM_USERNAME:
+        await query.answer()
+        return
+
+    _, pending_id, answer = query.data.split(':')
+    prefix = context.chat_data.get('pending_deletes', {}).pop(pending_id, None)
+    await query.answer()
+    if prefix is None:
+        await query.edit_message_text(text='This request has expired, run /delete again.')
+        return
+    if answer != 'yes':
+        await query.edit_message_text(text=f'Files under {prefix} have been kept.')
+        return
+
+    if JOB_QUEUE_ENABLED:
+        await enqueue_job(query.message, 'delete', {'prefix': prefix}, f'Queued deleting files under {prefix}',
+                          status_message=query.message)
+        return
+    await query.edit_message_text(text=f'Deleting files under {prefix}...')
+    try:
+        await query.edit_message_text(text=await delete_prefix(prefix))
+    except Exception as e:
+        logger.error(e)
+        await query.edit_message_text(text=f'Error: {e}')
+
+
+@metrics.track_handler('make_public')
 async def make_public(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if len(context.args) == 0:
         return
@@ -171,7 +794,8 @@ async def make_public(update: Update, context: ContextTypes.DEFAULT_TYPE):
     file_name = context.args[0].strip().lstrip('/')
     try:
         s3_file_path = s3_get_obj_url(file_name)
-        s3_make_public(file_name)
+        await s3_make_public(file_name)
+        schedule_purge(file_name)
         await update.effective_message.reply_text(text=f'File {s3_file_path} has become public.')
     except ACLNotSupportedError as e:
         logger.warning(e)
@@ -181,6 +805,7 @@ async def make_public(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.effective_message.reply_text(text=f'Error: {e}')
 
 
+@metrics.track_handler('make_private')
 async def make_private(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if len(context.args) == 0:
         return
@@ -188,7 +813,8 @@ async def make_private(update: Update, context: ContextTypes.DEFAULT_TYPE):
     file_name = context.args[0].strip().lstrip('/')
     try:
         s3_file_path = s3_get_obj_url(file_name)
-        s3_make_private(file_name)
+        await s3_make_private(file_name)
+        schedule_purge(file_name)
         await update.effective_message.reply_text(text=f'File {s3_file_path} has become private.')
     except ACLNotSupportedError as e:
         logger.warning(e)
@@ -198,6 +824,7 @@ async def make_private(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.effective_message.reply_text(text=f'Error: {e}')
 
 
+@metrics.track_handler('exist')
 async def file_exist(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if len(context.args) == 0:
         return
@@ -205,7 +832,7 @@ async def file_exist(update: Update, context: ContextTypes.DEFAULT_TYPE):
     file_name = context.args[0].strip().lstrip('/')
     try:
         s3_file_path = s3_get_obj_url(file_name)
-        if s3_file_exist(file_name):
+        if await s3_file_exist(file_name):
             await update.effective_message.reply_text(text=f'File {s3_file_path} exists.')
             return
         await update.effective_message.reply_text(text=f'File {s3_file_path} does not exist.')
@@ -214,26 +841,140 @@ async def file_exist(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.effective_message.reply_text(text=f'Error: {e}')
 
 
-async def copy_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def copy_or_move_paths(src, dest, move=False) -> str:
+    """Copy or move a file, or every file under a prefix when the source ends with a slash.
+
+    :return: Report for the user
+    """
+    action = 'moved' if move else 'copied'
+    if src == dest:
+        # A move would delete the object it has just copied onto itself
+        return f'Source and destination are the same: {src}'
+    if src.endswith('/'):
+        report = await bulk_copy_prefix(src, dest, move=move)
+        schedule_purge(f'{dest}*', *([f'{src}*'] if move else []))
+        return format_bulk_report(action.capitalize(), report)
+
+    s3_src_path = s3_get_obj_url(src)
+    s3_dest_path = s3_get_obj_url(dest)
+    # The copy checks the source itself, reusing its cached metadata
+    if not await s3_copy_file(src, dest):
+        return f'Source file {s3_src_path} does not exist.'
+    schedule_purge(dest)
+    if move:
+        await s3_delete_file(src)
+        schedule_purge(src)
+    return f'File {s3_src_path} has been {action} to {s3_dest_path}.'
+
+
+async def copy_or_move(update: Update, context: ContextTypes.DEFAULT_TYPE, move=False):
+    """Copy or move a file, or every file under a prefix when the source ends with a slash."""
     if len(context.args) < 2:
         return
 
     src = context.args[0].strip().lstrip('/')
     dest = context.args[1].strip().lstrip('/')
+    action = 'moved' if move else 'copied'
+    if src.endswith('/'):
+        if not dest.endswith('/'):
+            dest += '/'
+    elif dest.endswith('/'):
+        dest += path.basename(src)
+    if JOB_QUEUE_ENABLED:
+        await enqueue_job(update.effective_message, 'copy', {'src': src, 'dest': dest, 'move': move},
+                          f'Queued: {src} will be {action} to {dest}')
+        return
     try:
-        s3_src_path = s3_get_obj_url(src)
-        if not s3_file_exist(src):
-            await update.effective_message.reply_text(text=f'Source file {s3_src_path} does not exist.')
-            return
-
-        s3_dest_path = s3_get_obj_url(dest)
-        s3_copy_file(src, dest)
-        await update.effective_message.reply_text(text=f'File {s3_src_path} has been copied to {s3_dest_path}.')
+        if src.endswith('/'):
+            await update.effective_message.reply_text(text=f'Files under {src} are being {action} to {dest}...')
+        await update.effective_message.reply_text(text=await copy_or_move_paths(src, dest, move))
     except Exception as e:
         logger.error(e)
         await update.effective_message.reply_text(text=f'Error: {e}')
 
 
+@metrics.track_handler('copy_file')
+async def copy_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await copy_or_move(update, context)
+
+
+@metrics.track_handler('move')
+async def move_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await copy_or_move(update, context, move=True)
+
+
+async def download_file(file, file_name):
+    """Download a Telegram file to TEMP_PATH, unless it is already local.
+
+    :return: Tuple of the local path and whether it is a temporary copy to remove
+    """
+    if TELEGRAM_LOCAL and file.file_path.startswith('/'):
+        return file.file_path, False
+    # Keep the extension, which tells the archive format
+    temp_path = path.join(TEMP_PATH, f'{uuid.uuid4().hex}-{path.basename(file_name)}')
+    try:
+        with open(temp_path, 'wb') as f:
+            async for chunk in iter_url(file.file_path):
+                await aio.run(aio.BULK, f.write, chunk)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+    return temp_path, True
+
+
+async def sync_archive(file, file_name, prefix, delete, report=None) -> str:
+    """Mirror the files of an archive to a prefix.
+
+    :return: Report for the user
+    """
+    report = report if report is not None else SyncReport()
+    local_path, temporary = await download_file(file, file_name)
+    try:
+        await sync_path(local_path, prefix, delete=delete, checksum=True, report=report)
+    finally:
+        if temporary:
+            os.unlink(local_path)
+    changed = [prefix + name for name in report.uploaded + report.deleted]
+    if changed:
+        schedule_purge(*changed)
+    return format_failures(f'Synced {file_name} to {prefix or "/"}: {report}.', report.failed)
+
+
+@metrics.track_handler('sync')
+async def sync_files(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Mirror an archive the command replies to, to a prefix."""
+    message = update.effective_message
+    document = message.reply_to_message.document if message.reply_to_message is not None else None
+    if document is None or not is_archive(document.file_name or ''):
+        await message.reply_text(text='Reply to a zip or tar archive with /sync <prefix> [--delete].')
+        return
+    args = [arg for arg in context.args if not arg.startswith('--')]
+    delete = '--delete' in context.args
+    prefix = args[0].strip().lstrip('/') if args else ''
+    if prefix and not prefix.endswith('/'):
+        prefix += '/'
+    if JOB_QUEUE_ENABLED:
+        await enqueue_job(message, 'sync', {'file_id': document.file_id, 'file_name': document.file_name,
+                                            'prefix': prefix, 'delete': delete},
+                          f'Queued syncing {document.file_name} to {prefix or "/"}')
+        return
+
+    status_message = await message.reply_text(text=f'Syncing {document.file_name} to {prefix or "/"}')
+    report = SyncReport()
+    reporter = asyncio.create_task(report_progress(status_message, f'{document.file_name} to {prefix or "/"}',
+                                                   report))
+    try:
+        file = await document.get_file()
+        text = await sync_archive(file, document.file_name, prefix, delete, report)
+    except Exception as e:
+        logger.error(e)
+        text = f'Error: {e}'
+    finally:
+        reporter.cancel()
+    await status_message.edit_text(text=text)
+
+
+@metrics.track_handler('get_file_acl')
 async def get_file_acl(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if len(context.args) == 0:
         return
@@ -241,7 +982,7 @@ async def get_file_acl(update: Update, context: ContextTypes.DEFAULT_TYPE):
     file_name = context.args[0].strip().lstrip('/')
     try:
         s3_file_path = s3_get_obj_url(file_name)
-        acl = s3_get_file_acl(file_name)
+        acl = await s3_get_file_acl(file_name)
         if acl is None:
             await update.effective_message.reply_text(
                 text='ACL operations are not supported by this storage provider.')
@@ -252,6 +993,37 @@ async def get_file_acl(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.effective_message.reply_text(text=f'Error: {e}')
 
 
+def render_list_page(listing, page, entries, next_token, notice=None):
+    """Render a page of a listing, with prev/next buttons backed by the cached page positions.
+
+    A page ends early when its entries do not fit in a message, the next one then starts after its last key.
+
+    :param notice: Text shown after the page number, e.g. to tell that the page size was reduced
+    """
+    # Keep under the Telegram message size limit
+    text = f'Page {page + 1}' + (f' ({notice})' if notice else '') + '\n'
+    shown = 0
+    for entry in entries:
+        line = s3_get_obj_url(entry['key'])
+        if len(text) + len(line) + 1 > MAX_MESSAGE_LENGTH:
+            break
+        text += line + '\n'
+        shown += 1
+
+    positions = listing['positions']
+    if (next_token is not None or shown < len(entries)) and len(positions) == page + 1:
+        positions.append(entries[shown - 1]['key'])
+
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton('« Prev', callback_data=f'list:{listing["id"]}:{page - 1}'))
+    if len(positions) > page + 1:
+        buttons.append(InlineKeyboardButton('Next »', callback_data=f'list:{listing["id"]}:{page + 1}'))
+    reply_markup = InlineKeyboardMarkup([buttons]) if buttons else None
+    return text.rstrip(), reply_markup
+
+
+@metrics.track_handler('list')
 async def list_files(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if len(context.args) == 0:
         return
@@ -264,22 +1036,136 @@ async def list_files(update: Update, context: ContextTypes.DEFAULT_TYPE):
         except ValueError:
             await update.effective_message.reply_text(text='Invalid limit. Usage: /list <prefix> [limit]')
             return
-    entries = s3_list_files(prefix, limit=limit)
+    notice = f'limit reduced to {LIST_PAGE_MAX_SIZE} per page' if limit > LIST_PAGE_MAX_SIZE else None
+    limit = max(1, min(limit, LIST_PAGE_MAX_SIZE))
+
+    try:
+        entries, next_token = await s3_list_files_page(prefix, limit)
+    except Exception as e:
+        logger.error(e)
+        await update.effective_message.reply_text(text=f'Error: {e}')
+        return
     if len(entries) == 0:
         await update.effective_message.reply_text(text='Not found')
         return
 
-    message = '\n'.join(list(map(lambda entry: s3_get_obj_url(entry['key']), entries)))
-    await update.effective_message.reply_text(text=message)
+    # Page positions are cached per chat, positions[n] being the key page n starts after.
+    # Callback data is limited to 64 bytes, so buttons only carry the listing id and the page.
+    listings = context.chat_data.setdefault('listings', {})
+    listing = {'id': uuid.uuid4().hex[:8], 'prefix': prefix, 'limit': limit, 'positions': [None]}
+    listings[listing['id']] = listing
+    while len(listings) > LIST_MAX_CACHED:
+        del listings[next(iter(listings))]
+
+    text, reply_markup = render_list_page(listing, 0, entries, next_token, notice)
+    await update.effective_message.reply_text(text=text, reply_markup=reply_markup)
+
+
+# /find answers with at most this many files
+FIND_MAX_RESULTS = 50
+
+
+async def check_inventory(message) -> bool:
+    """Tell the user when the inventory cannot answer yet.
+
+    :return: True if the inventory can be queried
+    """
+    if not INVENTORY_ENABLED:
+        await message.reply_text(text='The bucket inventory is disabled. Set INVENTORY_ENABLED=1 to enable it.')
+        return False
+    if await aio.run(aio.METADATA, inventory_last_sync) is None:
+        await message.reply_text(text='The bucket inventory is being built, please try again in a few minutes.')
+        return False
+    return True
 
 
+@metrics.track_handler('find')
+async def find_files(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Find files by glob pattern in the bucket inventory."""
+    if len(context.args) == 0:
+        return
+    message = update.effective_message
+    pattern = context.args[0].strip().lstrip('/')
+    try:
+        if not await check_inventory(message):
+            return
+        entries, total = await aio.run(aio.METADATA, inventory.find, pattern, FIND_MAX_RESULTS)
+        if total == 0:
+            await message.reply_text(text='Not found')
+            return
+        text = f'{total} files' + (f', first {len(entries)}' if total > len(entries) else '') + ':\n'
+        for entry in entries:
+            line = f'{entry["key"]} ({format_size(entry["size"])})\n'
+            if len(text) + len(line) > MAX_MESSAGE_LENGTH:
+                break
+            text += line
+        await message.reply_text(text=text.rstrip())
+    except Exception as e:
+        logger.error(e)
+        await message.reply_text(text=f'Error: {e}')
+
+
+@metrics.track_handler('du')
+async def disk_usage(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Count the files under a prefix and their size from the bucket inventory."""
+    message = update.effective_message
+    prefix = context.args[0].strip().lstrip('/') if context.args else ''
+    try:
+        if not await check_inventory(message):
+            return
+        count, size, segments = await aio.run(aio.METADATA, inventory.usage, prefix)
+        if count == 0:
+            await message.reply_text(text='Not found')
+            return
+        last = await aio.run(aio.METADATA, inventory_last_sync)
+        lines = [f'{prefix or "/"}: {count} files, {format_size(size)}']
+        for segment, segment_count, segment_size in segments:
+            lines.append(f'{segment or "(files)"}: {segment_count} files, {format_size(segment_size)}')
+        lines.append(f'\nListed {format_time(last)}, with the changes made by the bot since.')
+        await message.reply_text(text='\n'.join(lines))
+    except Exception as e:
+        logger.error(e)
+        await message.reply_text(text=f'Error: {e}')
+
+
+@metrics.track_handler('list_page')
+async def list_files_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show another page of a listing when a prev/next button is pressed."""
+    query = update.callback_query
+    if update.effective_user is None or update.effective_user.username != TELEGRAM_USERNAME:
+        await query.answer()
+        return
+
+    _, listing_id, page = query.data.split(':')
+    page = int(page)
+    listing = context.chat_data.get('listings', {}).get(listing_id)
+    if listing is None or page >= len(listing['positions']):
+        await query.answer(text='This listing has expired, run /list again.')
+        return
+
+    try:
+        entries, next_token = await s3_list_files_page(listing['prefix'], listing['limit'],
+                                                       start_after=listing['positions'][page])
+    except Exception as e:
+        logger.error(e)
+        await query.answer(text=f'Error: {e}')
+        return
+    await query.answer()
+    if len(entries) == 0:
+        await query.edit_message_text(text='Not found')
+        return
+    text, reply_markup = render_list_page(listing, page, entries, next_token)
+    await query.edit_message_text(text=text, reply_markup=reply_markup)
+
+
+@metrics.track_handler('get_meta')
 async def get_metadata(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if len(context.args) == 0:
         return
 
     file_name = context.args[0].strip().lstrip('/')
     try:
-        response = s3_get_meta(file_name)
+        response = await s3_get_meta(file_name)
         logger.info(response)
         await update.effective_message.reply_text(text=f'{response}')
     except Exception as e:
@@ -287,47 +1173,223 @@ async def get_metadata(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.effective_message.reply_text(text=f'Error: {e}')
 
 
+@metrics.track_handler('presign')
+async def presign(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Sign a temporary URL to download a file, or with --put or --post to upload one, without the bot in between."""
+    args = [arg for arg in context.args if not arg.startswith('--')]
+    _, options = parse_caption(' '.join(arg for arg in context.args if arg.startswith('--')), known_options=None)
+    if len(args) == 0:
+        return
+
+    file_name = args[0].strip().lstrip('/')
+    message = update.effective_message
+    try:
+        ttl = parse_duration(args[1]) if len(args) > 1 else PRESIGN_DEFAULT_TTL
+        if not 0 < ttl <= PRESIGN_MAX_TTL:
+            raise ValueError(f'The lifetime must be at most {PRESIGN_MAX_TTL // 86400} days')
+        unknown = set(options) - {'put', 'post', 'max-size'}
+        if unknown:
+            raise ValueError(f'Unknown option: --{unknown.pop()}')
+        expires = (datetime.now(timezone.utc) + timedelta(seconds=ttl)).strftime('%Y-%m-%d %H:%M UTC')
+        mime_type = mimetypes.MimeTypes().guess_type(file_name)[0]
+
+        if 'post' in options:
+            max_size = parse_size(options['max-size']) if options.get('max-size') else None
+            post = s3_presign_post(file_name, ttl, mime_type, max_size)
+            form = ' '.join(f"-F '{name}={value}'" for name, value in post['fields'].items())
+            await message.reply_text(text=f'Upload form for {file_name}, valid until {expires}:\n\n'
+                                          f"curl {form} -F 'file=@FILE' '{post['url']}'")
+        elif 'put' in options:
+            url = s3_presign_put(file_name, ttl, mime_type)
+            header = f"-H 'Content-Type: {mime_type}' " if mime_type else ''
+            await message.reply_text(text=f'Upload URL for {file_name}, valid until {expires}:\n{url}\n\n'
+                                          f"curl -X PUT {header}-T FILE '{url}'")
+        else:
+            # Signed locally without checking the file exists, a missing file answers 404 when the URL is used
+            url = s3_presign_get(file_name, ttl)
+            await message.reply_text(text=f'{url}\n\nValid until {expires}.')
+    except Exception as e:
+        logger.error(e)
+        await message.reply_text(text=f'Error: {e}')
+
+
+async def purge_paths(file_names) -> str:
+    """Purge paths from the edge caches.
+
+    :return: Report for the user
+    """
+    purged = await cdn.purge(file_names)
+    if len(purged) == 1 and not purged[0].endswith('*'):
+        s3_file_path = s3_get_obj_url(purged[0])
+        return f'File {s3_file_path} has been cleared from all of your edge caches.'
+    return f'{len(purged)} paths have been cleared from all of your edge caches:\n' + '\n'.join(purged)
+
+
+@metrics.track_handler('purge_cache')
 async def purge_cache(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if len(context.args) == 0:
         return
 
-    if DIGITALOCEAN_TOKEN is None:
+    if not cdn.is_available():
         raise Exception('Service is not available.')
 
-    file_name = context.args[0].strip().lstrip('/')
+    file_names = [arg.strip().lstrip('/') for arg in context.args]
+    if JOB_QUEUE_ENABLED:
+        await enqueue_job(update.effective_message, 'purge', {'paths': file_names},
+                          f'Queued purging {len(file_names)} paths')
+        return
     try:
-        s3_file_path = s3_get_obj_url(file_name)
-        endpoint_url = ENDPOINT_URL.lstrip('https://')
-        origin = f'{BUCKET_NAME}.{endpoint_url}'
-        headers = {
-            'Authorization': f'Bearer {DIGITALOCEAN_TOKEN}',
-            'Content-Type': 'application/json',
-        }
-        api_url = f'https://api.digitalocean.com/v2/cdn/endpoints'
-        response = requests.get(api_url, headers=headers)
-        response.raise_for_status()
-        data = response.json()
-        if 'endpoints' not in data:
-            raise Exception('No endpoints found.')
-
-        endpoints = list(filter(lambda endpoint: endpoint['origin'] == origin, data['endpoints']))
-        if len(endpoints) == 0:
-            raise Exception('No endpoints found.')
-
-        endpoint_id = endpoints[0]['id']
-        logger.info(endpoint_id)
-
-        api_url = f'https://api.digitalocean.com/v2/cdn/endpoints/{endpoint_id}/cache'
-        response = requests.delete(api_url, headers=headers, json={
-            'files': [file_name]
-        })
-        response.raise_for_status()
-        await update.effective_message.reply_text(text=f'File {s3_file_path} has been cleared from all of your edge caches.')
+        await update.effective_message.reply_text(text=await purge_paths(file_names))
     except Exception as e:
         logger.error(e)
         await update.effective_message.reply_text(text=f'Error: {e}')
 
 
+async def enqueue_job(message, kind, payload, text, status_message=None):
+    """Queue a job for the workers. Its progress and result replace the status message."""
+    if status_message is None:
+        status_message = await message.reply_text(text=text)
+    else:
+        await status_message.edit_text(text=text)
+    traceparent = tracing.current_traceparent()
+    if traceparent is not None:
+        # The worker running the job continues the trace of this update
+        payload = dict(payload, traceparent=traceparent)
+    # The queue database may be locked by a worker for a while, keep the event loop free meanwhile
+    await aio.run(aio.METADATA, job_queue.enqueue, kind, payload, status_message.chat_id, status_message.message_id)
+
+
+def upload_job_item(upload: Upload):
+    return {
+        'file_id': upload.file.file_id,
+        'file_size': upload.attachment.file_size,
+        'file_name': upload.file_name,
+        'mime_type': upload.mime_type,
+        'settings': dataclasses.asdict(upload.settings),
+        'extract': upload.extract,
+    }
+
+
+async def run_upload_job(bot, job) -> str:
+    """Upload a file or an album in a worker."""
+    # Finish the multipart uploads of local files left by a previous attempt, and abort its streams.
+    # Their items are not uploaded again.
+    resumed = {}
+
+    async def remember_resumed(entry):
+        resumed[entry['meta'].get('item')] = entry['object_name']
+
+    await resume_uploads(remember_resumed, match=lambda entry: entry['meta'].get('job_id') == job.id)
+
+    items = job.payload['items']
+    progress = None
+    if len(items) == 1 and 'error' not in items[0]:
+        if items[0].get('extract'):
+            progress = SyncReport()
+            job.progress = lambda: f'Uploading files of {items[0]["extract"]}\n{progress}'
+        else:
+            progress = TransferProgress(items[0]['file_size'])
+            job.progress = lambda: f'Uploading {items[0]["file_name"]}\n{progress}'
+    workers = asyncio.Semaphore(MEDIA_GROUP_WORKERS)
+
+    async def upload_item(index, item):
+        if 'error' in item:
+            return item['error']
+        async with workers:
+            with tracing.span('telegram.get_file', **{'telegram.file_size': item['file_size']}):
+                file = await bot.get_file(item['file_id'])
+            upload = Upload(None, None, file, item['file_name'], item['mime_type'],
+                            TransferSettings(**item['settings']), item.get('extract'))
+            try:
+                if upload.extract is not None:
+                    return await extract_upload(upload, progress)
+                if resumed.get(index) == upload.file_name:
+                    logger.info(f'{upload.file_name} was completed by resuming its upload')
+                    return await finish_resumed_upload(upload)
+                return await transfer_upload(upload, progress, job_id=job.id, job_item=index)
+            except Exception as e:
+                if len(items) == 1:
+                    # Let the queue retry it
+                    raise
+                logger.error(e)
+                return f'Upload failed: {e}'
+
+    results = await asyncio.gather(*(upload_item(index, item) for index, item in enumerate(items)))
+    return '\n'.join(results)
+
+
+async def run_copy_job(bot, job) -> str:
+    return await copy_or_move_paths(job.payload['src'], job.payload['dest'], job.payload['move'])
+
+
+async def run_delete_job(bot, job) -> str:
+    if 'prefix' in job.payload:
+        return await delete_prefix(job.payload['prefix'])
+    return await delete_keys(job.payload['keys'])
+
+
+async def run_purge_job(bot, job) -> str:
+    return await purge_paths(job.payload['paths'])
+
+
+async def run_sync_job(bot, job) -> str:
+    report = SyncReport()
+    job.progress = lambda: f'Syncing {job.payload["file_name"]} to {job.payload["prefix"] or "/"}\n{report}'
+    file = await bot.get_file(job.payload['file_id'])
+    return await sync_archive(file, job.payload['file_name'], job.payload['prefix'], job.payload['delete'], report)
+
+
+# Coroutine functions run by the workers for every kind of job, returning the text sent to the user
+JOB_HANDLERS = {
+    'upload': run_upload_job,
+    'copy': run_copy_job,
+    'delete': run_delete_job,
+    'purge': run_purge_job,
+    'sync': run_sync_job,
+}
+
+
+async def deliver_job_results(application: Application) -> None:
+    """Relay the progress and the results of queued jobs to their chats."""
+    bot = application.bot
+    # Last progress text and edit time, by job id
+    reported = {}
+
+    async def send(job, text):
+        if job['message_id']:
+            await bot.edit_message_text(text=text, chat_id=job['chat_id'], message_id=job['message_id'])
+        else:
+            await bot.send_message(chat_id=job['chat_id'], text=text)
+
+    while True:
+        await asyncio.sleep(JOB_POLL_INTERVAL)
+        try:
+            now = asyncio.get_running_loop().time()
+            for job in await aio.run(aio.METADATA, job_queue.running):
+                last_text, last_time = reported.get(job['id'], (None, 0))
+                if not job['progress'] or job['progress'] == last_text or now - last_time < PROGRESS_INTERVAL:
+                    continue
+                reported[job['id']] = (job['progress'], now)
+                try:
+                    await send(job, job['progress'])
+                except TelegramError as e:
+                    logger.warning(e)
+
+            for job in await aio.run(aio.METADATA, job_queue.finished):
+                reported.pop(job['id'], None)
+                text = job['result'] if job['status'] == JOB_DONE else f'Error: {job["error"]}'
+                try:
+                    await send(job, text)
+                except (BadRequest, Forbidden) as e:
+                    # The message or chat is gone, retrying would not help
+                    logger.warning(e)
+                await aio.run(aio.METADATA, job_queue.mark_delivered, job['id'])
+            await aio.run(aio.METADATA, job_queue.prune)
+        except Exception as e:
+            # Network errors included: the undelivered results are sent on the next round
+            logger.error(e)
+
+
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Log the error or/and send a telegram message to notify the developer."""
     # Log the error before we do anything else, so we can see it even if something breaks.
@@ -360,11 +1422,81 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         await context.bot.send_message(chat_id=chat_id, text=message, parse_mode=ParseMode.HTML)
 
 
+async def resume_interrupted_uploads(application: Application) -> None:
+    """Finish the uploads interrupted by a restart and clean up orphaned multipart uploads."""
+    async def report(entry):
+        schedule_purge(entry['object_name'])
+        meta = entry['meta']
+        if not meta.get('chat_id'):
+            return
+        text = s3_get_obj_url(entry['object_name'])
+        try:
+            if meta.get('message_id'):
+                await application.bot.edit_message_text(text=text, chat_id=meta['chat_id'],
+                                                        message_id=meta['message_id'])
+            else:
+                await application.bot.send_message(chat_id=meta['chat_id'], text=text)
+        except TelegramError as e:
+            logger.warning(e)
+
+    try:
+        # Uploads of queued jobs are resumed by the worker running the job again
+        await resume_uploads(report, match=lambda entry: 'job_id' not in entry['meta'])
+        aborted = await abort_stale_uploads()
+        if aborted:
+            logger.info(f'Aborted {aborted} stale multipart uploads')
+    except Exception as e:
+        logger.error(e)
+
+
+async def post_init(application: Application) -> None:
+    """Start background work once the application is initialized."""
+    if cdn.CDN_AUTO_PURGE and cdn.is_available():
+        cdn.purge_queue.start()
+    application.bot_data['resume_task'] = asyncio.create_task(resume_interrupted_uploads(application))
+    if JOB_QUEUE_ENABLED:
+        application.bot_data['jobs_task'] = asyncio.create_task(deliver_job_results(application))
+    if INVENTORY_ENABLED:
+        application.bot_data['inventory_task'] = asyncio.create_task(run_inventory_sync())
+    # In webhook mode the server is run by webhook.run_webhook()
+    if not webhook.is_enabled() and webhook.is_server_enabled():
+        server = webhook.create_server(application)
+        await server.start()
+        application.bot_data['http_server'] = server
+
+
+async def post_shutdown(application: Application) -> None:
+    """Release resources when the application stops."""
+    if 'http_server' in application.bot_data:
+        await application.bot_data.pop('http_server').stop()
+    if 'jobs_task' in application.bot_data:
+        application.bot_data.pop('jobs_task').cancel()
+        job_queue.close()
+    if 'inventory_task' in application.bot_data:
+        application.bot_data.pop('inventory_task').cancel()
+    inventory.close()
+    await close_http_client()
+    await cdn.purge_queue.stop()
+    await cdn.close_http_client()
+    dedup_index.close()
+    aio.shutdown()
+    images.shutdown()
+    tracing.shutdown()
+
+
 def main():
     """Start the bot."""
     # Create the Application and pass it your bot's token.
     defaults = Defaults(link_preview_options=LinkPreviewOptions(is_disabled=True))
     builder = Application.builder().token(TELEGRAM_API_TOKEN).defaults(defaults)
+    # The handler of the first item of an album waits for the other items, which would never be handled
+    # meanwhile with updates processed one at a time
+    if TELEGRAM_CONCURRENT_UPDATES < 2:
+        raise ValueError('TELEGRAM_CONCURRENT_UPDATES must be at least 2 to receive albums')
+    builder = builder.concurrent_updates(TELEGRAM_CONCURRENT_UPDATES)
+    builder = builder.rate_limiter(create_rate_limiter())
+    builder = builder.post_init(post_init)
+    builder = builder.post_shutdown(post_shutdown)
 
     # Use local Bot API server if configured
     if TELEGRAM_BASE_URL:
@@ -394,11 +1526,13 @@ def main():
                                            & filters.User(username=TELEGRAM_USERNAME)
                                            & ~filters.COMMAND, upload_file))
 
-    # delete file from s3 by path
+    # delete files from s3 by path, or everything under a prefix (after a confirmation)
     application.add_handler(CommandHandler('delete',
                                            delete_file,
                                            filters.User(username=TELEGRAM_USERNAME)))
 
+    application.add_handler(CallbackQueryHandler(delete_prefix_confirmed, pattern=r'^delete:'))
+
     # make file public
     application.add_handler(CommandHandler('make_public',
                                            make_public,
@@ -419,6 +1553,16 @@ def main():
                                            copy_file,
                                            filters.User(username=TELEGRAM_USERNAME)))
 
+    # move or rename file, or a whole prefix
+    application.add_handler(CommandHandler('move',
+                                           move_file,
+                                           filters.User(username=TELEGRAM_USERNAME)))
+
+    # mirror an archive to a prefix, in reply to the archive
+    application.add_handler(CommandHandler('sync',
+                                           sync_files,
+                                           filters.User(username=TELEGRAM_USERNAME)))
+
     # check file acl
     application.add_handler(CommandHandler('get_file_acl',
                                            get_file_acl,
@@ -429,11 +1573,27 @@ def main():
                                            list_files,
                                            filters.User(username=TELEGRAM_USERNAME)))
 
+    application.add_handler(CallbackQueryHandler(list_files_page, pattern=r'^list:'))
+
+    # search the bucket inventory
+    application.add_handler(CommandHandler('find',
+                                           find_files,
+                                           filters.User(username=TELEGRAM_USERNAME)))
+
+    application.add_handler(CommandHandler('du',
+                                           disk_usage,
+                                           filters.User(username=TELEGRAM_USERNAME)))
+
     # get object metadata
     application.add_handler(CommandHandler('get_meta',
                                            get_metadata,
                                            filters.User(username=TELEGRAM_USERNAME)))
 
+    # sign temporary download and upload URLs
+    application.add_handler(CommandHandler('presign',
+                                           presign,
+                                           filters.User(username=TELEGRAM_USERNAME)))
+
     # purge cache
     application.add_handler(CommandHandler('purge_cache',
                                            purge_cache,
@@ -443,7 +1603,10 @@ def main():
     application.add_error_handler(error_handler)
 
     # Start the Bot and run until Ctrl-C
-    application.run_polling()
+    if webhook.is_enabled():
+        webhook.run_webhook(application, local_api=bool(TELEGRAM_BASE_URL))
+    else:
+        application.run_polling()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,152 @@
+"""Bulk operations over many objects, issued concurrently in batches."""
+import os
+import asyncio
+import logging
+
+from . import aio, s3bucket
+
+logger = logging.getLogger(__name__)
+
+# DeleteObjects accepts up to 1000 keys per request
+DELETE_BATCH_SIZE = 1000
+BULK_WORKERS = int(os.getenv('BULK_WORKERS') or 4)
+
+
+class BulkReport:
+    """Aggregated outcome of a bulk operation."""
+
+    def __init__(self):
+        self.succeeded = []
+        self.failed = []
+
+    def add(self, succeeded, failed):
+        self.succeeded.extend(succeeded)
+        self.failed.extend(failed)
+
+    def fail(self, keys, error):
+        self.failed.extend((key, str(error)) for key in keys)
+
+
+class _BatchRunner:
+    """Run batches in a bounded number of concurrent workers and collect their results.
+
+    :param func: Blocking callable taking a batch and returning a tuple of succeeded items and
+        (item, error message) tuples
+    """
+
+    def __init__(self, func, report, max_concurrency=BULK_WORKERS, kind=aio.METADATA):
+        self.func = func
+        self.report = report
+        self.kind = kind
+        self.slots = asyncio.Semaphore(max_concurrency)
+        self.tasks = []
+
+    async def _run(self, batch):
+        try:
+            succeeded, failed = await aio.run(self.kind, self.func, batch)
+            self.report.add(succeeded, failed)
+        except Exception as e:
+            logger.error(e)
+            self.report.fail(batch, e)
+        finally:
+            self.slots.release()
+
+    async def submit(self, batch):
+        # Wait for a free worker first, so that listing never runs far ahead of the deletes
+        await self.slots.acquire()
+        self.tasks.append(asyncio.create_task(self._run(batch)))
+
+    async def join(self):
+        await asyncio.gather(*self.tasks)
+
+
+async def delete_files(file_names, max_concurrency=BULK_WORKERS):
+    """Delete many files with concurrent DeleteObjects batches.
+
+    :return: BulkReport of the deleted keys and failures
+    """
+    report = BulkReport()
+    runner = _BatchRunner(s3bucket.delete_files, report, max_concurrency)
+    file_names = list(file_names)
+    for i in range(0, len(file_names), DELETE_BATCH_SIZE):
+        await runner.submit(file_names[i:i + DELETE_BATCH_SIZE])
+    await runner.join()
+    return report
+
+
+async def delete_prefix(prefix, max_concurrency=BULK_WORKERS):
+    """Delete every object under a prefix.
+
+    Every listed page of up to 1000 keys is deleted as one batch while the next page is listed.
+
+    :return: BulkReport of the deleted keys and failures
+    """
+    report = BulkReport()
+    runner = _BatchRunner(s3bucket.delete_files, report, max_concurrency)
+    continuation_token = None
+    try:
+        while True:
+            entries, continuation_token = await aio.list_files_page(prefix, DELETE_BATCH_SIZE, continuation_token)
+            if entries:
+                await runner.submit([entry['key'] for entry in entries])
+            if continuation_token is None:
+                break
+    finally:
+        await runner.join()
+    return report
+
+
+def _copy_batch(pairs):
+    """Copy a batch of (src, dest, size) tuples, one request each."""
+    copied = []
+    failed = []
+    for src, dest, size in pairs:
+        try:
+            if s3bucket.copy_file(src, dest, size):
+                copied.append((src, dest, size))
+            else:
+                failed.append(((src, dest, size), 'Source file does not exist.'))
+        except Exception as e:
+            logger.error(e)
+            failed.append(((src, dest, size), str(e)))
+    return copied, failed
+
+
+async def copy_prefix(src_prefix, dest_prefix, move=False, max_concurrency=BULK_WORKERS):
+    """Copy or move every object under a prefix to another prefix, server-side.
+
+    The prefix is processed one listing page at a time, copying the objects of a page
+    concurrently. When moving, the sources of each page are deleted with one DeleteObjects
+    request once they are copied.
+
+    :return: BulkReport of (src, dest, size) tuples
+    """
+    report = BulkReport()
+
+    async def copy_page(entries):
+        pairs = [(entry['key'], dest_prefix + entry['key'][len(src_prefix):], entry['size']) for entry in entries]
+        page_report = BulkReport()
+        runner = _BatchRunner(_copy_batch, page_report, max_concurrency, kind=aio.UPLOAD)
+        for pair in pairs:
+            await runner.submit([pair])
+        await runner.join()
+        if move and page_report.succeeded:
+            _, errors = await aio.run(aio.METADATA, s3bucket.delete_files,
+                                      [src for src, _, _ in page_report.succeeded])
+            errors = dict(errors)
+            page_report.failed.extend((pair, f'Copied, but not deleted: {errors[pair[0]]}')
+                                      for pair in page_report.succeeded if pair[0] in errors)
+            page_report.succeeded = [pair for pair in page_report.succeeded if pair[0] not in errors]
+        report.add(page_report.succeeded, page_report.failed)
+
+    continuation_token = None
+    while True:
+        entries, continuation_token = await aio.list_files_page(src_prefix, DELETE_BATCH_SIZE, continuation_token)
+        # Skip objects that are already under the destination, when it is nested in the source prefix
+        entries = [entry for entry in entries if not (dest_prefix.startswith(src_prefix)
+                                                      and entry['key'].startswith(dest_prefix))]
+        if entries:
+            await copy_page(entries)
+        if continuation_token is None:
+            break
+    return report
@@ -0,0 +1,214 @@
+"""DigitalOcean CDN cache purging.
+
+@see https://docs.digitalocean.com/reference/api/api-reference/#operation/cdn_purge_cache
+"""
+import os
+import time
+import asyncio
+import logging
+from urllib.parse import urlparse
+
+import httpx
+
+from . import ratelimit
+
+logger = logging.getLogger(__name__)
+
+DIGITALOCEAN_TOKEN = os.getenv('DIGITALOCEAN_TOKEN')
+DIGITALOCEAN_API_URL = 'https://api.digitalocean.com/v2'
+BUCKET_NAME = None
+if os.getenv('BUCKET_NAME', '').strip():
+    BUCKET_NAME = os.getenv('BUCKET_NAME')
+ENDPOINT_URL = None
+if os.getenv('ENDPOINT_URL', '').strip():
+    ENDPOINT_URL = os.getenv('ENDPOINT_URL')
+
+# The endpoint id of the bucket rarely changes, so it is looked up once per CDN_ENDPOINT_CACHE_TTL seconds
+CDN_ENDPOINT_CACHE_TTL = float(os.getenv('CDN_ENDPOINT_CACHE_TTL') or 3600)
+# Maximum number of paths sent in a single purge request
+CDN_PURGE_BATCH_SIZE = int(os.getenv('CDN_PURGE_BATCH_SIZE') or 100)
+
+# Opt-in: purge the paths changed by uploads, deletes, copies and ACL changes automatically.
+# Changes are collected for CDN_PURGE_DEBOUNCE seconds and purged together.
+CDN_AUTO_PURGE = os.getenv('CDN_AUTO_PURGE') == '1'
+CDN_PURGE_DEBOUNCE = float(os.getenv('CDN_PURGE_DEBOUNCE') or 5)
+CDN_PURGE_MAX_RETRIES = int(os.getenv('CDN_PURGE_MAX_RETRIES') or 5)
+# Requests per second sent to the DigitalOcean API, which allows 250 per minute
+CDN_RATE_LIMIT = float(os.getenv('CDN_RATE_LIMIT') or 4)
+
+cdn_limiter = ratelimit.Limiter('cdn', CDN_RATE_LIMIT, max_concurrency=4)
+
+
+class CDNError(Exception):
+    """Raised when the CDN cannot be purged."""
+
+
+_http_client = None
+_endpoint = None
+_endpoint_lock = asyncio.Lock()
+
+
+def is_available():
+    return DIGITALOCEAN_TOKEN is not None and ENDPOINT_URL is not None
+
+
+def get_http_client():
+    """Get the shared keep-alive HTTP client for the DigitalOcean API."""
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.AsyncClient(base_url=DIGITALOCEAN_API_URL,
+                                         headers={'Authorization': f'Bearer {DIGITALOCEAN_TOKEN}'},
+                                         timeout=30)
+    return _http_client
+
+
+async def close_http_client():
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+
+def get_origin():
+    """Get the CDN origin of the bucket, e.g. myuploads.ams3.digitaloceanspaces.com."""
+    return f'{BUCKET_NAME}.{urlparse(ENDPOINT_URL).hostname}'
+
+
+async def get_endpoint_id():
+    """Get the id of the CDN endpoint whose origin is the bucket, cached for CDN_ENDPOINT_CACHE_TTL seconds."""
+    global _endpoint
+    async with _endpoint_lock:
+        if _endpoint is not None and _endpoint[0] > time.monotonic():
+            return _endpoint[1]
+
+        origin = get_origin()
+        endpoint_id = None
+        # Follow the pages until the endpoint is found, the next page link is an absolute URL
+        url, params = '/cdn/endpoints', {'per_page': 200}
+        while endpoint_id is None and url is not None:
+            response = await ratelimit.send_request(
+                cdn_limiter, lambda: get_http_client().get(url, params=params))
+            response.raise_for_status()
+            data = response.json()
+            endpoints = [endpoint for endpoint in data.get('endpoints', []) if endpoint['origin'] == origin]
+            if len(endpoints) > 0:
+                endpoint_id = endpoints[0]['id']
+            url, params = (data.get('links') or {}).get('pages', {}).get('next'), None
+        if endpoint_id is None:
+            raise CDNError('No endpoints found.')
+
+        logger.info(f'CDN endpoint of {origin} is {endpoint_id}')
+        _endpoint = (time.monotonic() + CDN_ENDPOINT_CACHE_TTL, endpoint_id)
+        return endpoint_id
+
+
+def coalesce_paths(paths):
+    """Deduplicate paths and drop the ones already covered by a wildcard, e.g. images/* covers images/a.png.
+
+    :return: Sorted list of paths
+    """
+    paths = {file_name.strip().lstrip('/') for file_name in paths if file_name.strip()}
+    prefixes = [file_name[:-1] for file_name in paths if file_name.endswith('*')]
+    coalesced = []
+    for file_name in paths:
+        covered = any(file_name != prefix + '*' and file_name.startswith(prefix) for prefix in prefixes)
+        if not covered:
+            coalesced.append(file_name)
+    return sorted(coalesced)
+
+
+async def purge(paths):
+    """Purge paths from the edge caches, with as few requests as possible.
+
+    Paths may end with a * wildcard to purge everything under a prefix.
+
+    :return: List of the purged paths, after coalescing
+    """
+    if not is_available():
+        raise CDNError('Service is not available.')
+
+    paths = coalesce_paths(paths)
+    if not paths:
+        return paths
+    endpoint_id = await get_endpoint_id()
+    for i in range(0, len(paths), CDN_PURGE_BATCH_SIZE):
+        batch = paths[i:i + CDN_PURGE_BATCH_SIZE]
+        response = await ratelimit.send_request(cdn_limiter, lambda: get_http_client().request(
+            'DELETE', f'/cdn/endpoints/{endpoint_id}/cache', json={'files': batch}))
+        response.raise_for_status()
+    return paths
+
+
+class PurgeQueue:
+    """Background queue purging the paths changed by the bot.
+
+    Paths are deduplicated and collected for a debounce window after the first one arrives, then
+    purged with as few requests as possible. Failed purges are retried with exponential backoff.
+    """
+
+    def __init__(self, debounce, max_retries):
+        self.debounce = debounce
+        self.max_retries = max_retries
+        self._paths = set()
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    @property
+    def running(self):
+        return self._task is not None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the queue, purging the paths still waiting."""
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        if self._paths:
+            await self._flush()
+
+    def enqueue(self, paths):
+        """Schedule paths for purging. Does nothing unless the queue is running."""
+        if self._task is None:
+            return
+        self._paths.update(paths)
+        self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            await asyncio.sleep(self.debounce)
+            self._wakeup.clear()
+            await self._flush()
+
+    async def _flush(self):
+        paths, self._paths = self._paths, set()
+        try:
+            for attempt in range(self.max_retries + 1):
+                try:
+                    purged = await purge(paths)
+                    logger.info(f'Purged {len(purged)} paths from the edge caches')
+                    return
+                except Exception as e:
+                    if attempt == self.max_retries:
+                        logger.error(f'Giving up purging {len(paths)} paths: {e}')
+                        return
+                    delay = ratelimit.backoff_delay(attempt, base=1)
+                    if isinstance(e, httpx.HTTPStatusError):
+                        delay = max(delay, ratelimit.parse_retry_after(e.response.headers.get('Retry-After')) or 0)
+                    logger.warning(f'Purging {len(paths)} paths failed, retrying in {delay:.1f}s: {e}')
+                    await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            # Put the paths back, also when cancelled during a backoff, so that stop() still purges them
+            self._paths.update(paths)
+            raise
+
+
+purge_queue = PurgeQueue(CDN_PURGE_DEBOUNCE, CDN_PURGE_MAX_RETRIES)
@@ -0,0 +1,65 @@
+"""Command line interface, for what is better done from a shell than from a chat.
+
+Usage: python -m s3_bucket_bot sync ./public site/ --delete
+"""
+import sys
+import time
+import asyncio
+import logging
+import argparse
+
+from . import aio
+from .sync import sync_path, SYNC_CONCURRENCY
+from .transfer import DEFAULT_SETTINGS, close_http_client, format_size
+
+
+async def run_sync(args):
+    settings = DEFAULT_SETTINGS.with_options({'part-size': args.part_size}) if args.part_size else DEFAULT_SETTINGS
+    start = time.monotonic()
+    try:
+        report = await sync_path(args.source, args.prefix, delete=args.delete, checksum=args.checksum,
+                                 exclude=args.exclude, acl=args.acl, dry_run=args.dry_run, settings=settings,
+                                 concurrency=args.concurrency)
+    finally:
+        await close_http_client()
+        aio.shutdown()
+
+    action = 'Would upload' if args.dry_run else 'Uploaded'
+    if args.verbose or args.dry_run:
+        for name in sorted(report.uploaded):
+            print(f'{action} {name}')
+        for name in report.deleted:
+            print(f'{"Would delete" if args.dry_run else "Deleted"} {name}')
+    for name, error in report.failed:
+        print(f'Failed {name}: {error}', file=sys.stderr)
+    print(f'{report} ({format_size(report.bytes_uploaded)}) in {time.monotonic() - start:.1f}s')
+    return 1 if report.failed else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m s3_bucket_bot', description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    sync = commands.add_parser('sync', help='Mirror a directory or a zip/tar archive to a prefix of the bucket')
+    sync.add_argument('source', help='Directory or archive to upload')
+    sync.add_argument('prefix', help='Key prefix to mirror it to, e.g. site/')
+    sync.add_argument('--delete', action='store_true', help='Delete the objects under the prefix missing from the source')
+    sync.add_argument('--checksum', action='store_true',
+                      help='Compare files by ETag instead of modification time (always done for archives)')
+    sync.add_argument('--exclude', action='append', default=[], metavar='PATTERN',
+                      help='Glob pattern of relative paths to skip, can be repeated')
+    sync.add_argument('--acl', choices=('public-read', 'private'), default='public-read')
+    sync.add_argument('--concurrency', type=int, default=SYNC_CONCURRENCY, help='Files uploaded at the same time')
+    sync.add_argument('--part-size', help='Multipart upload part size, e.g. 64M')
+    sync.add_argument('--dry-run', action='store_true', help='Only show what would be done')
+    sync.add_argument('-v', '--verbose', action='store_true', help='List the uploaded and deleted files')
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                        level=logging.INFO if args.verbose else logging.WARNING)
+    if args.command == 'sync':
+        return asyncio.run(run_sync(args))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
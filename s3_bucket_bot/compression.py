@@ -0,0 +1,157 @@
+"""Precompressed variants of text uploads, stored next to them with a Content-Encoding header.
+
+S3 serves objects as they are stored, without looking at Accept-Encoding, so the original is kept
+as is for every client, and app.js gets app.js.gz and app.js.br siblings for the clients, CDNs and
+servers that negotiate the encoding themselves. brotli requires the optional brotli package.
+"""
+import os
+import zlib
+import logging
+
+from . import aio
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+GZIP = 'gzip'
+BROTLI = 'br'
+
+# Key suffixes of the variants
+SUFFIXES = {GZIP: '.gz', BROTLI: '.br'}
+
+GZIP_LEVEL = int(os.getenv('GZIP_LEVEL') or 9)
+# 11 compresses best but is an order of magnitude slower
+BROTLI_QUALITY = int(os.getenv('BROTLI_QUALITY') or 9)
+# Smaller files are not worth compressing
+COMPRESS_MIN_SIZE = int(os.getenv('COMPRESS_MIN_SIZE') or 1024)
+
+COMPRESSIBLE_MIME_TYPES = (
+    'application/javascript', 'application/json', 'application/xml', 'application/wasm',
+    'application/x-javascript', 'application/ld+json', 'application/manifest+json', 'application/rss+xml',
+    'application/atom+xml', 'application/x-ndjson', 'image/svg+xml', 'image/x-icon', 'image/bmp',
+    'font/ttf', 'font/otf', 'application/vnd.ms-fontobject',
+)
+
+
+def parse_encoding(value):
+    """Parse a compression option: gzip, br, or off/none/0 to disable.
+
+    :return: Content-Encoding, or None
+    :raises ValueError: On unknown encodings, or br without the brotli package
+    """
+    value = (value or '').strip().lower()
+    if value in ('', 'off', 'none', '0'):
+        return None
+    if value in ('gzip', 'gz'):
+        return GZIP
+    if value in ('br', 'brotli'):
+        if brotli is None:
+            raise ValueError('Brotli compression requires the brotli package')
+        return BROTLI
+    raise ValueError(f'Unknown compression: {value}')
+
+
+def parse_encodings(value):
+    """Parse a list of compression options, e.g. gzip,br.
+
+    :return: Tuple of Content-Encodings, empty to disable compression
+    :raises ValueError: On unknown encodings, or br without the brotli package
+    """
+    encodings = []
+    for part in (value or '').split(','):
+        encoding = parse_encoding(part)
+        if encoding is not None and encoding not in encodings:
+            encodings.append(encoding)
+    return tuple(encodings)
+
+
+def default_encodings():
+    """Encodings from COMPRESS_UPLOADS, without brotli if it is not installed."""
+    value = os.getenv('COMPRESS_UPLOADS') or ''
+    encodings = []
+    for part in value.split(','):
+        try:
+            encoding = parse_encoding(part)
+        except ValueError as e:
+            if part.strip().lower() not in ('br', 'brotli'):
+                raise
+            logger.warning(f'{e}, skipping brotli variants')
+            continue
+        if encoding is not None and encoding not in encodings:
+            encodings.append(encoding)
+    return tuple(encodings)
+
+
+def variant_key(object_name, encoding):
+    """Key of the variant of an object compressed with an encoding, e.g. app.js.gz."""
+    return object_name + SUFFIXES[encoding]
+
+
+def is_compressible(mime_type):
+    mime_type = (mime_type or '').split(';')[0].strip().lower()
+    return mime_type.startswith('text/') or mime_type.endswith(('+json', '+xml')) \
+        or mime_type in COMPRESSIBLE_MIME_TYPES
+
+
+def choose_encodings(encodings, mime_type, size=None):
+    """Encodings of the variants to store next to an upload.
+
+    :param encodings: Requested encodings, see parse_encodings()
+    :param size: Size of the upload if known
+    :return: Tuple of Content-Encodings, empty for none
+    """
+    if not encodings or not is_compressible(mime_type):
+        return ()
+    if size is not None and size < COMPRESS_MIN_SIZE:
+        return ()
+    return tuple(encodings)
+
+
+class Compressor:
+    """Incremental compressor for one encoding."""
+
+    def __init__(self, encoding):
+        if encoding == BROTLI:
+            compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+            self.compress, self.finish = compressor.process, compressor.finish
+        else:
+            # wbits 31 writes a gzip header and trailer, with a zero timestamp so the output is deterministic
+            compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+            self.compress, self.finish = compressor.compress, compressor.flush
+
+
+class Compressors:
+    """Compress data for several encodings at once, keeping the compressed data in memory."""
+
+    def __init__(self, encodings):
+        self.compressors = {encoding: Compressor(encoding) for encoding in encodings}
+        self.chunks = {encoding: [] for encoding in encodings}
+
+    def compress(self, chunk):
+        for encoding, compressor in self.compressors.items():
+            self.chunks[encoding].append(compressor.compress(chunk))
+
+    def finish(self):
+        """:return: Compressed data by encoding"""
+        for encoding, compressor in self.compressors.items():
+            self.chunks[encoding].append(compressor.finish())
+        return {encoding: b''.join(chunks) for encoding, chunks in self.chunks.items()}
+
+
+async def compress_stream(chunks, encoding, progress=None):
+    """Compress an async stream of bytes as it is read, in the bulk executor.
+
+    :param progress: Optional callable receiving the number of bytes read from the source
+    """
+    compressor = Compressor(encoding)
+    async for chunk in chunks:
+        if progress is not None:
+            progress(len(chunk))
+        compressed = await aio.run(aio.BULK, compressor.compress, chunk)
+        if compressed:
+            yield compressed
+    yield compressor.finish()
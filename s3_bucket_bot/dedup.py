@@ -0,0 +1,89 @@
+"""Persistent index of uploaded Telegram files, to skip redundant uploads.
+
+Telegram gives every file a file_unique_id that stays the same when the file is sent again. The
+index maps it to the S3 objects it was uploaded to, with their ETag and size, so that a repeated
+upload can be answered from the index or turned into a server-side copy.
+
+Files are also indexed by the SHA-256 of their content, so that a local file (with a local Bot API
+server) matches an object uploaded from another Telegram file with the same content.
+"""
+import os
+import time
+import hashlib
+import sqlite3
+import threading
+
+from .transfer import STATE_PATH
+
+DEDUP_ENABLED = (os.getenv('DEDUP_ENABLED') or '0') == '1'
+DEDUP_INDEX_PATH = os.getenv('DEDUP_INDEX_PATH') or os.path.join(STATE_PATH, 'dedup.sqlite3')
+
+
+def hash_file(file_path, chunk_size=1024 * 1024):
+    """SHA-256 of the content of a local file, as stored in the index."""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class DedupIndex:
+    """SQLite-backed map of file_unique_id and content hash to S3 objects."""
+
+    def __init__(self, path=DEDUP_INDEX_PATH):
+        self.path = path
+        self._connection = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._connection is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.row_factory = sqlite3.Row
+            self._connection.executescript('''
+                CREATE TABLE IF NOT EXISTS uploads (
+                    file_unique_id TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    etag TEXT,
+                    size INTEGER,
+                    content_hash TEXT,
+                    uploaded_at REAL NOT NULL,
+                    PRIMARY KEY (file_unique_id, key)
+                );
+                CREATE INDEX IF NOT EXISTS uploads_content_hash ON uploads (content_hash);
+            ''')
+        return self._connection
+
+    def lookup(self, file_unique_id=None, content_hash=None):
+        """Find the objects a file was uploaded to, most recent first.
+
+        :return: List of dicts with file_unique_id, key, etag, size and content_hash
+        """
+        with self._lock:
+            connection = self._connect()
+            if file_unique_id is not None:
+                rows = connection.execute('SELECT * FROM uploads WHERE file_unique_id = ? ORDER BY uploaded_at DESC',
+                                          (file_unique_id,))
+            else:
+                rows = connection.execute('SELECT * FROM uploads WHERE content_hash = ? ORDER BY uploaded_at DESC',
+                                          (content_hash,))
+            return [dict(row) for row in rows]
+
+    def record(self, file_unique_id, key, etag, size, content_hash=None):
+        with self._lock, self._connect() as connection:
+            connection.execute('INSERT OR REPLACE INTO uploads VALUES (?, ?, ?, ?, ?, ?)',
+                               (file_unique_id, key, etag, size, content_hash, time.time()))
+
+    def forget(self, file_unique_id, key):
+        with self._lock, self._connect() as connection:
+            connection.execute('DELETE FROM uploads WHERE file_unique_id = ? AND key = ?', (file_unique_id, key))
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+
+dedup_index = DedupIndex()
@@ -0,0 +1,238 @@
+"""Minimal HTTP/1.1 server on asyncio streams, for the webhook and health endpoints.
+
+It only supports what the bot needs: requests with a Content-Length body, keep-alive connections
+and exact path routing. TLS is usually terminated by a reverse proxy or load balancer in front of
+the bot, but can be enabled with HTTP_TLS_CERT and HTTP_TLS_KEY.
+
+The webhook server of python-telegram-bot requires tornado and only serves the webhook; this one
+has no dependencies and also serves /metrics in polling mode and in the workers.
+"""
+import os
+import ssl
+import json
+import asyncio
+import logging
+from http import HTTPStatus
+from urllib.parse import urlsplit, parse_qs
+
+logger = logging.getLogger(__name__)
+
+HTTP_HOST = os.getenv('HTTP_HOST') or '0.0.0.0'
+# The server is started in webhook mode, or in polling mode when a port is configured
+HTTP_PORT = int(os.getenv('HTTP_PORT') or 0)
+HTTP_DEFAULT_PORT = 8080
+HTTP_TLS_CERT = os.getenv('HTTP_TLS_CERT')
+HTTP_TLS_KEY = os.getenv('HTTP_TLS_KEY')
+# Requests larger than this are rejected, Telegram updates are a few kilobytes at most
+HTTP_MAX_BODY_SIZE = int(os.getenv('HTTP_MAX_BODY_SIZE') or 1024 * 1024)
+# Idle keep-alive connections are closed after this many seconds
+HTTP_KEEPALIVE_TIMEOUT = float(os.getenv('HTTP_KEEPALIVE_TIMEOUT') or 75)
+# Clients have this many seconds to send the headers and body of a request once its first line arrived
+HTTP_REQUEST_TIMEOUT = float(os.getenv('HTTP_REQUEST_TIMEOUT') or 10)
+
+MAX_HEADER_COUNT = 100
+# Longer request and header lines are rejected
+MAX_LINE_LENGTH = 8192
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message=None):
+        super().__init__(message or status.phrase)
+        self.status = status
+
+
+class Request:
+    def __init__(self, method, target, version, headers, body, peer):
+        url = urlsplit(target)
+        self.method = method
+        self.path = url.path
+        self.query = parse_qs(url.query)
+        self.version = version
+        self.headers = headers
+        self.body = body
+        self.peer = peer
+
+    @property
+    def client(self):
+        """Address of the client, as reported by the proxy in front of the server if there is one."""
+        forwarded_for = self.headers.get('x-forwarded-for')
+        if forwarded_for:
+            return forwarded_for.split(',')[0].strip()
+        return self.peer[0] if self.peer else None
+
+    @property
+    def scheme(self):
+        """Scheme the client used, which is https behind a TLS-terminating proxy."""
+        return self.headers.get('x-forwarded-proto', 'http')
+
+    @property
+    def keep_alive(self):
+        connection = self.headers.get('connection', '').lower()
+        if self.version == 'HTTP/1.0':
+            return connection == 'keep-alive'
+        return connection != 'close'
+
+    def json(self):
+        try:
+            return json.loads(self.body)
+        except ValueError as e:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, f'Invalid JSON: {e}')
+
+
+class Response:
+    def __init__(self, body=b'', status=HTTPStatus.OK, content_type='text/plain; charset=utf-8', headers=None):
+        if isinstance(body, str):
+            body = body.encode()
+        self.body = body
+        self.status = status
+        self.content_type = content_type
+        self.headers = headers or {}
+
+    @classmethod
+    def json(cls, data, status=HTTPStatus.OK):
+        return cls(json.dumps(data), status, 'application/json')
+
+
+class HTTPServer:
+    """Route requests by method and exact path to async handlers returning a Response."""
+
+    def __init__(self, host=HTTP_HOST, port=HTTP_PORT or HTTP_DEFAULT_PORT):
+        self.host = host
+        self.port = port
+        self.routes = {}
+        self._server = None
+        # Writers of the open connections, by their handler task
+        self._connections = {}
+
+    def route(self, method, path, handler):
+        self.routes[(method, path)] = handler
+
+    def get_ssl_context(self):
+        if not HTTP_TLS_CERT:
+            return None
+        context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        context.load_cert_chain(HTTP_TLS_CERT, HTTP_TLS_KEY)
+        return context
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port,
+                                                  ssl=self.get_ssl_context(), reuse_address=True,
+                                                  limit=MAX_LINE_LENGTH)
+        logger.info(f'Listening on {self.host}:{self.port}')
+
+    async def stop(self):
+        if self._server is None:
+            return
+        self._server.close()
+        # Idle keep-alive connections would otherwise hold up wait_closed(). Closing them ends their
+        # handlers, cancelling the handlers would make asyncio log their CancelledError.
+        for writer in list(self._connections.values()):
+            writer.close()
+        await asyncio.gather(*self._connections, return_exceptions=True)
+        await self._server.wait_closed()
+        self._server = None
+
+    @staticmethod
+    async def _read_line(reader, status):
+        """Read a line of at most MAX_LINE_LENGTH bytes.
+
+        :param status: Error status of longer lines
+        """
+        try:
+            return await reader.readline()
+        except ValueError:
+            raise HTTPError(status)
+
+    async def _read_request(self, reader, peer):
+        request_line = await asyncio.wait_for(self._read_line(reader, HTTPStatus.REQUEST_URI_TOO_LONG),
+                                              HTTP_KEEPALIVE_TIMEOUT)
+        if not request_line:
+            return None
+        try:
+            method, target, version = request_line.decode('latin-1').split()
+        except ValueError:
+            raise HTTPError(HTTPStatus.BAD_REQUEST)
+        # One deadline for the rest of the request, so that slow clients cannot hold a connection forever
+        headers, body = await asyncio.wait_for(self._read_headers_and_body(reader), HTTP_REQUEST_TIMEOUT)
+        return Request(method, target, version, headers, body, peer)
+
+    async def _read_headers_and_body(self, reader):
+        headers = {}
+        while True:
+            line = await self._read_line(reader, HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE)
+            if line in (b'\r\n', b'\n', b''):
+                break
+            if len(headers) >= MAX_HEADER_COUNT:
+                raise HTTPError(HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE)
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        if 'chunked' in headers.get('transfer-encoding', '').lower():
+            raise HTTPError(HTTPStatus.LENGTH_REQUIRED)
+        try:
+            length = int(headers.get('content-length') or 0)
+        except ValueError:
+            raise HTTPError(HTTPStatus.BAD_REQUEST)
+        if length > HTTP_MAX_BODY_SIZE:
+            raise HTTPError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+        body = await reader.readexactly(length) if length else b''
+        return headers, body
+
+    async def _dispatch(self, request):
+        handler = self.routes.get((request.method, request.path))
+        if handler is None:
+            if any(path == request.path for _, path in self.routes):
+                raise HTTPError(HTTPStatus.METHOD_NOT_ALLOWED)
+            raise HTTPError(HTTPStatus.NOT_FOUND)
+        return await handler(request)
+
+    @staticmethod
+    def _write_response(writer, response, keep_alive):
+        status = HTTPStatus(response.status)
+        head = [f'HTTP/1.1 {status.value} {status.phrase}',
+                f'Content-Type: {response.content_type}',
+                f'Content-Length: {len(response.body)}',
+                f'Connection: {"keep-alive" if keep_alive else "close"}']
+        head.extend(f'{name}: {value}' for name, value in response.headers.items())
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + response.body)
+
+    async def _handle_connection(self, reader, writer):
+        task = asyncio.current_task()
+        self._connections[task] = writer
+        peer = writer.get_extra_info('peername')
+        try:
+            while True:
+                try:
+                    request = await self._read_request(reader, peer)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                    break
+                except (HTTPError, asyncio.LimitOverrunError, ValueError) as e:
+                    status = e.status if isinstance(e, HTTPError) else HTTPStatus.BAD_REQUEST
+                    self._write_response(writer, Response(status.phrase, status), keep_alive=False)
+                    await writer.drain()
+                    break
+                if request is None:
+                    break
+
+                try:
+                    response = await self._dispatch(request)
+                except HTTPError as e:
+                    response = Response(str(e), e.status)
+                except Exception as e:
+                    logger.exception(f'{request.method} {request.path} failed: {e}')
+                    response = Response(HTTPStatus.INTERNAL_SERVER_ERROR.phrase, HTTPStatus.INTERNAL_SERVER_ERROR)
+                logger.debug(f'{request.client} {request.method} {request.path} {response.status}')
+
+                self._write_response(writer, response, request.keep_alive)
+                await writer.drain()
+                if not request.keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            self._connections.pop(task, None)
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except (ConnectionError, ssl.SSLError):
+                pass
@@ -0,0 +1,167 @@
+"""Resized and recompressed variants of uploaded images.
+
+Every variant in IMAGE_VARIANTS is rendered in a process pool, so that decoding and encoding
+(AVIF in particular) neither blocks the event loop nor is serialized by the GIL, and uploaded
+next to the original: 'photos/cat.jpg' gets e.g. 'photos/cat.thumb.webp'.
+
+Requires Pillow (AVIF needs Pillow 11.2 or later), the stage is skipped without it.
+"""
+import io
+import os
+import time
+import asyncio
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from posixpath import splitext
+
+from . import aio, metrics, s3bucket, tracing
+from .transfer import parse_size
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = ImageOps = None
+
+logger = logging.getLogger(__name__)
+
+# Comma-separated name:size:format[:quality] variants, size being the maximum width and height,
+# e.g. thumb:320:webp,medium:1280:webp,large:2048:avif
+IMAGE_VARIANTS = os.getenv('IMAGE_VARIANTS') or ''
+IMAGE_QUALITY = int(os.getenv('IMAGE_QUALITY') or 80)
+# Processes rendering variants
+IMAGE_WORKERS = int(os.getenv('IMAGE_WORKERS') or os.cpu_count() or 1)
+# Larger images are uploaded without variants
+IMAGE_MAX_SIZE = parse_size(os.getenv('IMAGE_MAX_SIZE') or '50M')
+
+# Types of the images that get variants
+SOURCE_MIME_TYPES = ('image/jpeg', 'image/png', 'image/webp', 'image/tiff', 'image/bmp')
+
+# Pillow format, MIME type and extension by format name
+_FORMATS = {
+    'webp': ('WEBP', 'image/webp', 'webp'),
+    'avif': ('AVIF', 'image/avif', 'avif'),
+    'jpeg': ('JPEG', 'image/jpeg', 'jpg'),
+    'jpg': ('JPEG', 'image/jpeg', 'jpg'),
+    'png': ('PNG', 'image/png', 'png'),
+}
+
+
+class Variant:
+    def __init__(self, name, size, format_name, quality=IMAGE_QUALITY):
+        if format_name not in _FORMATS:
+            raise ValueError(f'Unknown image format: {format_name}')
+        self.name = name
+        self.size = size
+        self.format, self.mime_type, self.extension = _FORMATS[format_name]
+        self.quality = quality
+
+    def key(self, file_name):
+        """Key of the variant of an object, next to it."""
+        return f'{splitext(file_name)[0]}.{self.name}.{self.extension}'
+
+
+def parse_variants(value):
+    """Parse IMAGE_VARIANTS, e.g. 'thumb:320:webp,large:2048:avif:60'."""
+    variants = []
+    for item in filter(None, (item.strip() for item in value.split(','))):
+        fields = item.split(':')
+        if len(fields) not in (3, 4) or not fields[1].isdigit() or (len(fields) == 4 and not fields[3].isdigit()):
+            raise ValueError(f'Invalid image variant: {item}')
+        variants.append(Variant(fields[0], int(fields[1]), fields[2].lower(), *map(int, fields[3:])))
+    return variants
+
+
+def _supported(variant):
+    Image.init()
+    if variant.format in Image.SAVE:
+        return True
+    logger.warning(f'Pillow cannot write {variant.format}, skipping the {variant.name} image variant')
+    return False
+
+
+VARIANTS = parse_variants(IMAGE_VARIANTS)
+if VARIANTS and Image is None:
+    logger.warning('IMAGE_VARIANTS is set but Pillow is not installed, images are uploaded without variants')
+    VARIANTS = []
+VARIANTS = [variant for variant in VARIANTS if _supported(variant)]
+
+
+def is_enabled():
+    return bool(VARIANTS)
+
+
+def wants_variants(mime_type, size):
+    """Whether variants are rendered for an upload."""
+    return is_enabled() and mime_type in SOURCE_MIME_TYPES and (size or 0) <= IMAGE_MAX_SIZE
+
+
+def render(source, size, image_format, quality):
+    """Resize an image to fit in size x size pixels, never enlarging it, and encode it.
+
+    Runs in the process pool. EXIF orientation is applied and metadata is not copied.
+
+    :param source: Image data, or path of a local file
+    :return: Encoded image
+    """
+    with Image.open(io.BytesIO(source) if isinstance(source, bytes) else source) as image:
+        # JPEG files are decoded at the smallest scale still larger than the variant, much faster
+        image.draft('RGB', (size, size))
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((size, size), Image.Resampling.LANCZOS)
+        if image_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        elif image.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+            image = image.convert('RGBA' if image.has_transparency_data else 'RGB')
+        output = io.BytesIO()
+        image.save(output, format=image_format, quality=quality, optimize=image_format in ('JPEG', 'PNG'))
+        return output.getvalue()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Get the process pool, created lazily."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # Forking a process running threads is unsafe
+            _pool = ProcessPoolExecutor(max_workers=IMAGE_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+        return _pool
+
+
+def shutdown():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+
+
+async def create_variants(file_name, source):
+    """Render the variants of an uploaded image and upload them concurrently, public like the original.
+
+    :param file_name: Key of the original
+    :param source: Image data, or path of a local file
+    :return: List of (key, error) tuples, error being None for the uploaded variants
+    """
+    loop = asyncio.get_running_loop()
+
+    async def create(variant):
+        key = variant.key(file_name)
+        try:
+            with tracing.span('image.render', **{'image.variant': variant.name, 'image.format': variant.format}):
+                start = time.monotonic()
+                data = await loop.run_in_executor(get_pool(), render, source, variant.size, variant.format,
+                                                  variant.quality)
+                metrics.IMAGE_RENDER_DURATION.observe(time.monotonic() - start, format=variant.format)
+            await aio.run(aio.BULK, s3bucket.put_object, key, data, variant.mime_type, 'public-read')
+            return key, None
+        except Exception as e:
+            logger.error(f'Cannot create {key}: {e}')
+            return key, str(e)
+
+    return await asyncio.gather(*(create(variant) for variant in VARIANTS))
@@ -0,0 +1,257 @@
+"""Local index of the bucket listing, answering /find and /du without listing the bucket.
+
+The whole bucket is listed page by page every INVENTORY_SYNC_INTERVAL seconds, and objects that
+were not seen by a listing are dropped from the index afterwards. Between listings, the writes and
+deletes made through s3bucket, by the bot and by its workers, are applied within seconds: deletes
+right away, writes once a head_object request has fetched their size and ETag.
+
+The index is a SQLite database in STATE_PATH, shared with the worker processes.
+"""
+import os
+import time
+import sqlite3
+import asyncio
+import logging
+import threading
+from datetime import datetime, timezone
+
+from . import aio, s3bucket
+from .transfer import STATE_PATH
+
+logger = logging.getLogger(__name__)
+
+INVENTORY_ENABLED = (os.getenv('INVENTORY_ENABLED') or '0') == '1'
+INVENTORY_PATH = os.getenv('INVENTORY_PATH') or os.path.join(STATE_PATH, 'inventory.sqlite3')
+# Seconds between two listings of the whole bucket
+INVENTORY_SYNC_INTERVAL = float(os.getenv('INVENTORY_SYNC_INTERVAL') or 3600)
+# Seconds between two checks of the objects written by the bot
+INVENTORY_REFRESH_INTERVAL = float(os.getenv('INVENTORY_REFRESH_INTERVAL') or 5)
+# Written objects checked at the same time
+INVENTORY_REFRESH_CONCURRENCY = 8
+
+
+def _prefix_range(prefix):
+    """Bounds of the keys starting with prefix, for an indexed range scan."""
+    if not prefix:
+        return '', None
+    return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def _glob_prefix(pattern):
+    """Literal part of a glob pattern before its first wildcard."""
+    for i, char in enumerate(pattern):
+        if char in '*?[':
+            return pattern[:i]
+    return pattern
+
+
+class Inventory:
+    """SQLite index of the objects in the bucket."""
+
+    def __init__(self, path=INVENTORY_PATH):
+        self.path = path
+        self._connection = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._connection is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self._connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._connection.row_factory = sqlite3.Row
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            # The index can always be rebuilt from the bucket, no need to sync every commit to disk
+            self._connection.execute('PRAGMA synchronous=NORMAL')
+            self._connection.executescript('''
+                CREATE TABLE IF NOT EXISTS objects (
+                    key TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    last_modified TEXT,
+                    etag TEXT,
+                    synced_at REAL NOT NULL
+                ) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS changed (
+                    key TEXT PRIMARY KEY
+                ) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS state (
+                    name TEXT PRIMARY KEY,
+                    value
+                );
+            ''')
+        return self._connection
+
+    def upsert(self, entries, synced_at=None):
+        """Add or update objects.
+
+        :param entries: Dicts with key, size, last_modified and etag, like s3bucket.list_files_page() returns
+        """
+        synced_at = synced_at or time.time()
+        with self._lock, self._connect() as connection:
+            connection.executemany('INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?)',
+                                   [(entry['key'], entry['size'], entry['last_modified'], entry['etag'], synced_at)
+                                    for entry in entries])
+
+    def remove(self, keys):
+        with self._lock, self._connect() as connection:
+            connection.executemany('DELETE FROM objects WHERE key = ?', [(key,) for key in keys])
+            connection.executemany('DELETE FROM changed WHERE key = ?', [(key,) for key in keys])
+
+    def mark_changed(self, keys, deleted=False):
+        """Apply a write or delete, listener of s3bucket.add_change_listener()."""
+        if deleted:
+            self.remove(keys)
+            return
+        with self._lock, self._connect() as connection:
+            connection.executemany('INSERT OR IGNORE INTO changed VALUES (?)', [(key,) for key in keys])
+
+    def remove_changed(self, key):
+        with self._lock, self._connect() as connection:
+            connection.execute('DELETE FROM changed WHERE key = ?', (key,))
+
+    def changed(self, limit=1000):
+        with self._lock:
+            return [row['key'] for row in self._connect().execute('SELECT key FROM changed LIMIT ?', (limit,))]
+
+    def sweep(self, before):
+        """Drop the objects not seen since the given time, i.e. by the last listing.
+
+        :return: Number of dropped objects
+        """
+        with self._lock, self._connect() as connection:
+            return connection.execute('DELETE FROM objects WHERE synced_at < ?', (before,)).rowcount
+
+    def get_state(self, name, default=None):
+        with self._lock:
+            row = self._connect().execute('SELECT value FROM state WHERE name = ?', (name,)).fetchone()
+        return row['value'] if row is not None else default
+
+    def set_state(self, name, value):
+        with self._lock, self._connect() as connection:
+            connection.execute('INSERT OR REPLACE INTO state VALUES (?, ?)', (name, value))
+
+    def find(self, pattern, limit=50):
+        """Find the keys matching a glob pattern, where * also matches slashes.
+
+        :return: Tuple of up to limit entries sorted by key, and the number of matching keys
+        """
+        low, high = _prefix_range(_glob_prefix(pattern))
+        where = 'key >= ? AND key GLOB ?' if high is None else 'key >= ? AND key < ? AND key GLOB ?'
+        params = (low, pattern) if high is None else (low, high, pattern)
+        with self._lock:
+            connection = self._connect()
+            total = connection.execute(f'SELECT COUNT(*) FROM objects WHERE {where}', params).fetchone()[0]
+            rows = connection.execute(f'SELECT key, size, last_modified FROM objects WHERE {where} ORDER BY key LIMIT ?',
+                                      params + (limit,))
+            return [dict(row) for row in rows], total
+
+    def usage(self, prefix, limit=10):
+        """Count the objects under a prefix and their size, in total and by first path segment after the prefix.
+
+        :return: Tuple of the object count, the total size, and up to limit (segment, count, size) tuples,
+            largest first. The segment of the objects right under the prefix is ''.
+        """
+        low, high = _prefix_range(prefix)
+        where = 'key >= ?' if high is None else 'key >= ? AND key < ?'
+        params = (low,) if high is None else (low, high)
+        start = len(prefix) + 1
+        with self._lock:
+            connection = self._connect()
+            count, size = connection.execute(f'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM objects WHERE {where}',
+                                             params).fetchone()
+            rows = connection.execute(f'''
+                SELECT CASE WHEN instr(substr(key, ?), '/') > 0 THEN substr(key, ?, instr(substr(key, ?), '/'))
+                       ELSE '' END AS segment, COUNT(*), SUM(size) AS size
+                FROM objects WHERE {where} GROUP BY segment ORDER BY size DESC LIMIT ?
+            ''', (start, start, start) + params + (limit,))
+            return count, size, [tuple(row) for row in rows]
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+
+inventory = Inventory()
+
+if INVENTORY_ENABLED:
+    s3bucket.add_change_listener(inventory.mark_changed)
+
+
+def last_sync():
+    """Time the last complete listing finished, None if there was none yet."""
+    return inventory.get_state('last_sync')
+
+
+async def sync():
+    """List the whole bucket into the index, then drop the objects that are gone.
+
+    :return: Number of indexed objects
+    """
+    started = time.time()
+    count = 0
+    token = None
+    while True:
+        entries, token = await aio.run(aio.METADATA, s3bucket.list_files_page, '', 1000, token)
+        await aio.run(aio.METADATA, inventory.upsert, entries)
+        count += len(entries)
+        if token is None:
+            break
+    # Objects written meanwhile were upserted after the start, so they are kept
+    dropped = await aio.run(aio.METADATA, inventory.sweep, started)
+    await aio.run(aio.METADATA, inventory.set_state, 'last_sync', time.time())
+    logger.info(f'Indexed {count} objects in {time.time() - started:.1f}s, dropped {dropped}')
+    return count
+
+
+async def refresh_changed():
+    """Fetch the size and ETag of the objects written since the last check.
+
+    :return: Number of refreshed objects
+    """
+    keys = await aio.run(aio.METADATA, inventory.changed)
+    slots = asyncio.Semaphore(INVENTORY_REFRESH_CONCURRENCY)
+
+    async def refresh(key):
+        async with slots:
+            head = await aio.run(aio.METADATA, s3bucket.head_object, key)
+        if head is None:
+            await aio.run(aio.METADATA, inventory.remove, [key])
+            return
+        last_modified = head['LastModified'].astimezone(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+        await aio.run(aio.METADATA, inventory.upsert, [{
+            'key': key, 'size': head['ContentLength'], 'last_modified': last_modified, 'etag': head.get('ETag'),
+        }])
+        await aio.run(aio.METADATA, inventory.remove_changed, key)
+
+    results = await asyncio.gather(*(refresh(key) for key in keys), return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            logger.error(f'Cannot refresh the inventory: {result}')
+    return len(keys)
+
+
+async def run_sync():
+    """Keep the index up to date until cancelled."""
+    listing = None
+    try:
+        while True:
+            try:
+                # Written objects keep being refreshed while a listing of a large bucket runs
+                if listing is not None and listing.done():
+                    if not listing.cancelled() and listing.exception() is not None:
+                        logger.error(f'Inventory sync failed: {listing.exception()}')
+                    listing = None
+                last = await aio.run(aio.METADATA, last_sync)
+                if listing is None and (last is None or time.time() - last >= INVENTORY_SYNC_INTERVAL):
+                    listing = asyncio.create_task(sync())
+                await refresh_changed()
+            except Exception as e:
+                logger.error(f'Inventory refresh failed: {e}')
+            await asyncio.sleep(INVENTORY_REFRESH_INTERVAL)
+    finally:
+        if listing is not None:
+            listing.cancel()
+
+
+def format_time(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime('%Y-%m-%d %H:%M UTC')
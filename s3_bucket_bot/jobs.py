@@ -0,0 +1,211 @@
+"""Durable queue of transfer jobs, shared by the bot and its worker processes.
+
+With JOB_QUEUE_ENABLED=1 the bot only receives updates and enqueues the uploads, copies, bulk
+deletes and purges they ask for. Any number of worker processes (python -m s3_bucket_bot.worker)
+claim the jobs, run them and store their result, which the bot sends back to the chat.
+
+The queue is a SQLite database in WAL mode, so the bot and the workers have to share STATE_PATH
+on a local file system. A claimed job is leased for JOB_LEASE_TIMEOUT seconds and extended by the
+worker while it runs, so the job of a worker that died is picked up by another one.
+"""
+import os
+import json
+import time
+import sqlite3
+import threading
+
+from .transfer import STATE_PATH
+
+JOB_QUEUE_ENABLED = os.getenv('JOB_QUEUE_ENABLED') == '1'
+JOB_QUEUE_PATH = os.getenv('JOB_QUEUE_PATH') or os.path.join(STATE_PATH, 'jobs.sqlite3')
+JOB_LEASE_TIMEOUT = float(os.getenv('JOB_LEASE_TIMEOUT') or 120)
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS') or 3)
+# How often idle workers look for new jobs, and the bot for results, in seconds
+JOB_POLL_INTERVAL = float(os.getenv('JOB_POLL_INTERVAL') or 1)
+# Finished jobs are kept this many hours after their result was delivered
+JOB_RETENTION = float(os.getenv('JOB_RETENTION') or 24)
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class Job:
+    """A claimed job. Handlers may set progress to a callable returning a status text shown while it runs."""
+
+    def __init__(self, row):
+        self.id = row['id']
+        self.kind = row['kind']
+        self.payload = json.loads(row['payload'])
+        self.chat_id = row['chat_id']
+        self.message_id = row['message_id']
+        self.attempts = row['attempts']
+        self.progress = None
+
+
+class JobQueue:
+    def __init__(self, path=JOB_QUEUE_PATH, lease_timeout=JOB_LEASE_TIMEOUT, max_attempts=JOB_MAX_ATTEMPTS):
+        self.path = path
+        self.lease_timeout = lease_timeout
+        self.max_attempts = max_attempts
+        self._connection = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._connection is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            # Autocommit, transactions that need the write lock up front are opened with BEGIN IMMEDIATE
+            self._connection = sqlite3.connect(self.path, timeout=30, isolation_level=None,
+                                               check_same_thread=False)
+            self._connection.row_factory = sqlite3.Row
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.executescript('''
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    kind TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    chat_id INTEGER,
+                    message_id INTEGER,
+                    status TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    available_at REAL NOT NULL,
+                    lease_until REAL,
+                    worker TEXT,
+                    progress TEXT,
+                    result TEXT,
+                    error TEXT,
+                    delivered INTEGER NOT NULL DEFAULT 0,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, available_at);
+            ''')
+        return self._connection
+
+    def enqueue(self, kind, payload, chat_id=None, message_id=None):
+        """Add a job.
+
+        :param payload: JSON-serializable arguments of the job
+        :param message_id: Message edited with the progress and the result, a new one is sent otherwise
+        :return: Job id
+        """
+        now = time.time()
+        with self._lock:
+            cursor = self._connect().execute(
+                'INSERT INTO jobs (kind, payload, chat_id, message_id, status, available_at, created_at, updated_at)'
+                ' VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (kind, json.dumps(payload), chat_id, message_id, PENDING, now, now, now))
+            return cursor.lastrowid
+
+    def claim(self, worker, kinds=None):
+        """Lease the oldest available job, including running jobs whose lease expired.
+
+        :return: Job, or None if there is none
+        """
+        now = time.time()
+        with self._lock:
+            connection = self._connect()
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                query = ('SELECT * FROM jobs WHERE (status = ? AND available_at <= ?)'
+                         ' OR (status = ? AND lease_until < ?)')
+                params = [PENDING, now, RUNNING, now]
+                if kinds:
+                    query = f'SELECT * FROM ({query}) WHERE kind IN ({", ".join("?" * len(kinds))})'
+                    params.extend(kinds)
+                row = connection.execute(query + ' ORDER BY id LIMIT 1', params).fetchone()
+                if row is None:
+                    connection.execute('COMMIT')
+                    return None
+                connection.execute('UPDATE jobs SET status = ?, attempts = attempts + 1, lease_until = ?, worker = ?,'
+                                   ' updated_at = ? WHERE id = ?',
+                                   (RUNNING, now + self.lease_timeout, worker, now, row['id']))
+                connection.execute('COMMIT')
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+        job = Job(row)
+        job.attempts += 1
+        return job
+
+    def heartbeat(self, job_id, progress=None):
+        """Extend the lease of a running job and store its progress."""
+        now = time.time()
+        with self._lock:
+            self._connect().execute('UPDATE jobs SET lease_until = ?, progress = ?, updated_at = ?'
+                                    ' WHERE id = ? AND status = ?',
+                                    (now + self.lease_timeout, progress, now, job_id, RUNNING))
+
+    def complete(self, job_id, result):
+        now = time.time()
+        with self._lock:
+            self._connect().execute('UPDATE jobs SET status = ?, result = ?, lease_until = NULL, updated_at = ?'
+                                    ' WHERE id = ?', (DONE, json.dumps(result), now, job_id))
+
+    def fail(self, job_id, error, attempts, retry=True):
+        """Record a failed attempt, retrying the job with exponential backoff until JOB_MAX_ATTEMPTS.
+
+        :param retry: Whether the job may succeed when run again, it fails for good otherwise
+        :return: New status of the job
+        """
+        now = time.time()
+        if retry and attempts < self.max_attempts:
+            status, available_at = PENDING, now + 2 ** attempts
+        else:
+            status, available_at = FAILED, now
+        with self._lock:
+            self._connect().execute('UPDATE jobs SET status = ?, error = ?, available_at = ?, lease_until = NULL,'
+                                    ' updated_at = ? WHERE id = ?', (status, str(error), available_at, now, job_id))
+        return status
+
+    def release(self, job_id):
+        """Put a job back in the queue without counting the attempt, e.g. when its worker stops."""
+        now = time.time()
+        with self._lock:
+            self._connect().execute('UPDATE jobs SET status = ?, attempts = attempts - 1, available_at = ?,'
+                                    ' lease_until = NULL, updated_at = ? WHERE id = ? AND status = ?',
+                                    (PENDING, now, now, job_id, RUNNING))
+
+    def running(self):
+        """Jobs being run, with their progress."""
+        with self._lock:
+            rows = self._connect().execute('SELECT id, chat_id, message_id, progress FROM jobs WHERE status = ?',
+                                           (RUNNING,))
+            return [dict(row) for row in rows]
+
+    def finished(self):
+        """Finished jobs whose result was not delivered yet."""
+        with self._lock:
+            rows = self._connect().execute('SELECT * FROM jobs WHERE status IN (?, ?) AND delivered = 0 ORDER BY id',
+                                           (DONE, FAILED))
+            jobs = []
+            for row in rows:
+                job = dict(row)
+                job['result'] = json.loads(job['result']) if job['result'] is not None else None
+                jobs.append(job)
+            return jobs
+
+    def mark_delivered(self, job_id):
+        with self._lock:
+            self._connect().execute('UPDATE jobs SET delivered = 1, updated_at = ? WHERE id = ?',
+                                    (time.time(), job_id))
+
+    def prune(self, max_age=JOB_RETENTION):
+        """Delete delivered jobs older than max_age hours.
+
+        :return: Number of deleted jobs
+        """
+        with self._lock:
+            cursor = self._connect().execute('DELETE FROM jobs WHERE delivered = 1 AND updated_at < ?',
+                                             (time.time() - max_age * 3600,))
+            return cursor.rowcount
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+
+job_queue = JobQueue()
@@ -0,0 +1,328 @@
+"""Process metrics in the Prometheus text exposition format, served at /metrics by the HTTP server.
+
+@see https://prometheus.io/docs/instrumenting/exposition_formats/
+"""
+import os
+import time
+import shutil
+import logging
+import functools
+import threading
+from contextlib import contextmanager
+
+from . import tracing
+from .httpserver import Response
+
+logger = logging.getLogger(__name__)
+
+TEMP_PATH = os.getenv('TEMP_PATH', '/tmp')
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+# Whole transfers and slow commands
+LONG_BUCKETS = (.1, .5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs.extend(f'{name}="{_escape(value)}"' for name, value in extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        with self._lock:
+            metrics = list(self._metrics)
+        for metric in metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                # A broken collector must not hide the other metrics
+                logger.error(f'Cannot collect {metric.name}: {e}')
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'{self.name} expects labels {self.labelnames}, got {tuple(labels)}')
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _header(self):
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+
+    def _samples(self):
+        with self._lock:
+            return list(self._values.items())
+
+    def render(self):
+        lines = self._header()
+        for key, value in self._samples():
+            lines.append(f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}')
+        return lines
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """A value that goes up and down, or is read from a callback when the metrics are collected.
+
+    :param callback: Optional callable returning the value, or a dict of values by label value tuples
+    """
+    type = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY, callback=None):
+        super().__init__(name, documentation, labelnames, registry)
+        self.callback = callback
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def _samples(self):
+        if self.callback is None:
+            return super()._samples()
+        values = self.callback()
+        if not isinstance(values, dict):
+            values = {(): values}
+        return list(values.items())
+
+
+class CallbackCounter(Gauge):
+    """A counter maintained elsewhere, e.g. cache hits, read when the metrics are collected."""
+    type = 'counter'
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0, 0.0]
+            counts = state[0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            state[1] += 1
+            state[2] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def render(self):
+        lines = self._header()
+        with self._lock:
+            samples = [(key, (list(state[0]), state[1], state[2])) for key, state in self._values.items()]
+        for key, (counts, count, total) in samples:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key, [('le', _format_value(float(bound)))])
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f'{self.name}_count{labels} {count}')
+            lines.append(f'{self.name}_sum{labels} {_format_value(total)}')
+        return lines
+
+
+# Telegram handlers
+HANDLER_DURATION = Histogram('s3bot_handler_duration_seconds', 'Time spent handling an update, by handler.',
+                             ['handler'], buckets=LONG_BUCKETS)
+HANDLER_ERRORS = Counter('s3bot_handler_errors_total', 'Updates whose handler raised, by handler.', ['handler'])
+
+# S3 API calls, recorded by botocore event hooks
+S3_REQUESTS = Counter('s3bot_s3_requests_total', 'S3 API calls, by operation.', ['operation'])
+S3_REQUEST_DURATION = Histogram('s3bot_s3_request_duration_seconds',
+                                'S3 API call latency including retries, by operation.', ['operation'])
+S3_ERRORS = Counter('s3bot_s3_errors_total', 'Failed S3 API calls, by operation and error code.',
+                    ['operation', 'code'])
+S3_BYTES_SENT = Counter('s3bot_s3_bytes_sent_total', 'Request body bytes sent to S3, by operation.', ['operation'])
+S3_BYTES_RECEIVED = Counter('s3bot_s3_bytes_received_total', 'Response body bytes received from S3, by operation.',
+                            ['operation'])
+
+# Where the time of an upload goes
+UPLOAD_DURATION = Histogram('s3bot_upload_duration_seconds', 'Time to upload a file, by source.',
+                            ['source'], buckets=LONG_BUCKETS)
+TELEGRAM_DOWNLOAD_WAIT = Histogram('s3bot_telegram_download_wait_seconds',
+                                   'Time an upload spent waiting for data from Telegram.', buckets=LONG_BUCKETS)
+TELEGRAM_DOWNLOAD_BYTES = Counter('s3bot_telegram_download_bytes_total', 'Bytes downloaded from Telegram.')
+DISK_READ_DURATION = Histogram('s3bot_disk_read_seconds', 'Time to read a multipart upload part from disk.')
+DISK_READ_BYTES = Counter('s3bot_disk_read_bytes_total', 'Bytes of local files read for uploads.')
+DEDUPLICATED_UPLOADS = Counter('s3bot_uploads_deduplicated_total',
+                               'Uploads answered from the dedup index, by outcome.', ['outcome'])
+IMAGE_RENDER_DURATION = Histogram('s3bot_image_render_duration_seconds',
+                                  'Time to render an image variant in the process pool, by format.', ['format'])
+
+# Executors of the aio module
+EXECUTOR_QUEUED = Gauge('s3bot_executor_queued', 'Calls waiting for a thread, by executor.', ['executor'])
+EXECUTOR_ACTIVE = Gauge('s3bot_executor_active', 'Calls running in a thread, by executor.', ['executor'])
+
+# Client-side rate limiting, by backend (s3, telegram, cdn)
+RATE_LIMIT_WAIT = Histogram('s3bot_rate_limit_wait_seconds', 'Time calls waited for the rate limiter, by backend.',
+                            ['backend'])
+RATE_LIMIT_THROTTLES = Counter('s3bot_rate_limit_throttled_total', 'Calls refused by the backend for their rate.',
+                               ['backend'])
+RATE_LIMIT_WINDOW = Gauge('s3bot_rate_limit_concurrency', 'Calls allowed at the same time, by backend.', ['backend'])
+
+JOB_DURATION = Histogram('s3bot_job_duration_seconds', 'Time to run a queued job, by kind and outcome.',
+                         ['kind', 'status'], buckets=LONG_BUCKETS)
+
+
+def _disk_usage():
+    usage = shutil.disk_usage(TEMP_PATH)
+    return {('total',): usage.total, ('used',): usage.used, ('free',): usage.free}
+
+
+TEMP_DIR_BYTES = Gauge('s3bot_temp_dir_bytes', 'Size of the file system holding TEMP_PATH, by state.', ['state'],
+                       callback=_disk_usage)
+
+_caches = {}
+
+
+def register_cache(name, cache):
+    """Expose the hit, miss and size counters of a TTLCache."""
+    _caches[name] = cache
+
+
+def _cache_stats(field):
+    return lambda: {(name,): cache.stats()[field] for name, cache in _caches.items()}
+
+
+CACHE_HITS = CallbackCounter('s3bot_cache_hits_total', 'Cache hits, by cache.', ['cache'],
+                             callback=_cache_stats('hits'))
+CACHE_MISSES = CallbackCounter('s3bot_cache_misses_total', 'Cache misses, by cache.', ['cache'],
+                               callback=_cache_stats('misses'))
+CACHE_SIZE = Gauge('s3bot_cache_entries', 'Cached entries, by cache.', ['cache'], callback=_cache_stats('size'))
+
+
+def track_handler(name):
+    """Decorate an update handler to record its duration and errors, and to run it in the root span of a trace."""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(update, *args, **kwargs):
+            start = time.monotonic()
+            chat = getattr(update, 'effective_chat', None)
+            try:
+                with tracing.span(f'handler.{name}', tracing.SPAN_KIND_SERVER, **{
+                    'telegram.update_id': getattr(update, 'update_id', None),
+                    'telegram.chat_id': chat.id if chat is not None else None,
+                }):
+                    return await func(update, *args, **kwargs)
+            except Exception:
+                HANDLER_ERRORS.inc(handler=name)
+                raise
+            finally:
+                HANDLER_DURATION.observe(time.monotonic() - start, handler=name)
+        return wrapper
+    return decorator
+
+
+def _before_call(model, context, **kwargs):
+    context['metrics_start'] = time.monotonic()
+
+
+def _after_call(model, context, http_response=None, parsed=None, **kwargs):
+    operation = model.name
+    S3_REQUESTS.inc(operation=operation)
+    if 'metrics_start' in context:
+        S3_REQUEST_DURATION.observe(time.monotonic() - context['metrics_start'], operation=operation)
+    if http_response is not None:
+        if http_response.status_code >= 400:
+            code = (parsed or {}).get('Error', {}).get('Code') or str(http_response.status_code)
+            S3_ERRORS.inc(operation=operation, code=code)
+        length = http_response.headers.get('content-length')
+        if length and length.isdigit():
+            S3_BYTES_RECEIVED.inc(int(length), operation=operation)
+
+
+def _after_call_error(model, context, exception=None, **kwargs):
+    # Connection errors and timeouts, raised before any response was received
+    operation = model.name
+    S3_REQUESTS.inc(operation=operation)
+    if 'metrics_start' in context:
+        S3_REQUEST_DURATION.observe(time.monotonic() - context['metrics_start'], operation=operation)
+    S3_ERRORS.inc(operation=operation, code=type(exception).__name__)
+
+
+def _before_send(request, event_name, **kwargs):
+    # Fired for every attempt, so retried bodies are counted again, like they are sent again
+    length = request.headers.get('Content-Length')
+    if length:
+        S3_BYTES_SENT.inc(int(length), operation=event_name.rsplit('.', 1)[-1])
+
+
+def instrument_s3_client(client):
+    """Record the calls of a botocore client with event hooks."""
+    events = client.meta.events
+    events.register('before-call.s3', _before_call)
+    events.register('after-call.s3', _after_call)
+    events.register('after-call-error.s3', _after_call_error)
+    events.register('before-send.s3', _before_send)
+    return client
+
+
+async def metrics_endpoint(request):
+    return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
@@ -0,0 +1,239 @@
+"""Client-side rate limiting of the S3, Telegram and DigitalOcean APIs.
+
+Every backend gets a Limiter: a token bucket capping the request rate, and a concurrency window
+adapted AIMD-style like TCP congestion control. Every successful call widens the window by one
+slot per window's worth of calls, a throttled call (S3 503 SlowDown, Telegram RetryAfter, HTTP 429)
+halves it and pauses the backend for its Retry-After, or a jittered exponential backoff. Bulk
+operations then settle at the rate the backend sustains instead of failing.
+
+Limiters are shared by the threads running S3 calls and by coroutines.
+"""
+import os
+import time
+import random
+import asyncio
+import logging
+import threading
+from datetime import timedelta
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# Bounds of the jittered exponential backoff after a throttled call without Retry-After, in seconds
+RATE_LIMIT_BASE_DELAY = float(os.getenv('RATE_LIMIT_BASE_DELAY') or 0.5)
+RATE_LIMIT_MAX_DELAY = float(os.getenv('RATE_LIMIT_MAX_DELAY') or 60)
+
+# Coroutines waiting for a slot check again this often, threads are woken up by releases
+_POLL_INTERVAL = 0.05
+
+# Error codes S3 answers throttled requests with
+S3_THROTTLING_CODES = ('SlowDown', 'Throttling', 'ThrottlingException', 'RequestLimitExceeded',
+                       'TooManyRequests', 'RequestThrottled')
+
+_limiters = {}
+
+
+def backoff_delay(attempt, base=None, cap=None):
+    """Exponential backoff with equal jitter: half of the delay is fixed, the other half random."""
+    base = RATE_LIMIT_BASE_DELAY if base is None else base
+    cap = RATE_LIMIT_MAX_DELAY if cap is None else cap
+    return min(base * 2 ** attempt, cap) * (1 + random.random()) / 2
+
+
+def parse_retry_after(value):
+    """Seconds of a Retry-After header or of a Telegram RetryAfter, None if missing or an HTTP date."""
+    if isinstance(value, timedelta):
+        return value.total_seconds()
+    if isinstance(value, (int, float)):
+        return float(value)
+    if value and value.strip().isdigit():
+        return float(value)
+    return None
+
+
+class Limiter:
+    """Token bucket and AIMD concurrency window of one backend.
+
+    :param name: Backend name, used in logs and metrics
+    :param rate: Sustained requests per second, 0 for unlimited
+    :param burst: Requests allowed at once above the rate, defaults to one second worth of requests
+    :param max_concurrency: Upper bound of the concurrency window, the starting point
+    :param min_concurrency: Lower bound of the concurrency window
+    """
+
+    def __init__(self, name, rate=0, burst=None, max_concurrency=16, min_concurrency=1):
+        self.name = name
+        self.rate = rate
+        self.burst = burst or max(rate, 1)
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.window = float(max_concurrency)
+        self.active = 0
+        # Consecutive throttled calls, the exponent of the backoff
+        self.throttles = 0
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._paused_until = 0
+        self._condition = threading.Condition()
+        _limiters[name] = self
+
+    def _try_acquire(self):
+        """Take a slot and a token if available, with the condition held.
+
+        :return: 0 once acquired, else the seconds to wait before trying again, None to wait for a release
+        """
+        now = time.monotonic()
+        if now < self._paused_until:
+            return self._paused_until - now
+        if self.active >= int(self.window):
+            return None
+        if self.rate:
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens < 1:
+                return (1 - self._tokens) / self.rate
+            self._tokens -= 1
+        self.active += 1
+        return 0
+
+    def acquire(self):
+        """Wait for a slot, blocking the calling thread."""
+        start = time.monotonic()
+        with self._condition:
+            while (delay := self._try_acquire()) != 0:
+                self._condition.wait(delay)
+        metrics.RATE_LIMIT_WAIT.observe(time.monotonic() - start, backend=self.name)
+
+    async def acquire_async(self):
+        """Wait for a slot without blocking the event loop."""
+        start = time.monotonic()
+        while True:
+            with self._condition:
+                delay = self._try_acquire()
+            if delay == 0:
+                break
+            await asyncio.sleep(_POLL_INTERVAL if delay is None else delay)
+        metrics.RATE_LIMIT_WAIT.observe(time.monotonic() - start, backend=self.name)
+
+    def release(self, throttled=False, retry_after=None, failed=False):
+        """Give back a slot, adapting the window to the outcome of the call.
+
+        :param throttled: Whether the backend refused the call for its rate
+        :param retry_after: Seconds the backend asked to wait, if it did
+        :param failed: Whether the call got no answer, the window is then left as it is
+        """
+        with self._condition:
+            self.active -= 1
+            if throttled and not failed:
+                metrics.RATE_LIMIT_THROTTLES.inc(backend=self.name)
+                now = time.monotonic()
+                # Calls in flight when the backend started throttling count as one congestion event
+                if now >= self._paused_until:
+                    self.window = max(float(self.min_concurrency), self.window / 2)
+                    self.throttles += 1
+                delay = retry_after if retry_after is not None else backoff_delay(self.throttles - 1)
+                self._paused_until = max(self._paused_until, now + delay)
+                logger.warning(f'{self.name} is throttling, pausing for {delay:.1f}s '
+                               f'with {int(self.window)} calls at a time')
+            elif not failed:
+                # A call that got no answer says nothing about the rate the backend sustains
+                self.throttles = 0
+                self.window = min(float(self.max_concurrency), self.window + 1 / self.window)
+            self._condition.notify_all()
+
+
+metrics.RATE_LIMIT_WINDOW.callback = lambda: {(name,): int(limiter.window) for name, limiter in _limiters.items()}
+
+
+def _is_s3_throttled(response):
+    if response is None:
+        return False
+    http_response, parsed = response
+    code = (parsed or {}).get('Error', {}).get('Code')
+    return http_response.status_code in (429, 503) or code in S3_THROTTLING_CODES
+
+
+def instrument_s3_client(client, limiter):
+    """Route every attempt of the calls of a botocore client through a limiter.
+
+    botocore still retries throttled calls itself, each attempt waits for the limiter.
+    """
+    def before_send(request, **kwargs):
+        limiter.acquire()
+        request.context['ratelimit_acquired'] = True
+
+    def needs_retry(request_dict, response=None, **kwargs):
+        # Fired after every attempt, whether it got a response or raised
+        if not request_dict['context'].pop('ratelimit_acquired', False):
+            return
+        if response is None:
+            limiter.release(failed=True)
+            return
+        throttled = _is_s3_throttled(response)
+        retry_after = parse_retry_after(response[0].headers.get('Retry-After')) if throttled else None
+        limiter.release(throttled, retry_after)
+
+    events = client.meta.events
+    events.register('before-send.s3', before_send)
+    events.register('needs-retry.s3', needs_retry)
+    return client
+
+
+async def send_request(limiter, send, max_retries=5):
+    """Send an HTTP request through a limiter, retrying 429 and 503 answers.
+
+    :param send: Coroutine function sending the request and returning the httpx response
+    :return: The last response
+    """
+    for attempt in range(max_retries + 1):
+        await limiter.acquire_async()
+        try:
+            response = await send()
+        except BaseException:
+            limiter.release(failed=True)
+            raise
+        throttled = response.status_code in (429, 503)
+        limiter.release(throttled, parse_retry_after(response.headers.get('Retry-After')) if throttled else None)
+        if not throttled:
+            break
+    return response
+
+
+class TelegramRateLimiter(BaseRateLimiter):
+    """Rate limiter of python-telegram-bot sending Bot API requests through a Limiter.
+
+    Requests refused with RetryAfter are sent again after the delay, up to max_retries times.
+    """
+
+    def __init__(self, limiter, max_retries=3):
+        self.limiter = limiter
+        self.max_retries = max_retries
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if endpoint == 'getUpdates':
+            # Long polling waits for updates and sends nothing
+            return await callback(*args, **kwargs)
+        for attempt in range(self.max_retries + 1):
+            await self.limiter.acquire_async()
+            try:
+                result = await callback(*args, **kwargs)
+            except RetryAfter as e:
+                self.limiter.release(True, parse_retry_after(e.retry_after))
+                if attempt == self.max_retries:
+                    raise
+                continue
+            except BaseException:
+                self.limiter.release(failed=True)
+                raise
+            self.limiter.release()
+            return result
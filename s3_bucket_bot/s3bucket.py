@@ -1,7 +1,17 @@
 import os
+import json
+import math
+import fnmatch
+import threading
+import contextvars
 import boto3
 import logging
+from botocore.config import Config
 from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+
+from . import metrics, ratelimit, tracing
+from .cache import TTLCache, MISSING
 
 
 class ACLNotSupportedError(Exception):
@@ -40,24 +50,180 @@ if os.getenv('EDGE_ENDPOINT_URL', '').strip():
 CUSTOM_ENDPOINT_URL = None
 if os.getenv('CUSTOM_ENDPOINT_URL', '').strip():
     CUSTOM_ENDPOINT_URL = os.getenv('CUSTOM_ENDPOINT_URL')
+# Endpoint presigned URLs point to, when clients reach S3 at another address than the bot (defaults to ENDPOINT_URL)
+PRESIGN_ENDPOINT_URL = os.getenv('PRESIGN_ENDPOINT_URL') or ENDPOINT_URL
+# Lifetime of presigned URLs in seconds, SigV4 allows up to 7 days
+PRESIGN_DEFAULT_TTL = int(os.getenv('PRESIGN_DEFAULT_TTL') or 3600)
+PRESIGN_MAX_TTL = 7 * 24 * 3600
+# Cache-Control of uploaded objects: a JSON list of rules with a key prefix and/or a MIME type pattern,
+# the first matching one applies, e.g. [{"prefix": "assets/", "cache_control": "public, max-age=31536000"},
+# {"mime_type": "text/html", "cache_control": "no-cache"}]
+CACHE_CONTROL_RULES = json.loads(os.getenv('CACHE_CONTROL_RULES') or '[]')
+
+
+# Connection pool and retry settings shared by every S3 call in the process
+S3_MAX_POOL_CONNECTIONS = int(os.getenv('S3_MAX_POOL_CONNECTIONS') or 50)
+S3_CONNECT_TIMEOUT = float(os.getenv('S3_CONNECT_TIMEOUT') or 10)
+S3_READ_TIMEOUT = float(os.getenv('S3_READ_TIMEOUT') or 60)
+S3_MAX_ATTEMPTS = int(os.getenv('S3_MAX_ATTEMPTS') or 5)
+S3_RETRY_MODE = os.getenv('S3_RETRY_MODE') or 'standard'
+S3_TCP_KEEPALIVE = (os.getenv('S3_TCP_KEEPALIVE') or '1') == '1'
+# Requests per second sent to S3 by the process, 0 for unlimited. Concurrency starts at S3_MAX_POOL_CONNECTIONS
+# and is halved whenever S3 answers SlowDown.
+S3_RATE_LIMIT = float(os.getenv('S3_RATE_LIMIT') or 0)
+
+# S3 requires every part but the last one to be at least 5MB, and accepts up to 10000 parts of at most 5GB
+MIN_PART_SIZE = 5 * 1024 * 1024
+MAX_PART_SIZE = 5 * 1024 ** 3
+MAX_PARTS = 10000
+
+# Objects larger than this are copied with parallel upload_part_copy requests (single copies are limited to 5GB)
+S3_COPY_MULTIPART_THRESHOLD = int(os.getenv('S3_COPY_MULTIPART_THRESHOLD') or 1024 * 1024 * 1024)
+S3_COPY_PART_SIZE = int(os.getenv('S3_COPY_PART_SIZE') or 256 * 1024 * 1024)
+S3_COPY_CONCURRENCY = int(os.getenv('S3_COPY_CONCURRENCY') or 8)
+
+# Object metadata (head_object) and ACL cache. Every write made through this module updates or
+# invalidates it, changes made by other clients are picked up after METADATA_CACHE_TTL seconds.
+# Missing objects are cached for METADATA_CACHE_MISSING_TTL seconds at most, so that an object uploaded
+# by another client shows up sooner.
+METADATA_CACHE_TTL = float(os.getenv('METADATA_CACHE_TTL') or 60)
+METADATA_CACHE_MISSING_TTL = float(os.getenv('METADATA_CACHE_MISSING_TTL') or 5)
+METADATA_CACHE_SIZE = int(os.getenv('METADATA_CACHE_SIZE') or 10000)
+
+metadata_cache = TTLCache(METADATA_CACHE_TTL, METADATA_CACHE_SIZE)
+metrics.register_cache('metadata', metadata_cache)
+
+s3_limiter = ratelimit.Limiter('s3', S3_RATE_LIMIT, max_concurrency=S3_MAX_POOL_CONNECTIONS)
+
+_session = None
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_s3_config():
+    return Config(region_name=AWS_REGION,
+                  max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+                  connect_timeout=S3_CONNECT_TIMEOUT,
+                  read_timeout=S3_READ_TIMEOUT,
+                  retries={'max_attempts': S3_MAX_ATTEMPTS, 'mode': S3_RETRY_MODE},
+                  tcp_keepalive=S3_TCP_KEEPALIVE)
+
+
+def _get_or_create(name, factory):
+    """Return a process-wide object from the registry, creating it once."""
+    global _session
+    instance = _clients.get(name)
+    if instance is not None:
+        return instance
+    with _clients_lock:
+        instance = _clients.get(name)
+        if instance is None:
+            # A boto3 session is not thread-safe, but clients created from it are
+            # safe to share once built, so build them under the lock.
+            if _session is None:
+                _session = boto3.session.Session(aws_access_key_id=AWS_SERVER_PUBLIC_KEY,
+                                                 aws_secret_access_key=AWS_SERVER_SECRET_KEY,
+                                                 region_name=AWS_REGION)
+            instance = factory(_session)
+            _clients[name] = instance
+    return instance
 
 
 def get_s3_client():
-    session = boto3.session.Session()
-    return session.client('s3',
-                          region_name=AWS_REGION,
-                          endpoint_url=ENDPOINT_URL,
-                          aws_access_key_id=AWS_SERVER_PUBLIC_KEY,
-                          aws_secret_access_key=AWS_SERVER_SECRET_KEY)
+    """Get the shared S3 client, created lazily once per process."""
+    return _get_or_create('client', lambda session: tracing.instrument_s3_client(metrics.instrument_s3_client(
+        ratelimit.instrument_s3_client(session.client('s3', endpoint_url=ENDPOINT_URL, config=get_s3_config()),
+                                       s3_limiter))))
+
+
+def get_presign_client():
+    """Get the shared client signing URLs, created lazily once per process.
+
+    Signing is done locally, the client never sends a request.
+    """
+    return _get_or_create('presign', lambda session: session.client(
+        's3', endpoint_url=PRESIGN_ENDPOINT_URL, config=Config(region_name=AWS_REGION, signature_version='s3v4')))
+
+
+def reset_s3_clients():
+    """Drop the shared clients, e.g. after a fork or a credentials change."""
+    global _session
+    with _clients_lock:
+        _clients.clear()
+        _session = None
+
+
+_change_listeners = []
+
+
+def add_change_listener(listener):
+    """Call listener(keys, deleted) after every write or delete made through this module.
+
+    deleted is True when the objects are known to be gone, False when they may have changed.
+    Listeners run in the calling thread and must be quick.
+    """
+    _change_listeners.append(listener)
+
 
+def _notify(keys, deleted=False):
+    for listener in _change_listeners:
+        try:
+            listener(keys, deleted)
+        except Exception as e:
+            logging.error(f'Change listener failed: {e}')
 
-def upload_file(file_name, object_name=None, mime_type=None, acl=None):
+
+def invalidate(file_name):
+    """Forget the cached metadata and ACL of an object."""
+    metadata_cache.delete(('meta', BUCKET_NAME, file_name))
+    metadata_cache.delete(('acl', BUCKET_NAME, file_name))
+    _notify([file_name])
+
+
+def _forget_deleted(file_names):
+    """Cache that objects are gone."""
+    for file_name in file_names:
+        metadata_cache.set(('meta', BUCKET_NAME, file_name), None, ttl=METADATA_CACHE_MISSING_TTL)
+        metadata_cache.delete(('acl', BUCKET_NAME, file_name))
+    _notify(file_names, deleted=True)
+
+
+def get_cache_control(object_name, mime_type=None):
+    """Cache-Control of an object from CACHE_CONTROL_RULES, None if no rule matches."""
+    for rule in CACHE_CONTROL_RULES:
+        if 'prefix' in rule and not (object_name or '').startswith(rule['prefix']):
+            continue
+        if 'mime_type' in rule and not fnmatch.fnmatchcase(mime_type or '', rule['mime_type']):
+            continue
+        return rule['cache_control']
+    return None
+
+
+def get_extra_args(mime_type=None, acl=None, object_name=None, content_encoding=None):
+    """Build the extra arguments shared by every kind of upload."""
+    extra_args = {}
+    if acl is not None and acl == 'public-read':
+        extra_args['ACL'] = acl
+    if mime_type is not None:
+        extra_args['ContentType'] = mime_type
+    if content_encoding is not None:
+        extra_args['ContentEncoding'] = content_encoding
+    cache_control = get_cache_control(object_name, mime_type)
+    if cache_control is not None:
+        extra_args['CacheControl'] = cache_control
+    return extra_args
+
+
+@tracing.traced('s3bucket.upload_file')
+def upload_file(file_name, object_name=None, mime_type=None, acl=None, config=None, callback=None):
     """Upload a file to an S3 bucket
 
     :param file_name: File to upload
     :param object_name: S3 object name. If not specified then file_name is used
     :param mime_type: File mime type
     :param acl: ACL specifying access rules for the objects (e.g. private or public-read). Defaults to private
+    :param config: boto3 TransferConfig (part size, concurrency, bandwidth). Defaults to boto3 defaults
+    :param callback: Callable receiving the number of bytes transferred since the last call
     :return: True if file was uploaded, else False
     """
 
@@ -66,24 +232,99 @@ def upload_file(file_name, object_name=None, mime_type=None, acl=None):
         object_name = os.path.basename(file_name)
 
     try:
-        extra_args = {}
-        if acl is not None and acl == 'public-read':
-            extra_args['ACL'] = acl
-        if mime_type is not None:
-            extra_args['ContentType'] = mime_type
-
+        extra_args = get_extra_args(mime_type, acl, object_name)
         s3_client = get_s3_client()
+        if tracing.is_enabled():
+            # The requests are made by boto3 transfer threads, outside of the trace
+            size = os.path.getsize(file_name)
+            threshold = config.multipart_threshold if config is not None else 8 * 1024 * 1024
+            chunk_size = config.multipart_chunksize if config is not None else 8 * 1024 * 1024
+            tracing.set_attributes(**{'s3.key': object_name, 'file.size': size,
+                                      'upload.parts': math.ceil(size / chunk_size) if size >= threshold else 1})
         # Upload the file
         s3_client.upload_file(file_name,
                               BUCKET_NAME,
                               object_name,
-                              ExtraArgs=extra_args)
+                              ExtraArgs=extra_args,
+                              Config=config,
+                              Callback=callback)
     except ClientError as e:
         logging.error(e)
         return False
+    finally:
+        invalidate(object_name)
     return True
 
 
+def put_object(object_name, body, mime_type=None, acl=None, content_encoding=None):
+    """Upload a small object from memory in a single request."""
+    s3_client = get_s3_client()
+    try:
+        return s3_client.put_object(Bucket=BUCKET_NAME, Key=object_name, Body=body,
+                                    **get_extra_args(mime_type, acl, object_name, content_encoding))
+    finally:
+        invalidate(object_name)
+
+
+def create_multipart_upload(object_name, mime_type=None, acl=None, content_encoding=None):
+    """Start a multipart upload.
+
+    :return: Upload id
+    """
+    s3_client = get_s3_client()
+    response = s3_client.create_multipart_upload(Bucket=BUCKET_NAME, Key=object_name,
+                                                 **get_extra_args(mime_type, acl, object_name, content_encoding))
+    return response['UploadId']
+
+
+def upload_part(object_name, upload_id, part_number, body):
+    """Upload a single part of a multipart upload.
+
+    :return: Part ETag
+    """
+    s3_client = get_s3_client()
+    response = s3_client.upload_part(Bucket=BUCKET_NAME, Key=object_name, UploadId=upload_id,
+                                     PartNumber=part_number, Body=body)
+    return response['ETag']
+
+
+def complete_multipart_upload(object_name, upload_id, parts):
+    """Complete a multipart upload.
+
+    :param parts: List of (part number, ETag) tuples
+    """
+    s3_client = get_s3_client()
+    multipart_upload = {
+        'Parts': [{'PartNumber': number, 'ETag': etag} for number, etag in sorted(parts)],
+    }
+    try:
+        return s3_client.complete_multipart_upload(Bucket=BUCKET_NAME, Key=object_name, UploadId=upload_id,
+                                                   MultipartUpload=multipart_upload)
+    finally:
+        invalidate(object_name)
+
+
+def abort_multipart_upload(object_name, upload_id):
+    try:
+        s3_client = get_s3_client()
+        s3_client.abort_multipart_upload(Bucket=BUCKET_NAME, Key=object_name, UploadId=upload_id)
+    except ClientError as e:
+        logging.error(e)
+
+
+def list_multipart_uploads():
+    """List the multipart uploads in progress in the bucket.
+
+    :return: List of dicts with Key, UploadId and Initiated
+    """
+    s3_client = get_s3_client()
+    paginator = s3_client.get_paginator('list_multipart_uploads')
+    uploads = []
+    for page in paginator.paginate(Bucket=BUCKET_NAME):
+        uploads.extend(page.get('Uploads', []))
+    return uploads
+
+
 def get_obj_url(file_name):
     """ Get an object URL """
     if CUSTOM_ENDPOINT_URL is not None:
@@ -96,10 +337,78 @@ def get_obj_url(file_name):
     return f'https://{BUCKET_NAME}.{endpoint_url}/{file_name}'
 
 
+def presign_get(file_name, expires_in=PRESIGN_DEFAULT_TTL):
+    """Sign a URL downloading a (private) object.
+
+    :param expires_in: Lifetime of the URL in seconds
+    :return: URL
+    """
+    return get_presign_client().generate_presigned_url(
+        'get_object', Params={'Bucket': BUCKET_NAME, 'Key': file_name}, ExpiresIn=expires_in)
+
+
+def presign_put(file_name, expires_in=PRESIGN_DEFAULT_TTL, mime_type=None):
+    """Sign a URL uploading an object with a single PUT request.
+
+    The client must send the signed Content-Type header as is. Objects written this way bypass the
+    metadata cache, which picks them up after METADATA_CACHE_TTL seconds.
+
+    :return: URL
+    """
+    params = {'Bucket': BUCKET_NAME, 'Key': file_name}
+    if mime_type is not None:
+        params['ContentType'] = mime_type
+    return get_presign_client().generate_presigned_url('put_object', Params=params, ExpiresIn=expires_in)
+
+
+def presign_post(file_name, expires_in=PRESIGN_DEFAULT_TTL, mime_type=None, max_size=None):
+    """Sign a policy uploading an object with an HTML form POST request.
+
+    Unlike a presigned PUT, the policy can limit the size of the upload.
+
+    :param max_size: Largest accepted upload in bytes
+    :return: Dict with the url and the form fields to send before the file field
+    """
+    fields = {}
+    conditions = []
+    if mime_type is not None:
+        fields['Content-Type'] = mime_type
+        conditions.append({'Content-Type': mime_type})
+    if max_size is not None:
+        conditions.append(['content-length-range', 0, max_size])
+    return get_presign_client().generate_presigned_post(BUCKET_NAME, file_name, Fields=fields,
+                                                        Conditions=conditions, ExpiresIn=expires_in)
+
+
 def delete_file(file_name):
     s3_client = get_s3_client()
     # Delete the file
-    s3_client.delete_object(Bucket=BUCKET_NAME, Key=file_name)
+    try:
+        s3_client.delete_object(Bucket=BUCKET_NAME, Key=file_name)
+    except ClientError:
+        invalidate(file_name)
+        raise
+    _forget_deleted([file_name])
+
+
+@tracing.traced('s3bucket.delete_files')
+def delete_files(file_names):
+    """Delete up to 1000 files with a single DeleteObjects request.
+
+    :return: Tuple of the deleted keys and a list of (key, error message) tuples for the failed ones
+    """
+    s3_client = get_s3_client()
+    response = s3_client.delete_objects(Bucket=BUCKET_NAME, Delete={
+        'Objects': [{'Key': file_name} for file_name in file_names],
+        'Quiet': True,
+    })
+    errors = [(error['Key'], error.get('Message') or error.get('Code')) for error in response.get('Errors', [])]
+    failed = {key for key, _ in errors}
+    deleted = [file_name for file_name in file_names if file_name not in failed]
+    _forget_deleted(deleted)
+    for file_name in failed:
+        invalidate(file_name)
+    return deleted, errors
 
 
 def make_public(file_name):
@@ -112,8 +421,10 @@ def make_public(file_name):
         s3_client = get_s3_client()
         s3_client.put_object_acl(ACL='public-read', Bucket=BUCKET_NAME, Key=file_name)
     except ClientError as e:
+        metadata_cache.delete(('acl', BUCKET_NAME, file_name))
         ACLNotSupportedError.raise_if_not_implemented(e)
         raise
+    metadata_cache.set(('acl', BUCKET_NAME, file_name), 'public-read')
 
 
 def make_private(file_name):
@@ -126,37 +437,75 @@ def make_private(file_name):
         s3_client = get_s3_client()
         s3_client.put_object_acl(ACL='private', Bucket=BUCKET_NAME, Key=file_name)
     except ClientError as e:
+        metadata_cache.delete(('acl', BUCKET_NAME, file_name))
         ACLNotSupportedError.raise_if_not_implemented(e)
         raise
+    metadata_cache.set(('acl', BUCKET_NAME, file_name), 'private')
 
 
-def file_exist(file_name):
+@tracing.traced('s3bucket.head_object')
+def head_object(file_name):
+    """Get the metadata of an object, served from the cache when possible.
+
+    :return: head_object response, or None if the object does not exist
+    """
+    cache_key = ('meta', BUCKET_NAME, file_name)
+    response = metadata_cache.get(cache_key)
+    if response is not MISSING:
+        return response
     try:
         s3_client = get_s3_client()
-        s3_client.head_object(Bucket=BUCKET_NAME, Key=file_name)
+        response = s3_client.head_object(Bucket=BUCKET_NAME, Key=file_name)
     except ClientError as e:
         logging.error(e)
         if e.response['ResponseMetadata']['HTTPStatusCode'] != 404:
             raise e
-        return False
-    return True
+        metadata_cache.set(cache_key, None, ttl=METADATA_CACHE_MISSING_TTL)
+        return None
+    metadata_cache.set(cache_key, response)
+    return response
 
 
-def copy_file(src, dest):
-    """Copy a file within the bucket."""
+def file_exist(file_name):
+    return head_object(file_name) is not None
+
+
+@tracing.traced('s3bucket.copy_file')
+def copy_file(src, dest, size=None):
+    """Copy a file within the bucket.
+
+    Objects larger than S3_COPY_MULTIPART_THRESHOLD are copied server-side with parallel
+    upload_part_copy requests, which also lifts the 5GB limit of a single copy_object.
+
+    :param src: Source object name
+    :param dest: Destination object name
+    :param size: Source size if already known (e.g. from a listing), saves a head_object request
+    :return: True if the file was copied, False if the source does not exist
+    """
     try:
-        s3_client = get_s3_client()
+        head = None
+        if size is None or size > S3_COPY_MULTIPART_THRESHOLD:
+            head = head_object(src)
+            if head is None:
+                return False
+            size = head['ContentLength']
         acl = get_file_acl(src)
 
+        if size > S3_COPY_MULTIPART_THRESHOLD:
+            # Completing the multipart upload invalidates the destination
+            _multipart_copy(src, dest, head, acl)
+            return True
+
         copy_args = {
             'Bucket': BUCKET_NAME,
-            'CopySource': f'{BUCKET_NAME}/{src}',
+            'CopySource': {'Bucket': BUCKET_NAME, 'Key': src},
             'Key': dest,
         }
         # Only include ACL if the storage provider supports it
         if acl is not None:
             copy_args['ACL'] = acl
 
+        s3_client = get_s3_client()
         response = s3_client.copy_object(**copy_args)
         logging.debug(response)
     except ClientError as e:
@@ -164,9 +513,59 @@ def copy_file(src, dest):
         if e.response['ResponseMetadata']['HTTPStatusCode'] != 404:
             raise e
         return False
+    invalidate(dest)
     return True
 
 
+# Headers of the source object carried over to the destination of a multipart copy
+_COPIED_HEADERS = ('CacheControl', 'ContentDisposition', 'ContentEncoding', 'ContentLanguage', 'ContentType',
+                   'Expires', 'Metadata')
+
+
+def copy_part_size(size):
+    """Part size of a multipart copy: S3_COPY_PART_SIZE, raised so that the copy stays under MAX_PARTS parts."""
+    return min(max(S3_COPY_PART_SIZE, MIN_PART_SIZE, math.ceil(size / MAX_PARTS)), MAX_PART_SIZE)
+
+
+def _multipart_copy(src, dest, head, acl):
+    """Copy a large object with parallel upload_part_copy requests."""
+    s3_client = get_s3_client()
+    create_args = {key: head[key] for key in _COPIED_HEADERS if head.get(key)}
+    if acl is not None:
+        create_args['ACL'] = acl
+    upload_id = s3_client.create_multipart_upload(Bucket=BUCKET_NAME, Key=dest, **create_args)['UploadId']
+
+    size = head['ContentLength']
+    part_size = copy_part_size(size)
+    copy_source = {'Bucket': BUCKET_NAME, 'Key': src}
+    # Pin the copy to the version that was inspected, in case the source changes meanwhile
+    copy_source_if_match = head.get('ETag')
+
+    def copy_part(number):
+        start = (number - 1) * part_size
+        end = min(start + part_size, size) - 1
+        part_args = {}
+        if copy_source_if_match:
+            part_args['CopySourceIfMatch'] = copy_source_if_match
+        response = s3_client.upload_part_copy(Bucket=BUCKET_NAME, Key=dest, UploadId=upload_id, PartNumber=number,
+                                              CopySource=copy_source, CopySourceRange=f'bytes={start}-{end}',
+                                              **part_args)
+        return number, response['CopyPartResult']['ETag']
+
+    part_count = -(-size // part_size)
+    tracing.set_attributes(**{'copy.size': size, 'copy.parts': part_count})
+    try:
+        with ThreadPoolExecutor(max_workers=S3_COPY_CONCURRENCY, thread_name_prefix='s3-copy') as executor:
+            # A context per call, carrying the current span over to the copy threads
+            futures = [executor.submit(contextvars.copy_context().run, copy_part, number)
+                       for number in range(1, part_count + 1)]
+            parts = [future.result() for future in futures]
+        complete_multipart_upload(dest, upload_id, parts)
+    except Exception:
+        abort_multipart_upload(dest, upload_id)
+        raise
+
+
 def get_file_obj(file_name):
     try:
         s3_client = get_s3_client()
@@ -177,12 +576,17 @@ def get_file_obj(file_name):
     return None
 
 
+@tracing.traced('s3bucket.get_file_acl')
 def get_file_acl(file_name):
     """Get the ACL of a file.
 
     Returns:
         str: 'public-read', 'private', or None if ACL operations are not supported.
     """
+    cache_key = ('acl', BUCKET_NAME, file_name)
+    acl = metadata_cache.get(cache_key)
+    if acl is not MISSING:
+        return acl
     try:
         s3_client = get_s3_client()
         response = s3_client.get_object_acl(Bucket=BUCKET_NAME, Key=file_name)
@@ -193,35 +597,68 @@ def get_file_acl(file_name):
                 if len(grants) > 0:
                     public = grants[0]['Permission'] == 'READ'
 
-        if public:
-            return 'public-read'
-        return 'private'
+        acl = 'public-read' if public else 'private'
+        metadata_cache.set(cache_key, acl)
+        return acl
     except ClientError as e:
         logging.error(e)
         if ACLNotSupportedError.is_not_implemented(e):
+            metadata_cache.set(cache_key, None)
             return None
     return 'private'
 
 
-def list_files(prefix, limit=10):
-    if limit > 1000:
-        limit = 1000
+def _to_entry(obj):
+    return {
+        'key': obj['Key'],
+        'size': obj['Size'],
+        'last_modified': obj['LastModified'].strftime("%Y-%m-%d %H:%M:%S"),
+        'etag': obj.get('ETag'),
+    }
 
+
+@tracing.traced('s3bucket.list_files_page')
+def list_files_page(prefix, limit=10, continuation_token=None, start_after=None):
+    """List a single page of objects, with one S3 request.
+
+    :param prefix: Key prefix
+    :param limit: Maximum number of entries (up to 1000)
+    :param continuation_token: Token returned for the previous page, None for the first page
+    :param start_after: Key to list the objects after, ignored with a continuation token
+    :return: Tuple of entries and the token of the next page (None on the last page)
+    """
+    s3_client = get_s3_client()
+    kwargs = {
+        'Bucket': BUCKET_NAME,
+        'Prefix': prefix,
+        'MaxKeys': min(limit, 1000),
+    }
+    if continuation_token is not None:
+        kwargs['ContinuationToken'] = continuation_token
+    elif start_after is not None:
+        kwargs['StartAfter'] = start_after
+    response = s3_client.list_objects_v2(**kwargs)
+    entries = [_to_entry(obj) for obj in response.get('Contents', [])]
+    next_token = response.get('NextContinuationToken') if response.get('IsTruncated') else None
+    return entries, next_token
+
+
+def iter_files(prefix, page_size=1000):
+    """Lazily iterate over all objects under a prefix, fetching one page at a time."""
+    continuation_token = None
+    while True:
+        entries, continuation_token = list_files_page(prefix, page_size, continuation_token)
+        yield from entries
+        if continuation_token is None:
+            return
+
+
+def list_files(prefix, limit=10):
     entries = []
     try:
-        s3 = boto3.resource('s3',
-                            endpoint_url=ENDPOINT_URL,
-                            aws_access_key_id=AWS_SERVER_PUBLIC_KEY,
-                            aws_secret_access_key=AWS_SERVER_SECRET_KEY,
-                            region_name=AWS_REGION)
-        bucket = s3.Bucket(BUCKET_NAME)
-        for obj in bucket.objects.filter(Prefix=prefix).limit(limit):
-            last_modified = obj.last_modified.strftime("%Y-%m-%d %H:%M:%S")
-            entry = {
-                'key': obj.key,
-                'size': obj.size,
-                'last_modified': last_modified,
-            }
+        for entry in iter_files(prefix, page_size=min(limit, 1000)):
+            if len(entries) >= limit:
+                break
             entries.append(entry)
     except ClientError as e:
         logging.error(e)
@@ -230,12 +667,7 @@ def list_files(prefix, limit=10):
 
 def get_meta(file_name):
     try:
-        s3_client = get_s3_client()
-        response = s3_client.head_object(
-            Bucket=BUCKET_NAME,
-            Key=file_name,
-        )
-        return response
+        return head_object(file_name)
     except ClientError as e:
         logging.error(e)
     return None
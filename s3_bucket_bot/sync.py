@@ -0,0 +1,361 @@
+"""Mirror a local directory or an archive to a prefix of the bucket.
+
+Only new and changed files are uploaded, many at a time: files smaller than a part are read and
+sent with one PUT request each in the bulk executor, larger ones are sent as multipart uploads.
+Objects under the prefix that are not in the source can be deleted as well.
+
+A file is unchanged when the object has the same size and either a newer modification time, or
+with checksum comparison, the same ETag. Files are always compared by checksum in archives, whose
+modification times usually tell when the archive was built rather than when a file changed. Archive
+members of at least a part are streamed to S3 as they are read, and always uploaded.
+
+extract_archive() uploads all the files of an archive without comparing them, and can read a tar
+archive while it is being downloaded.
+"""
+import io
+import os
+import asyncio
+import fnmatch
+import hashlib
+import logging
+import mimetypes
+from datetime import datetime, timezone
+
+from . import aio, archive, s3bucket
+from .bulk import delete_files as bulk_delete_files
+from .transfer import upload_file, stream_upload, DEFAULT_SETTINGS
+
+logger = logging.getLogger(__name__)
+
+# Files synced at the same time
+SYNC_CONCURRENCY = int(os.getenv('SYNC_CONCURRENCY') or 16)
+
+# Outcomes of a single file
+UPLOADED = 'uploaded'
+SKIPPED = 'skipped'
+
+
+class SyncReport:
+    """Outcome of a sync, updated while it runs."""
+
+    def __init__(self):
+        self.uploaded = []
+        self.skipped = []
+        self.deleted = []
+        self.failed = []
+        self.bytes_uploaded = 0
+
+    def __str__(self):
+        text = f'{len(self.uploaded)} uploaded, {len(self.skipped)} unchanged, {len(self.deleted)} deleted'
+        if self.failed:
+            text += f', {len(self.failed)} failed'
+        return text
+
+
+class _Remote:
+    """State of an object under the synced prefix."""
+
+    def __init__(self, entry):
+        self.size = entry['size']
+        self.etag = (entry.get('etag') or '').strip('"')
+        self.mtime = datetime.strptime(entry['last_modified'], '%Y-%m-%d %H:%M:%S') \
+            .replace(tzinfo=timezone.utc).timestamp()
+
+
+def compute_etag(chunks, part_size):
+    """ETag S3 gives to data uploaded with the given part size: the MD5 of a single part upload, or
+    the MD5 of the part MD5s followed by the number of parts for a multipart upload.
+
+    :param chunks: Iterable of bytes
+    """
+    digests = []
+    current = hashlib.md5()
+    filled = 0
+    for chunk in chunks:
+        view = memoryview(chunk)
+        while len(view):
+            taken = view[:part_size - filled]
+            current.update(taken)
+            filled += len(taken)
+            view = view[len(taken):]
+            if filled == part_size:
+                digests.append(current.digest())
+                current = hashlib.md5()
+                filled = 0
+    if filled or not digests:
+        digests.append(current.digest())
+    if len(digests) == 1:
+        return digests[0].hex()
+    return f'{hashlib.md5(b"".join(digests)).hexdigest()}-{len(digests)}'
+
+
+def _read_chunks(file_name, chunk_size=1024 * 1024):
+    with open(file_name, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            yield chunk
+
+
+class Sync:
+    """Sync of one source to a prefix.
+
+    :param prefix: Key prefix the source is mirrored to, e.g. 'site/'
+    :param delete: Delete the objects under the prefix that are not in the source
+    :param checksum: Compare files by ETag instead of modification time
+    :param exclude: Glob patterns of relative paths to leave alone, both in the source and under the prefix
+    :param acl: ACL of the uploaded objects
+    :param dry_run: Only report what would be done
+    """
+
+    def __init__(self, prefix, delete=False, checksum=False, exclude=(), acl='public-read', dry_run=False,
+                 settings=DEFAULT_SETTINGS, concurrency=SYNC_CONCURRENCY, report=None):
+        self.prefix = prefix
+        self.delete = delete
+        self.checksum = checksum
+        self.exclude = tuple(exclude)
+        self.acl = acl
+        self.dry_run = dry_run
+        self.settings = settings
+        self.report = report if report is not None else SyncReport()
+        # Also bounds the memory held by files read for upload to concurrency parts
+        self.slots = asyncio.Semaphore(concurrency)
+        self.tasks = set()
+        self.remote = {}
+
+    def is_excluded(self, name):
+        return any(fnmatch.fnmatchcase(name, pattern) for pattern in self.exclude)
+
+    async def list_remote(self):
+        token = None
+        while True:
+            entries, token = await aio.run(aio.METADATA, s3bucket.list_files_page, self.prefix, 1000, token)
+            for entry in entries:
+                name = entry['key'][len(self.prefix):]
+                if not self.is_excluded(name):
+                    self.remote[name] = _Remote(entry)
+            if token is None:
+                return
+
+    def _put(self, name, data, remote):
+        """Upload a small file unless the object has the same content.
+
+        :return: UPLOADED or SKIPPED
+        """
+        if remote is not None and remote.size == len(data) and remote.etag == hashlib.md5(data).hexdigest():
+            return SKIPPED
+        if not self.dry_run:
+            s3bucket.put_object(self.prefix + name, data, mimetypes.guess_type(name)[0], self.acl)
+        return UPLOADED
+
+    def _record(self, name, size, outcome):
+        if outcome == UPLOADED:
+            self.report.uploaded.append(name)
+            self.report.bytes_uploaded += size
+        else:
+            self.report.skipped.append(name)
+
+    def _spawn(self, name, size, coroutine):
+        """Run the sync of one file in the background, in one of the slots acquired by the caller."""
+        async def run():
+            try:
+                self._record(name, size, await coroutine)
+            except Exception as e:
+                logger.error(f'Cannot sync {name}: {e}')
+                self.report.failed.append((name, str(e)))
+            finally:
+                self.slots.release()
+
+        task = asyncio.create_task(run())
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def sync_file(self, file_name, name):
+        # What is left in self.remote once the source is read are the orphans
+        remote = self.remote.pop(name, None)
+        size = os.path.getsize(file_name)
+        if not self.checksum and remote is not None and remote.size == size \
+                and remote.mtime >= os.path.getmtime(file_name):
+            self.report.skipped.append(name)
+            return
+        await self.slots.acquire()
+        if size < self.settings.part_size:
+            self._spawn(name, size, aio.run(aio.BULK, lambda: self._put(name, _read(file_name), remote)))
+        else:
+            self._spawn(name, size, self._upload_large_file(file_name, name, size, remote))
+
+    async def _upload_large_file(self, file_name, name, size, remote):
+        if remote is not None and remote.size == size:
+            # upload_file() raises the part size of very large files
+            etag = await aio.run(aio.BULK, compute_etag, _read_chunks(file_name),
+                                 self.settings.for_size(size).part_size)
+            if etag == remote.etag:
+                return SKIPPED
+        if not self.dry_run:
+            await upload_file(file_name, self.prefix + name, mimetypes.guess_type(name)[0], self.acl,
+                              settings=self.settings)
+        return UPLOADED
+
+    async def sync_directory(self, root):
+        def walk():
+            for directory, _, file_names in os.walk(root):
+                for file_name in file_names:
+                    path = os.path.join(directory, file_name)
+                    if os.path.isfile(path):
+                        yield path, os.path.relpath(path, root).replace(os.sep, '/')
+
+        for path, name in await aio.run(aio.BULK, lambda: list(walk())):
+            if self.is_excluded(name):
+                continue
+            await self.sync_file(path, name)
+
+    async def sync_archive(self, file_name, fileobj=None):
+        members = archive.iter_members(file_name, fileobj)
+        while True:
+            # Members are read one after the other, the uploads of small ones run in the background
+            await self.slots.acquire()
+            try:
+                item = await aio.run(aio.BULK, _next_member, members, self.settings.part_size)
+            except BaseException:
+                self.slots.release()
+                raise
+            if item is None:
+                self.slots.release()
+                return
+            member, f, data = item
+            if self.is_excluded(member.name):
+                self.slots.release()
+                continue
+            remote = self.remote.pop(member.name, None)
+            if data is not None:
+                self._spawn(member.name, member.size, aio.run(aio.BULK, self._put, member.name, data, remote))
+                continue
+            # Large members are streamed before moving on, sent part by part in parallel. They cannot be
+            # compared before they are read, so they are always uploaded.
+            try:
+                if not self.dry_run:
+                    await stream_upload(_iter_member(f, self.settings.part_size), self.prefix + member.name,
+                                        mimetypes.guess_type(member.name)[0], self.acl, settings=self.settings,
+                                        size=member.size)
+                self._record(member.name, member.size, UPLOADED)
+            except Exception as e:
+                logger.error(f'Cannot sync {member.name}: {e}')
+                self.report.failed.append((member.name, str(e)))
+            finally:
+                self.slots.release()
+
+    async def finish(self):
+        """Wait for the running uploads, then delete the orphans if requested."""
+        if self.tasks:
+            await asyncio.gather(*self.tasks)
+        if self.delete and self.remote:
+            orphans = sorted(self.remote)
+            if self.dry_run:
+                self.report.deleted.extend(orphans)
+                return
+            result = await bulk_delete_files([self.prefix + name for name in orphans])
+            self.report.deleted.extend(key[len(self.prefix):] for key in result.succeeded)
+            self.report.failed.extend((key[len(self.prefix):], error) for key, error in result.failed)
+
+    async def cancel(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+
+def _read(file_name):
+    with open(file_name, 'rb') as f:
+        return f.read()
+
+
+def _next_member(members, part_size):
+    """Advance an archive to its next member, reading it whole if it is smaller than a part.
+
+    :return: Tuple of the member, its file object and its data (None for large members), or None at the end
+    """
+    member = next(members, None)
+    if member is None:
+        return None
+    member, f = member
+    if member.size < part_size:
+        return member, f, f.read()
+    return member, f, None
+
+
+async def _iter_member(f, part_size):
+    while chunk := await aio.run(aio.BULK, f.read, part_size):
+        yield chunk
+
+
+class _ChunkReader(io.RawIOBase):
+    """Blocking binary stream over an async iterator of bytes, for reading in a worker thread while
+    the event loop produces the chunks."""
+
+    def __init__(self, chunks, loop):
+        self._chunks = aiter(chunks)
+        self._loop = loop
+        self._buffer = memoryview(b'')
+
+    async def _next_chunk(self):
+        return await anext(self._chunks, b'')
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if not self._buffer:
+            self._buffer = memoryview(asyncio.run_coroutine_threadsafe(self._next_chunk(), self._loop).result())
+        size = min(len(b), len(self._buffer))
+        b[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+
+async def sync_path(source, prefix, **kwargs):
+    """Mirror a local directory or archive to a prefix.
+
+    :param source: Path of a directory or of a zip or tar archive
+    :param kwargs: Options of Sync
+    :return: SyncReport
+    """
+    if prefix and not prefix.endswith('/'):
+        prefix += '/'
+    sync = Sync(prefix, **kwargs)
+    try:
+        await sync.list_remote()
+        if os.path.isdir(source):
+            await sync.sync_directory(source)
+        elif archive.is_archive(source):
+            await sync.sync_archive(source)
+        else:
+            raise ValueError(f'{source} is neither a directory nor a zip or tar archive')
+        await sync.finish()
+    except BaseException:
+        await sync.cancel()
+        raise
+    return sync.report
+
+
+async def extract_archive(file_name, prefix, chunks=None, **kwargs):
+    """Upload all the files of an archive under a prefix, replacing the objects already there.
+
+    Memory use is bounded by the concurrency times the part size, the archive is never extracted to disk.
+
+    :param file_name: Path of a zip or tar archive, or only its name when chunks are given
+    :param chunks: Async iterator of the bytes of a tar archive, extracted as they arrive
+    :param kwargs: Options of Sync
+    :return: SyncReport
+    """
+    if prefix and not prefix.endswith('/'):
+        prefix += '/'
+    sync = Sync(prefix, **kwargs)
+    fileobj = _ChunkReader(chunks, asyncio.get_running_loop()) if chunks is not None else None
+    try:
+        # Nothing is listed: without remote state, every member is uploaded
+        await sync.sync_archive(file_name, fileobj)
+        await sync.finish()
+    except BaseException:
+        await sync.cancel()
+        raise
+    finally:
+        if chunks is not None and hasattr(chunks, 'aclose'):
+            await chunks.aclose()
+    return sync.report
@@ -0,0 +1,295 @@
+"""Lightweight tracing, exported as OpenTelemetry (OTLP/JSON) spans to a file or stdout.
+
+Spans are opened with span() and nest through a context variable, so they follow the handler
+across awaits and into the S3 calls that aio.run() hands to its thread pools, which copy the
+context. Every S3 API call made inside a trace gets its own span from botocore event hooks.
+Queued jobs carry a W3C traceparent, so that their spans in a worker join the trace of the
+update that queued them.
+
+Every line of the output is an OTLP/JSON ExportTraceServiceRequest holding one span, the format
+of the OpenTelemetry collector file exporter and receiver.
+
+@see https://opentelemetry.io/docs/specs/otlp/#json-protobuf-encoding
+"""
+import os
+import sys
+import json
+import time
+import random
+import inspect
+import logging
+import functools
+import threading
+import contextvars
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Where finished spans go: stdout, a file path, or nothing (default)
+TRACING_EXPORTER = os.getenv('TRACING_EXPORTER') or ''
+# Fraction of traces that are recorded, decided when a trace starts
+TRACING_SAMPLE_RATE = float(os.getenv('TRACING_SAMPLE_RATE') or 1)
+TRACING_SERVICE_NAME = os.getenv('TRACING_SERVICE_NAME') or 's3-bucket-bot'
+
+SCOPE_NAME = 's3_bucket_bot'
+# OTLP span kinds and status codes
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_SERVER = 2
+SPAN_KIND_CLIENT = 3
+SPAN_KIND_CONSUMER = 5
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+_current_span = contextvars.ContextVar('current_span', default=None)
+
+
+class Span:
+    def __init__(self, name, trace_id, parent_span_id=None, kind=SPAN_KIND_INTERNAL, attributes=None, sampled=True):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = f'{random.getrandbits(64):016x}'
+        self.parent_span_id = parent_span_id
+        self.kind = kind
+        self.attributes = dict(attributes or {})
+        self.sampled = sampled
+        self.start_time = time.time_ns()
+        self.end_time = None
+        self.status = None
+
+    @property
+    def traceparent(self):
+        """W3C trace context header value identifying this span."""
+        return f'00-{self.trace_id}-{self.span_id}-{"01" if self.sampled else "00"}'
+
+    def set_attributes(self, **attributes):
+        self.attributes.update(attributes)
+
+    def record_error(self, error):
+        self.status = (STATUS_ERROR, f'{type(error).__name__}: {error}')
+
+    def end(self):
+        if self.end_time is not None:
+            return
+        self.end_time = time.time_ns()
+        if self.status is None:
+            self.status = (STATUS_OK, '')
+        if self.sampled:
+            export(self)
+
+    def to_otlp(self):
+        span = {
+            'traceId': self.trace_id,
+            'spanId': self.span_id,
+            'name': self.name,
+            'kind': self.kind,
+            'startTimeUnixNano': str(self.start_time),
+            'endTimeUnixNano': str(self.end_time),
+            'attributes': [{'key': key, 'value': _otlp_value(value)} for key, value in self.attributes.items()
+                           if value is not None],
+            'status': {'code': self.status[0], 'message': self.status[1]} if self.status[1] else {'code': self.status[0]},
+        }
+        if self.parent_span_id:
+            span['parentSpanId'] = self.parent_span_id
+        return span
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        # 64-bit integers are strings in OTLP/JSON
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+class JsonLinesExporter:
+    """Write every span as one line of OTLP/JSON."""
+
+    def __init__(self, target):
+        self.target = target
+        self._stream = None
+        self._lock = threading.Lock()
+
+    def _open(self):
+        if self._stream is None:
+            if self.target == 'stdout':
+                self._stream = sys.stdout
+            else:
+                os.makedirs(os.path.dirname(os.path.abspath(self.target)), exist_ok=True)
+                self._stream = open(self.target, 'a', buffering=1)
+        return self._stream
+
+    def export(self, span):
+        line = json.dumps({'resourceSpans': [{
+            'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': TRACING_SERVICE_NAME}},
+                                        {'key': 'process.pid', 'value': {'intValue': str(os.getpid())}}]},
+            'scopeSpans': [{'scope': {'name': SCOPE_NAME}, 'spans': [span.to_otlp()]}],
+        }]})
+        with self._lock:
+            try:
+                self._open().write(line + '\n')
+            except OSError as e:
+                logger.error(f'Cannot export span {span.name}: {e}')
+
+    def close(self):
+        with self._lock:
+            if self._stream is not None and self._stream is not sys.stdout:
+                self._stream.close()
+            self._stream = None
+
+
+exporter = JsonLinesExporter(TRACING_EXPORTER) if TRACING_EXPORTER else None
+
+
+def is_enabled():
+    return exporter is not None
+
+
+def export(span):
+    if exporter is not None:
+        exporter.export(span)
+
+
+def current_span():
+    return _current_span.get()
+
+
+def set_attributes(**attributes):
+    """Add attributes to the current span, if there is one."""
+    span = _current_span.get()
+    if span is not None:
+        span.set_attributes(**attributes)
+
+
+def current_traceparent():
+    span = _current_span.get()
+    return span.traceparent if span is not None else None
+
+
+def _parse_traceparent(traceparent):
+    try:
+        _, trace_id, span_id, flags = traceparent.split('-')
+        return trace_id, span_id, flags == '01'
+    except (AttributeError, ValueError):
+        return None
+
+
+def start_span(name, kind=SPAN_KIND_INTERNAL, parent=None, **attributes):
+    """Start a span, child of the current one or of the given traceparent. Must be ended with end()."""
+    parent_span = _current_span.get()
+    remote = _parse_traceparent(parent) if parent else None
+    if parent_span is not None:
+        return Span(name, parent_span.trace_id, parent_span.span_id, kind, attributes, parent_span.sampled)
+    if remote is not None:
+        trace_id, parent_span_id, sampled = remote
+        return Span(name, trace_id, parent_span_id, kind, attributes, sampled)
+    sampled = is_enabled() and random.random() < TRACING_SAMPLE_RATE
+    return Span(name, f'{random.getrandbits(128):032x}', None, kind, attributes, sampled)
+
+
+@contextmanager
+def span(name, kind=SPAN_KIND_INTERNAL, parent=None, **attributes):
+    """Run a block in a span, which records the exception the block raises if any.
+
+    :param parent: traceparent of a remote parent, used when there is no current span
+    """
+    if not is_enabled():
+        yield None
+        return
+    current = start_span(name, kind, parent, **attributes)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.record_error(e)
+        raise
+    finally:
+        _current_span.reset(token)
+        current.end()
+
+
+def traced(name):
+    """Decorate a function, blocking or async, to run it in a span when tracing is enabled at call time."""
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                if not is_enabled():
+                    return await func(*args, **kwargs)
+                with span(name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not is_enabled():
+                return func(*args, **kwargs)
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _before_call(model, params, context, **kwargs):
+    # Only calls made inside a trace, e.g. not the ones of boto3 transfer threads
+    if _current_span.get() is None:
+        return
+    context['tracing_span'] = start_span(f'S3.{model.name}', SPAN_KIND_CLIENT, **{
+        'rpc.system': 'aws-api',
+        'rpc.service': 'S3',
+        'rpc.method': model.name,
+        'url.path': params.get('url_path'),
+    })
+
+
+def _after_call(model, context, http_response=None, parsed=None, **kwargs):
+    current = context.pop('tracing_span', None)
+    if current is None:
+        return
+    metadata = (parsed or {}).get('ResponseMetadata', {})
+    current.set_attributes(**{
+        'http.response.status_code': http_response.status_code if http_response is not None else None,
+        'aws.request_id': metadata.get('RequestId'),
+        'aws.retry_attempts': metadata.get('RetryAttempts'),
+    })
+    if http_response is not None and http_response.status_code >= 400:
+        current.status = (STATUS_ERROR, (parsed or {}).get('Error', {}).get('Code') or str(http_response.status_code))
+    current.end()
+
+
+def _after_call_error(model, context, exception=None, **kwargs):
+    current = context.pop('tracing_span', None)
+    if current is None:
+        return
+    current.record_error(exception)
+    current.end()
+
+
+def _before_send(request, **kwargs):
+    context = request.context
+    if 'tracing_span' not in context:
+        return
+    # Fired for every attempt, the size of the last one is kept
+    length = request.headers.get('Content-Length')
+    if length:
+        context['tracing_span'].set_attributes(**{'http.request.body.size': int(length)})
+
+
+def instrument_s3_client(client):
+    """Trace the calls of a botocore client made inside a trace with event hooks.
+
+    The hooks do nothing outside of a trace, so they are registered even when tracing is disabled.
+    """
+    events = client.meta.events
+    events.register('before-call.s3', _before_call)
+    events.register('after-call.s3', _after_call)
+    events.register('after-call-error.s3', _after_call_error)
+    events.register('before-send.s3', _before_send)
+    return client
+
+
+def shutdown():
+    if exporter is not None:
+        exporter.close()
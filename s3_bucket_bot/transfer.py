@@ -0,0 +1,522 @@
+"""Transfer engine for uploads to S3.
+
+Data is fed into S3 multipart upload parts as it arrives, so a Telegram download never has to be
+written to disk first and the download overlaps with the upload. Multipart uploads of local files
+are journaled on disk and resumed after a restart.
+"""
+import os
+import re
+import json
+import math
+import time
+import uuid
+import asyncio
+import logging
+import threading
+from datetime import datetime, timedelta, timezone
+from dataclasses import dataclass, replace
+
+import httpx
+from boto3.s3.transfer import TransferConfig
+
+from . import aio, compression, metrics, s3bucket, tracing
+from .s3bucket import MIN_PART_SIZE, MAX_PART_SIZE, MAX_PARTS
+
+logger = logging.getLogger(__name__)
+
+# Streams of unknown size double their part size every this many parts, to stay under MAX_PARTS
+PART_SIZE_GROWTH_INTERVAL = 1000
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Local state that must survive restarts. The default lives under TEMP_PATH, which docker-compose mounts as a volume.
+STATE_PATH = os.getenv('STATE_PATH') or os.path.join(os.getenv('TEMP_PATH', '/tmp'), 'state')
+UPLOAD_JOURNAL_PATH = os.path.join(STATE_PATH, 'uploads')
+
+# Multipart uploads unknown to the journal and older than this many hours are aborted on startup
+STALE_UPLOAD_MAX_AGE = float(os.getenv('STALE_UPLOAD_MAX_AGE') or 24)
+
+_SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+def parse_size(value):
+    """Parse a human-readable size like 64M or 1.5G into bytes."""
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([KMG]?)i?B?\s*', str(value), re.IGNORECASE)
+    if match is None:
+        raise ValueError(f'Invalid size: {value}')
+    return int(float(match.group(1)) * _SIZE_UNITS[match.group(2).upper()])
+
+
+def format_size(size):
+    """Format a number of bytes for humans."""
+    for unit in ('B', 'KB', 'MB'):
+        if abs(size) < 1024:
+            return f'{size:.1f} {unit}' if unit != 'B' else f'{int(size)} B'
+        size /= 1024
+    return f'{size:.1f} GB'
+
+
+@dataclass(frozen=True)
+class TransferSettings:
+    """Tunables of the transfer engine.
+
+    :param part_size: Size of a single multipart upload part in bytes
+    :param max_concurrency: Maximum number of parts uploaded at the same time
+    :param max_bandwidth: Upload bandwidth cap in bytes per second, None for unlimited
+    :param max_buffers: Maximum number of parts held in memory, including the ones being uploaded
+    :param compress: Encodings of the precompressed variants of compressible files (gzip, br), empty for none
+    """
+    part_size: int = 8 * 1024 * 1024
+    max_concurrency: int = 4
+    max_bandwidth: int = None
+    max_buffers: int = 8
+    compress: tuple = ()
+
+    # Per-command option names, as used in upload captions (e.g. --part-size=64M)
+    OPTIONS = {
+        'part-size': ('part_size', parse_size),
+        'concurrency': ('max_concurrency', int),
+        'bandwidth': ('max_bandwidth', parse_size),
+        'buffers': ('max_buffers', int),
+        # A bare --compress means gzip
+        'compress': ('compress', lambda value: compression.parse_encodings(value or compression.GZIP)),
+    }
+
+    @classmethod
+    def from_env(cls):
+        max_bandwidth = None
+        if os.getenv('S3_MAX_BANDWIDTH', '').strip():
+            max_bandwidth = parse_size(os.getenv('S3_MAX_BANDWIDTH'))
+        settings = cls(part_size=parse_size(os.getenv('S3_MULTIPART_CHUNKSIZE') or cls.part_size),
+                       max_concurrency=int(os.getenv('S3_MAX_CONCURRENCY') or cls.max_concurrency),
+                       max_bandwidth=max_bandwidth,
+                       max_buffers=int(os.getenv('S3_MAX_BUFFERS') or cls.max_buffers),
+                       compress=compression.default_encodings())
+        return settings.validated()
+
+    def validated(self):
+        """Clamp values to what S3 and the engine accept."""
+        max_concurrency = max(self.max_concurrency, 1)
+        return replace(self,
+                       part_size=min(max(self.part_size, MIN_PART_SIZE), MAX_PART_SIZE),
+                       max_concurrency=max_concurrency,
+                       max_bandwidth=self.max_bandwidth or None,
+                       max_buffers=max(self.max_buffers, max_concurrency))
+
+    def for_size(self, size):
+        """Settings for an upload of the given size, with parts large enough to stay under MAX_PARTS."""
+        if size is None or size <= self.part_size * MAX_PARTS:
+            return self
+        return replace(self, part_size=min(math.ceil(size / MAX_PARTS), MAX_PART_SIZE))
+
+    def with_options(self, options):
+        """Override settings with per-command options.
+
+        :param options: Mapping of option names (see OPTIONS) to string values
+        :raises ValueError: On unknown options or invalid values
+        """
+        changes = {}
+        for name, value in options.items():
+            if name not in self.OPTIONS:
+                raise ValueError(f'Unknown option: --{name}')
+            field, parse = self.OPTIONS[name]
+            changes[field] = parse(value)
+        return replace(self, **changes).validated()
+
+    def to_boto3_config(self):
+        return TransferConfig(multipart_threshold=self.part_size,
+                              multipart_chunksize=self.part_size,
+                              max_concurrency=self.max_concurrency,
+                              max_io_queue=self.max_buffers,
+                              max_bandwidth=self.max_bandwidth)
+
+
+DEFAULT_SETTINGS = TransferSettings.from_env()
+
+
+class TransferProgress:
+    """Thread-safe transfer progress, usable as a boto3 transfer callback."""
+
+    def __init__(self, total=None):
+        self.total = total
+        self.transferred = 0
+        self.started_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def __call__(self, bytes_amount):
+        with self._lock:
+            self.transferred += bytes_amount
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.started_at
+
+    @property
+    def throughput(self):
+        """Average throughput in bytes per second."""
+        elapsed = self.elapsed
+        return self.transferred / elapsed if elapsed > 0 else 0
+
+    @property
+    def eta(self):
+        """Estimated seconds left, or None if unknown."""
+        throughput = self.throughput
+        if self.total is None or throughput == 0:
+            return None
+        return max(self.total - self.transferred, 0) / throughput
+
+    def __str__(self):
+        text = format_size(self.transferred)
+        if self.total:
+            text += f' of {format_size(self.total)} ({self.transferred * 100 // self.total}%)'
+        text += f', {format_size(self.throughput)}/s'
+        eta = self.eta
+        if eta is not None:
+            text += f', ETA {int(eta) // 60}:{int(eta) % 60:02d}'
+        return text
+
+
+class BandwidthLimiter:
+    """Delay callers so that the average rate stays below max_bandwidth bytes per second."""
+
+    def __init__(self, max_bandwidth):
+        self.max_bandwidth = max_bandwidth
+        self._next_at = time.monotonic()
+
+    async def consume(self, amount):
+        now = time.monotonic()
+        start_at = max(now, self._next_at)
+        self._next_at = start_at + amount / self.max_bandwidth
+        if start_at > now:
+            await asyncio.sleep(start_at - now)
+
+
+class UploadJournal:
+    """Multipart upload state persisted on disk, one JSON file per upload.
+
+    An entry holds the upload id, the object name, the source file path (None for streams, which
+    cannot be resumed), the part size, the completed part ETags and caller-defined meta data.
+    """
+
+    def __init__(self, path=UPLOAD_JOURNAL_PATH):
+        self.path = path
+
+    def _entry_path(self, upload_id):
+        # Upload ids are opaque strings, so do not use them as file names directly
+        return os.path.join(self.path, f'{uuid.uuid5(uuid.NAMESPACE_URL, upload_id)}.json')
+
+    def save(self, entry):
+        os.makedirs(self.path, exist_ok=True)
+        entry_path = self._entry_path(entry['upload_id'])
+        tmp_path = f'{entry_path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(entry, f)
+        # Atomic on POSIX, so a crash never leaves a half-written entry behind
+        os.replace(tmp_path, entry_path)
+
+    def remove(self, upload_id):
+        try:
+            os.unlink(self._entry_path(upload_id))
+        except FileNotFoundError:
+            pass
+
+    def entries(self):
+        if not os.path.isdir(self.path):
+            return []
+        entries = []
+        for name in sorted(os.listdir(self.path)):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.path, name)) as f:
+                    entries.append(json.load(f))
+            except (OSError, ValueError) as e:
+                logger.error(f'Skipping broken upload journal entry {name}: {e}')
+        return entries
+
+
+journal = UploadJournal()
+
+
+def _new_journal_entry(upload_id, object_name, source, size, part_size, mime_type, acl, meta):
+    return {
+        'upload_id': upload_id,
+        'object_name': object_name,
+        'source': source,
+        'size': size,
+        'part_size': part_size,
+        'mime_type': mime_type,
+        'acl': acl,
+        'parts': {},
+        'meta': meta or {},
+        'created_at': time.time(),
+    }
+
+
+_http_client = None
+
+
+def get_http_client():
+    """Get the shared HTTP client used to stream downloads."""
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.AsyncClient(timeout=httpx.Timeout(30, read=300), follow_redirects=True)
+    return _http_client
+
+
+async def close_http_client():
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+
+async def iter_url(url, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """Download a URL as a stream of chunks."""
+    async with get_http_client().stream('GET', url) as response:
+        response.raise_for_status()
+        async for chunk in response.aiter_bytes(chunk_size):
+            yield chunk
+
+
+async def iter_file(file_name, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """Read a local file as a stream of chunks."""
+    with open(file_name, 'rb') as f:
+        while chunk := await aio.run(aio.UPLOAD, f.read, chunk_size):
+            yield chunk
+
+
+async def upload_file(file_name, object_name=None, mime_type=None, acl=None, settings=DEFAULT_SETTINGS,
+                      progress=None, meta=None):
+    """Upload a local file with the given transfer settings.
+
+    Files of at least one part are sent as a journaled multipart upload, which is resumed by
+    resume_uploads() if the process dies before it completes.
+
+    :param progress: Optional callable receiving the number of bytes sent since the last call
+    :param meta: JSON-serializable data stored in the journal, handed back when the upload is resumed
+    """
+    if object_name is None:
+        object_name = os.path.basename(file_name)
+    size = os.path.getsize(file_name)
+    settings = settings.for_size(size)
+    if size < settings.part_size:
+        return await aio.upload_file(file_name, object_name, mime_type, acl,
+                                     config=settings.to_boto3_config(), callback=progress)
+
+    with tracing.span('transfer.upload_file', **{'s3.key': object_name, 'file.size': size}):
+        upload_id = await aio.run(aio.UPLOAD, s3bucket.create_multipart_upload, object_name, mime_type, acl)
+        entry = _new_journal_entry(upload_id, object_name, os.path.abspath(file_name), size, settings.part_size,
+                                   mime_type, acl, meta)
+        journal.save(entry)
+        await _upload_file_parts(entry, settings, progress)
+    return True
+
+
+def _upload_file_part(file_name, object_name, upload_id, number, offset, length):
+    with tracing.span('disk.read', **{'file.offset': offset, 'file.bytes': length}), \
+            metrics.DISK_READ_DURATION.time(), open(file_name, 'rb') as f:
+        f.seek(offset)
+        body = f.read(length)
+    metrics.DISK_READ_BYTES.inc(len(body))
+    return s3bucket.upload_part(object_name, upload_id, number, body)
+
+
+async def _upload_file_parts(entry, settings, progress=None):
+    """Upload the parts of a journaled multipart upload that are not done yet, then complete it."""
+    file_name = entry['source']
+    object_name = entry['object_name']
+    upload_id = entry['upload_id']
+    size = entry['size']
+    part_size = entry['part_size']
+    limiter = BandwidthLimiter(settings.max_bandwidth) if settings.max_bandwidth else None
+    slots = asyncio.Semaphore(settings.max_concurrency)
+
+    def part_length(number):
+        return min(part_size, size - (number - 1) * part_size)
+
+    if progress is not None:
+        progress(sum(part_length(int(number)) for number in entry['parts']))
+
+    async def send_part(number):
+        length = part_length(number)
+        # The span includes the wait for a slot and for bandwidth
+        with tracing.span('transfer.upload_part', **{'part.number': number, 'part.bytes': length}):
+            async with slots:
+                if limiter is not None:
+                    await limiter.consume(length)
+                etag = await aio.run(aio.UPLOAD, _upload_file_part, file_name, object_name, upload_id, number,
+                                     (number - 1) * part_size, length)
+        entry['parts'][str(number)] = etag
+        journal.save(entry)
+        if progress is not None:
+            progress(length)
+
+    part_count = max(math.ceil(size / part_size), 1)
+    tracing.set_attributes(**{'upload.parts': part_count, 'upload.parts_resumed': len(entry['parts'])})
+    tasks = [asyncio.create_task(send_part(number))
+             for number in range(1, part_count + 1) if str(number) not in entry['parts']]
+    try:
+        if tasks:
+            await asyncio.gather(*tasks)
+        parts = [(int(number), etag) for number, etag in entry['parts'].items()]
+        await aio.run(aio.UPLOAD, s3bucket.complete_multipart_upload, object_name, upload_id, parts)
+    except asyncio.CancelledError:
+        # Most likely a shutdown: keep the journal entry so the upload is resumed on the next start
+        for task in tasks:
+            task.cancel()
+        raise
+    except Exception:
+        for task in tasks:
+            task.cancel()
+        logger.warning(f'Aborting multipart upload of {object_name}')
+        await aio.run(aio.UPLOAD, s3bucket.abort_multipart_upload, object_name, upload_id)
+        journal.remove(upload_id)
+        raise
+    journal.remove(upload_id)
+
+
+async def resume_uploads(callback=None, settings=DEFAULT_SETTINGS, match=None):
+    """Resume the multipart uploads left unfinished by a previous run.
+
+    Uploads whose source file is gone or changed are aborted.
+
+    :param callback: Optional coroutine function called with the journal entry of every resumed upload
+    :param match: Optional predicate selecting the journal entries to handle
+    :return: Number of resumed uploads
+    """
+    resumed = 0
+    for entry in journal.entries():
+        if match is not None and not match(entry):
+            continue
+        object_name = entry['object_name']
+        upload_id = entry['upload_id']
+        source = entry['source']
+        if source is None or not os.path.isfile(source) or os.path.getsize(source) != entry['size']:
+            logger.warning(f'Cannot resume upload of {object_name}, aborting it')
+            await aio.run(aio.UPLOAD, s3bucket.abort_multipart_upload, object_name, upload_id)
+            journal.remove(upload_id)
+            continue
+
+        logger.info(f'Resuming upload of {object_name} ({len(entry["parts"])} parts done)')
+        try:
+            await _upload_file_parts(entry, settings)
+        except Exception as e:
+            logger.error(e)
+            continue
+        resumed += 1
+        if callback is not None:
+            await callback(entry)
+    return resumed
+
+
+async def abort_stale_uploads(max_age=STALE_UPLOAD_MAX_AGE):
+    """Abort multipart uploads that are not in the journal and older than max_age hours.
+
+    :return: Number of aborted uploads
+    """
+    known = {entry['upload_id'] for entry in journal.entries()}
+    uploads = await aio.run(aio.METADATA, s3bucket.list_multipart_uploads)
+    threshold = datetime.now(timezone.utc) - timedelta(hours=max_age)
+    aborted = 0
+    for upload in uploads:
+        if upload['UploadId'] in known or upload['Initiated'] > threshold:
+            continue
+        logger.info(f'Aborting stale multipart upload of {upload["Key"]}')
+        await aio.run(aio.UPLOAD, s3bucket.abort_multipart_upload, upload['Key'], upload['UploadId'])
+        aborted += 1
+    return aborted
+
+
+@tracing.traced('transfer.stream_upload')
+async def stream_upload(chunks, object_name, mime_type=None, acl=None, settings=DEFAULT_SETTINGS, progress=None,
+                        meta=None, content_encoding=None, size=None):
+    """Upload an async stream of bytes to S3.
+
+    Streams smaller than a single part are sent with one PUT request. Larger streams are sent as a
+    multipart upload with up to settings.max_concurrency parts in flight, keeping at most
+    settings.max_buffers parts in memory. Parts may differ in size, so the part size of streams of
+    unknown size doubles every PART_SIZE_GROWTH_INTERVAL parts.
+
+    :param chunks: Async iterable of bytes
+    :param object_name: S3 object name
+    :param mime_type: File mime type
+    :param acl: ACL specifying access rules for the object
+    :param settings: Transfer settings
+    :param progress: Optional callable receiving the number of bytes sent since the last call
+    :param meta: JSON-serializable data stored in the journal
+    :param content_encoding: Content-Encoding of the stream, e.g. gzip
+    :param size: Size of the stream, or an upper bound of it, if known, to pick the part size
+    """
+    settings = settings.for_size(size)
+    part_size = settings.part_size
+    limiter = BandwidthLimiter(settings.max_bandwidth) if settings.max_bandwidth else None
+    slots = asyncio.Semaphore(settings.max_concurrency)
+    buffer = bytearray()
+    upload_id = None
+    part_number = 0
+    parts = []
+    pending = set()
+    received = 0
+
+    async def send_part(number, body):
+        # The span includes the wait for a slot and for bandwidth
+        with tracing.span('transfer.upload_part', **{'part.number': number, 'part.bytes': len(body)}):
+            async with slots:
+                if limiter is not None:
+                    await limiter.consume(len(body))
+                etag = await aio.run(aio.UPLOAD, s3bucket.upload_part, object_name, upload_id, number, body)
+        parts.append((number, etag))
+        if progress is not None:
+            progress(len(body))
+
+    async def submit_part(body):
+        nonlocal pending, part_number
+        if len(pending) >= settings.max_buffers:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                # Surface failed parts right away instead of after the whole stream is read
+                task.result()
+        part_number += 1
+        pending.add(asyncio.create_task(send_part(part_number, body)))
+
+    try:
+        async for chunk in chunks:
+            received += len(chunk)
+            buffer += chunk
+            while len(buffer) >= part_size:
+                if upload_id is None:
+                    upload_id = await aio.run(aio.UPLOAD, s3bucket.create_multipart_upload,
+                                              object_name, mime_type, acl, content_encoding)
+                    # Streams cannot be resumed, the entry only lets the next start abort the upload
+                    journal.save(_new_journal_entry(upload_id, object_name, None, None, part_size,
+                                                    mime_type, acl, meta))
+                body = bytes(buffer[:part_size])
+                del buffer[:part_size]
+                await submit_part(body)
+                if size is None and part_number % PART_SIZE_GROWTH_INTERVAL == 0:
+                    part_size = min(part_size * 2, MAX_PART_SIZE)
+
+        tracing.set_attributes(**{'s3.key': object_name, 'upload.bytes': received})
+        if upload_id is None:
+            await aio.run(aio.UPLOAD, s3bucket.put_object, object_name, bytes(buffer), mime_type, acl,
+                          content_encoding)
+            if progress is not None:
+                progress(len(buffer))
+            return
+
+        if len(buffer) > 0:
+            await submit_part(bytes(buffer))
+        tracing.set_attributes(**{'upload.parts': part_number})
+        if pending:
+            await asyncio.gather(*pending)
+        await aio.run(aio.UPLOAD, s3bucket.complete_multipart_upload, object_name, upload_id, parts)
+    except BaseException:
+        for task in pending:
+            task.cancel()
+        if upload_id is not None:
+            logger.warning(f'Aborting multipart upload of {object_name}')
+            await aio.run(aio.UPLOAD, s3bucket.abort_multipart_upload, object_name, upload_id)
+            journal.remove(upload_id)
+        raise
+    journal.remove(upload_id)
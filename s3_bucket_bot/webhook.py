@@ -0,0 +1,148 @@
+"""Receive updates with a webhook instead of long polling.
+
+Telegram posts every update to TELEGRAM_WEBHOOK_URL, which has to be reachable over HTTPS, usually
+through a reverse proxy or load balancer that terminates TLS and forwards to the built-in HTTP
+server. The local Bot API server also accepts plain HTTP webhook URLs.
+
+Albums being collected, /list pages and pending /delete confirmations live in the memory of the
+process that received the update, so only one instance may receive the updates at a time. Several
+instances behind a load balancer only work as failover, e.g. active/passive or sticky to one backend.
+
+Application.run_webhook() of python-telegram-bot is not used: it requires tornado and serves nothing
+but the webhook, while the bot serves /healthz and /metrics on the same port. Like run_webhook(),
+the webhook is left set on exit: Telegram keeps the updates sent meanwhile for the restarted or the
+standby instance, and run_polling() deletes it when switching back to polling.
+
+@see https://core.telegram.org/bots/api#setwebhook
+"""
+import os
+import hmac
+import signal
+import asyncio
+import logging
+from http import HTTPStatus
+from urllib.parse import urlparse
+
+from telegram import Update
+from telegram.ext import Application
+
+from . import metrics
+from .httpserver import HTTPServer, HTTPError, Response, HTTP_PORT
+
+logger = logging.getLogger(__name__)
+
+# Webhook mode is enabled by setting the public URL Telegram posts updates to, e.g. https://bot.example.com/telegram
+TELEGRAM_WEBHOOK_URL = os.getenv('TELEGRAM_WEBHOOK_URL')
+# Required, checked against the X-Telegram-Bot-Api-Secret-Token header of every update.
+# It is set on the webhook by every instance, so all of them have to share it.
+TELEGRAM_WEBHOOK_SECRET = os.getenv('TELEGRAM_WEBHOOK_SECRET')
+# Public key certificate to upload when the webhook endpoint uses a self-signed certificate
+TELEGRAM_WEBHOOK_CERT = os.getenv('TELEGRAM_WEBHOOK_CERT')
+# Maximum number of simultaneous connections Telegram opens to deliver updates (1-100)
+TELEGRAM_WEBHOOK_MAX_CONNECTIONS = int(os.getenv('TELEGRAM_WEBHOOK_MAX_CONNECTIONS') or 40)
+TELEGRAM_WEBHOOK_DROP_PENDING = os.getenv('TELEGRAM_WEBHOOK_DROP_PENDING') == '1'
+
+SECRET_TOKEN_HEADER = 'x-telegram-bot-api-secret-token'
+HEALTH_PATH = '/healthz'
+METRICS_PATH = '/metrics'
+
+
+def is_enabled():
+    return bool(TELEGRAM_WEBHOOK_URL)
+
+
+def is_server_enabled():
+    """The HTTP server runs in webhook mode, or in polling mode when HTTP_PORT is set."""
+    return is_enabled() or HTTP_PORT > 0
+
+
+def get_webhook_path():
+    return urlparse(TELEGRAM_WEBHOOK_URL).path or '/'
+
+
+def check_webhook_config(local_api=False):
+    """Telegram only delivers webhooks over HTTPS, the local Bot API server also over HTTP.
+
+    :raise ValueError: If the URL cannot be used or the secret token is missing
+    """
+    scheme = urlparse(TELEGRAM_WEBHOOK_URL).scheme
+    if scheme != 'https' and not (scheme == 'http' and local_api):
+        raise ValueError(f'TELEGRAM_WEBHOOK_URL must be an https:// URL, got {TELEGRAM_WEBHOOK_URL}')
+    if not TELEGRAM_WEBHOOK_SECRET:
+        raise ValueError('TELEGRAM_WEBHOOK_SECRET must be set in webhook mode')
+
+
+def create_server(application: Application, secret_token=None) -> HTTPServer:
+    """Create the HTTP server with the health and metrics endpoints, and the webhook endpoint in webhook mode."""
+    server = HTTPServer()
+
+    async def health(request):
+        status = HTTPStatus.OK if application.running else HTTPStatus.SERVICE_UNAVAILABLE
+        return Response.json({'status': 'ok' if application.running else 'starting',
+                              'mode': 'webhook' if is_enabled() else 'polling'}, status)
+
+    async def receive_update(request):
+        token = request.headers.get(SECRET_TOKEN_HEADER, '')
+        if not hmac.compare_digest(token.encode(), secret_token.encode()):
+            logger.warning(f'Rejected an update from {request.client} with an invalid secret token')
+            raise HTTPError(HTTPStatus.FORBIDDEN)
+        update = Update.de_json(request.json(), application.bot)
+        # Reply right away, the update is processed in the background
+        await application.update_queue.put(update)
+        return Response()
+
+    server.route('GET', HEALTH_PATH, health)
+    server.route('GET', METRICS_PATH, metrics.metrics_endpoint)
+    if is_enabled():
+        server.route('POST', get_webhook_path(), receive_update)
+    return server
+
+
+async def _run(application: Application):
+    secret_token = TELEGRAM_WEBHOOK_SECRET
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+
+    server = create_server(application, secret_token)
+    await application.initialize()
+    try:
+        if application.post_init:
+            await application.post_init(application)
+        await server.start()
+        await application.start()
+
+        certificate = open(TELEGRAM_WEBHOOK_CERT, 'rb') if TELEGRAM_WEBHOOK_CERT else None
+        try:
+            await application.bot.set_webhook(TELEGRAM_WEBHOOK_URL,
+                                              certificate=certificate,
+                                              max_connections=TELEGRAM_WEBHOOK_MAX_CONNECTIONS,
+                                              allowed_updates=Update.ALL_TYPES,
+                                              drop_pending_updates=TELEGRAM_WEBHOOK_DROP_PENDING,
+                                              secret_token=secret_token)
+        finally:
+            if certificate is not None:
+                certificate.close()
+        logger.info(f'Receiving updates at {TELEGRAM_WEBHOOK_URL}')
+
+        await stop.wait()
+    finally:
+        # The webhook is left in place, see the module docstring
+        await server.stop()
+        if application.running:
+            await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+
+def run_webhook(application: Application, local_api=False):
+    """Serve the webhook until SIGINT or SIGTERM, as a replacement for Application.run_polling().
+
+    Runs the post_init, post_stop and post_shutdown callbacks like run_polling() does.
+    """
+    check_webhook_config(local_api)
+    asyncio.run(_run(application))
@@ -0,0 +1,149 @@
+"""Worker process running the jobs queued by the bot.
+
+Run as many as needed on the host of the bot, sharing its STATE_PATH: python -m s3_bucket_bot.worker
+The queue is a SQLite database in WAL mode, which does not work over network file systems (NFS, SMB),
+so workers scale transfers on a single host only.
+"""
+import os
+import time
+import signal
+import socket
+import asyncio
+import logging
+
+import httpx
+import botocore.exceptions
+from telegram.error import BadRequest, NetworkError, RetryAfter
+from telegram.ext import ExtBot
+
+from . import aio, cdn, images, metrics, ratelimit, tracing
+from .bot import JOB_HANDLERS, TELEGRAM_API_TOKEN, TELEGRAM_BASE_URL, TELEGRAM_BASE_FILE_URL, create_rate_limiter
+from .dedup import dedup_index
+from .inventory import inventory
+from .httpserver import HTTPServer, HTTP_PORT
+from .jobs import job_queue, JOB_POLL_INTERVAL, FAILED
+from .transfer import close_http_client
+
+logger = logging.getLogger(__name__)
+
+# Number of jobs run at the same time by one worker process
+JOB_WORKER_CONCURRENCY = int(os.getenv('JOB_WORKER_CONCURRENCY') or 4)
+
+
+def is_transient(error):
+    """Whether a failed job may succeed when run again: network errors, throttling and server errors.
+
+    Anything else, e.g. an unknown job kind, a missing source or an invalid argument, fails the same way every time.
+    """
+    if isinstance(error, BadRequest):
+        return False
+    if isinstance(error, (RetryAfter, NetworkError, httpx.TransportError, ConnectionError, TimeoutError,
+                          botocore.exceptions.ConnectionError, botocore.exceptions.HTTPClientError)):
+        return True
+    if isinstance(error, httpx.HTTPStatusError):
+        status = error.response.status_code
+        return status >= 500 or status in (408, 429)
+    if isinstance(error, botocore.exceptions.ClientError):
+        status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode') or 0
+        code = error.response.get('Error', {}).get('Code')
+        return status >= 500 or status in (408, 429) or code in ratelimit.S3_THROTTLING_CODES
+    return False
+
+
+async def heartbeat(job):
+    """Keep the lease of a job and publish its progress while it runs."""
+    while True:
+        progress = job.progress() if job.progress is not None else None
+        await aio.run(aio.METADATA, job_queue.heartbeat, job.id, progress)
+        await asyncio.sleep(min(job_queue.lease_timeout / 3, 5))
+
+
+async def run_job(bot, job):
+    logger.info(f'Running {job.kind} job {job.id} (attempt {job.attempts})')
+    handler = JOB_HANDLERS.get(job.kind)
+    beating = asyncio.create_task(heartbeat(job))
+    start = time.monotonic()
+    try:
+        if handler is None:
+            raise ValueError(f'Unknown job kind: {job.kind}')
+        with tracing.span(f'job.{job.kind}', tracing.SPAN_KIND_CONSUMER, parent=job.payload.get('traceparent'),
+                          **{'job.id': job.id, 'job.attempt': job.attempts}):
+            result = await handler(bot, job)
+    except asyncio.CancelledError:
+        await aio.run(aio.METADATA, job_queue.release, job.id)
+        raise
+    except Exception as e:
+        logger.error(e)
+        status = await aio.run(aio.METADATA, job_queue.fail, job.id, e, job.attempts, is_transient(e))
+        metrics.JOB_DURATION.observe(time.monotonic() - start, kind=job.kind, status='failed')
+        if status != FAILED:
+            logger.info(f'Job {job.id} will be retried')
+        return
+    finally:
+        beating.cancel()
+    await aio.run(aio.METADATA, job_queue.complete, job.id, result)
+    metrics.JOB_DURATION.observe(time.monotonic() - start, kind=job.kind, status='done')
+    logger.info(f'Finished {job.kind} job {job.id}')
+
+
+async def work(bot, name, stop):
+    """Claim and run jobs one at a time until stopped."""
+    while not stop.is_set():
+        job = await aio.run(aio.METADATA, job_queue.claim, name)
+        if job is None:
+            try:
+                await asyncio.wait_for(stop.wait(), JOB_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        await run_job(bot, job)
+
+
+async def run_workers(concurrency=JOB_WORKER_CONCURRENCY):
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+
+    kwargs = {}
+    if TELEGRAM_BASE_URL:
+        kwargs['base_url'] = TELEGRAM_BASE_URL
+    if TELEGRAM_BASE_FILE_URL:
+        kwargs['base_file_url'] = TELEGRAM_BASE_FILE_URL
+    name = f'{socket.gethostname()}:{os.getpid()}'
+    async with ExtBot(TELEGRAM_API_TOKEN, rate_limiter=create_rate_limiter(), **kwargs) as bot:
+        if cdn.CDN_AUTO_PURGE and cdn.is_available():
+            cdn.purge_queue.start()
+        server = None
+        if HTTP_PORT:
+            server = HTTPServer()
+            server.route('GET', '/metrics', metrics.metrics_endpoint)
+            await server.start()
+        logger.info(f'Worker {name} running {concurrency} jobs at a time')
+        tasks = [asyncio.create_task(work(bot, f'{name}/{i}', stop)) for i in range(concurrency)]
+        try:
+            await stop.wait()
+        finally:
+            # Running jobs are put back in the queue for the next worker
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if server is not None:
+                await server.stop()
+            await close_http_client()
+            await cdn.purge_queue.stop()
+            await cdn.close_http_client()
+            dedup_index.close()
+            inventory.close()
+            job_queue.close()
+            aio.shutdown()
+            images.shutdown()
+            tracing.shutdown()
+
+
+def main():
+    asyncio.run(run_workers())
+
+
+if __name__ == '__main__':
+    main()
@@ -20,14 +20,19 @@ COMMANDS = [
     BotCommand("start", "Start the bot"),
     BotCommand("help", "Show help message"),
     BotCommand("exist", "Check if file exists"),
-    BotCommand("delete", "Delete a file from S3"),
+    BotCommand("delete", "Delete files: /delete PATH... or /delete PREFIX*"),
     BotCommand("make_public", "Make file publicly accessible"),
     BotCommand("make_private", "Make file private"),
-    BotCommand("copy_file", "Copy file: /copy_file src dest"),
+    BotCommand("copy_file", "Copy file or folder: /copy_file src dest"),
+    BotCommand("move", "Move file or folder: /move src dest"),
+    BotCommand("sync", "Reply to an archive: /sync PREFIX [--delete]"),
     BotCommand("list", "List objects: /list PREFIX [LIMIT]"),
+    BotCommand("find", "Find objects by glob pattern: /find PATTERN"),
+    BotCommand("du", "Size of a prefix: /du [PREFIX]"),
     BotCommand("get_file_acl", "Get file ACL status"),
     BotCommand("get_meta", "Get object metadata"),
-    BotCommand("purge_cache", "Purge CDN cache (DigitalOcean)"),
+    BotCommand("presign", "Temporary link: /presign PATH [TTL] [--put|--post]"),
+    BotCommand("purge_cache", "Purge CDN cache (DigitalOcean): /purge_cache PATH..."),
 ]
 
 
@@ -0,0 +1,224 @@
+"""
+Unit tests for the bot helpers, runnable without S3 credentials.
+
+Run with: python -m unittest tests.test_bot -v
+"""
+
+import asyncio
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from s3_bucket_bot import bot
+
+
+def make_listing():
+    return {'id': 'abcd1234', 'prefix': 'tests/', 'limit': 50, 'positions': [None]}
+
+
+def make_entries(count, key_length=90):
+    return [{'key': f'tests/{i:04d}-'.ljust(key_length, 'x')} for i in range(count)]
+
+
+class TestParsing(unittest.TestCase):
+    """Tests for the parsing of captions and command arguments."""
+
+    def test_parse_caption(self):
+        self.assertEqual(bot.parse_caption('videos/ --part-size=64M --concurrency=8'),
+                         ('videos/', {'part-size': '64M', 'concurrency': '8'}))
+        self.assertEqual(bot.parse_caption(' photos/cat.jpg '), ('photos/cat.jpg', {}))
+        self.assertEqual(bot.parse_caption('site/ --extract'), ('site/', {'extract': ''}))
+
+    def test_unknown_options_are_part_of_the_name(self):
+        """Test that a caption ending with something that looks like an option is still a file name."""
+        self.assertEqual(bot.parse_caption('report --final.pdf'), ('report --final.pdf', {}))
+        self.assertEqual(bot.parse_caption('a --b --compress=br'), ('a --b', {'compress': 'br'}))
+        self.assertEqual(bot.parse_caption('--put --max-size=1M', known_options=None),
+                         ('', {'put': '', 'max-size': '1M'}))
+
+    def test_parse_duration(self):
+        self.assertEqual(bot.parse_duration('90'), 90)
+        self.assertEqual(bot.parse_duration('15m'), 900)
+        self.assertEqual(bot.parse_duration('2H'), 7200)
+        self.assertEqual(bot.parse_duration('7d'), 604800)
+        for value in ('', 'm', '1.5h', '3w', '-1'):
+            with self.subTest(value=value):
+                with self.assertRaises(ValueError):
+                    bot.parse_duration(value)
+
+
+class TestRenderListPage(unittest.TestCase):
+    """Tests for the pages of /list."""
+
+    def test_page_fits(self):
+        """Test that a page fitting in a message shows every entry and keeps the next position."""
+        listing = make_listing()
+        entries = make_entries(3)
+
+        text, reply_markup = bot.render_list_page(listing, 0, entries, 'token')
+
+        self.assertEqual(len(text.splitlines()), 4)
+        self.assertEqual(listing['positions'], [None, entries[-1]['key']])
+        self.assertEqual(reply_markup.inline_keyboard[0][0].text, 'Next »')
+
+    def test_last_page(self):
+        """Test that the last page has no next button."""
+        listing = make_listing()
+
+        text, reply_markup = bot.render_list_page(listing, 0, make_entries(3), None)
+
+        self.assertIsNone(reply_markup)
+        self.assertEqual(listing['positions'], [None])
+
+    def test_truncated_page_continues_after_last_shown_key(self):
+        """Test that entries not fitting in a message are shown on the next page instead of being lost."""
+        listing = make_listing()
+        entries = make_entries(50, key_length=200)
+
+        text, reply_markup = bot.render_list_page(listing, 0, entries, None)
+
+        self.assertLessEqual(len(text), bot.MAX_MESSAGE_LENGTH)
+        shown = len(text.splitlines()) - 1
+        self.assertLess(shown, len(entries))
+        self.assertEqual(listing['positions'], [None, entries[shown - 1]['key']])
+        self.assertIn(entries[shown - 1]['key'], text)
+        self.assertNotIn(entries[shown]['key'], text)
+        self.assertEqual(reply_markup.inline_keyboard[0][0].text, 'Next »')
+
+    def test_revisited_page_keeps_positions(self):
+        """Test that going back to a page does not change the positions of the following pages."""
+        listing = make_listing()
+        listing['positions'] = [None, 'tests/a', 'tests/b']
+
+        _, reply_markup = bot.render_list_page(listing, 1, make_entries(3), 'token')
+
+        self.assertEqual(listing['positions'], [None, 'tests/a', 'tests/b'])
+        self.assertEqual([button.text for button in reply_markup.inline_keyboard[0]], ['« Prev', 'Next »'])
+
+    def test_reduced_limit_is_reported(self):
+        """Test that /list tells the user when their limit is above LIST_PAGE_MAX_SIZE."""
+        limits = []
+
+        async def list_files_page(prefix, limit):
+            limits.append(limit)
+            return make_entries(3), None
+
+        def run(limit):
+            message = SimpleNamespace(reply_text=mock.AsyncMock())
+            update = SimpleNamespace(effective_message=message)
+            context = SimpleNamespace(args=['tests/', limit], chat_data={})
+            asyncio.run(bot.list_files(update, context))
+            return message.reply_text.await_args.kwargs['text'].splitlines()[0]
+
+        with mock.patch.object(bot, 'LIST_PAGE_MAX_SIZE', 50), \
+                mock.patch.object(bot, 's3_list_files_page', list_files_page):
+            self.assertEqual(run('1000'), 'Page 1 (limit reduced to 50 per page)')
+            self.assertEqual(run('20'), 'Page 1')
+        self.assertEqual(limits, [50, 20])
+
+
+class TestCopyOrMovePaths(unittest.TestCase):
+    """Tests for the checks made before copying or moving, without S3 calls."""
+
+    def test_move_onto_itself_is_refused(self):
+        """Test that a file is not moved onto itself, which would delete it."""
+        text = asyncio.run(bot.copy_or_move_paths('photos/cat.jpg', 'photos/cat.jpg', move=True))
+
+        self.assertIn('the same', text)
+
+    def test_move_prefix_onto_itself_is_refused(self):
+        text = asyncio.run(bot.copy_or_move_paths('photos/', 'photos/', move=True))
+
+        self.assertIn('the same', text)
+
+
+def make_album_message(message_id, caption=None):
+    return SimpleNamespace(media_group_id='album', message_id=message_id, caption=caption,
+                           reply_text=mock.AsyncMock())
+
+
+class TestMediaGroups(unittest.TestCase):
+    """Tests for the collection of albums, without S3 calls."""
+
+    def test_album_is_collected_until_no_item_arrives(self):
+        """Test that items arriving within MEDIA_GROUP_WAIT of each other are uploaded together, in order."""
+        uploaded = []
+
+        async def upload_media_group(messages):
+            uploaded.append([message.message_id for message in messages])
+
+        async def run():
+            first = asyncio.create_task(bot.collect_media_group(make_album_message(3)))
+            for message_id in (1, 2):
+                # Each item arrives before the previous wait is over, extending the collection
+                await asyncio.sleep(0.15)
+                await bot.collect_media_group(make_album_message(message_id))
+            await first
+            # A later item is a new album
+            await bot.collect_media_group(make_album_message(4))
+
+        with mock.patch.object(bot, 'MEDIA_GROUP_WAIT', 0.2), \
+                mock.patch.object(bot, 'upload_media_group', upload_media_group):
+            asyncio.run(run())
+
+        self.assertEqual(uploaded, [[1, 2, 3], [4]])
+        self.assertEqual(bot._media_groups, {})
+
+    def test_folder_caption_of_any_item(self):
+        """Test that a folder caption on any item of an album applies to the items without a caption."""
+        messages = [make_album_message(1), make_album_message(2, 'photos/'), make_album_message(3, 'cat.jpg')]
+        prefixes = []
+
+        async def prepare_upload(message, default_prefix=None):
+            prefixes.append(default_prefix)
+            return SimpleNamespace(extract=None, file_name=message.caption or f'{default_prefix}{message.message_id}')
+
+        async def transfer_upload(upload):
+            return upload.file_name
+
+        with mock.patch.object(bot, 'JOB_QUEUE_ENABLED', False), \
+                mock.patch.object(bot, 'prepare_upload', prepare_upload), \
+                mock.patch.object(bot, 'transfer_upload', transfer_upload):
+            asyncio.run(bot.upload_media_group(messages))
+
+        self.assertEqual(prefixes, ['photos/'] * 3)
+        messages[0].reply_text.assert_awaited_once_with(text='photos/1\nphotos/\ncat.jpg')
+
+
+def make_job_item(file_name):
+    return {'file_id': f'id-{file_name}', 'file_size': 10, 'file_name': file_name, 'mime_type': 'text/plain',
+            'settings': {}, 'extract': None}
+
+
+class TestRunUploadJob(unittest.TestCase):
+    """Tests for upload jobs run again after an interruption, without S3 calls."""
+
+    def test_resumed_items_are_not_uploaded_again(self):
+        """Test that an item whose multipart upload was resumed is finished instead of uploaded again."""
+        job = SimpleNamespace(id=7, payload={'items': [make_job_item('a.bin'), make_job_item('b.bin')]},
+                              progress=None)
+
+        async def resume_uploads(callback=None, match=None):
+            entry = {'object_name': 'b.bin', 'meta': {'job_id': 7, 'item': 1}}
+            self.assertTrue(match(entry))
+            self.assertFalse(match({'object_name': 'b.bin', 'meta': {'job_id': 8, 'item': 1}}))
+            await callback(entry)
+            return 1
+
+        async def get_file(file_id):
+            return SimpleNamespace(file_id=file_id)
+
+        transfer_upload = mock.AsyncMock(return_value='uploaded')
+        finish_resumed_upload = mock.AsyncMock(return_value='resumed')
+        with mock.patch.object(bot, 'resume_uploads', resume_uploads), \
+                mock.patch.object(bot, 'transfer_upload', transfer_upload), \
+                mock.patch.object(bot, 'finish_resumed_upload', finish_resumed_upload):
+            result = asyncio.run(bot.run_upload_job(SimpleNamespace(get_file=get_file), job))
+
+        self.assertEqual(result, 'uploaded\nresumed')
+        self.assertEqual([call.args[0].file_name for call in transfer_upload.await_args_list], ['a.bin'])
+        self.assertEqual(transfer_upload.await_args.kwargs, {'job_id': 7, 'job_item': 0})
+        self.assertEqual(finish_resumed_upload.await_args.args[0].file_name, 'b.bin')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+"""
+Unit tests for the TTL cache, runnable without S3 credentials.
+
+Run with: python -m unittest tests.test_cache -v
+"""
+
+import unittest
+from unittest import mock
+
+from s3_bucket_bot import cache
+from s3_bucket_bot.cache import TTLCache, MISSING
+
+
+class TestTTLCache(unittest.TestCase):
+    """Tests for expiry, eviction and the MISSING sentinel."""
+
+    def setUp(self):
+        self.now = 1000.0
+        patch = mock.patch.object(cache.time, 'monotonic', lambda: self.now)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_get_and_set(self):
+        ttl_cache = TTLCache(60, 10)
+        ttl_cache.set('a', 1)
+        self.assertEqual(ttl_cache.get('a'), 1)
+        self.assertIs(ttl_cache.get('b'), MISSING)
+        self.assertEqual(ttl_cache.stats(), {'hits': 1, 'misses': 1, 'size': 1})
+
+    def test_none_is_cached(self):
+        """Test that None is a cached value, told apart from absent entries by MISSING."""
+        ttl_cache = TTLCache(60, 10)
+        ttl_cache.set('a', None)
+        self.assertIsNone(ttl_cache.get('a'))
+
+    def test_expiry(self):
+        ttl_cache = TTLCache(60, 10)
+        ttl_cache.set('a', 1)
+        self.now += 59
+        self.assertEqual(ttl_cache.get('a'), 1)
+        self.now += 2
+        self.assertIs(ttl_cache.get('a'), MISSING)
+        self.assertEqual(len(ttl_cache), 0)
+
+    def test_entry_ttl(self):
+        """Test that an entry TTL shortens the cache TTL but never extends it."""
+        ttl_cache = TTLCache(60, 10)
+        ttl_cache.set('short', 1, ttl=5)
+        ttl_cache.set('long', 2, ttl=600)
+        self.now += 6
+        self.assertIs(ttl_cache.get('short'), MISSING)
+        self.assertEqual(ttl_cache.get('long'), 2)
+        self.now += 60
+        self.assertIs(ttl_cache.get('long'), MISSING)
+
+    def test_lru_eviction(self):
+        """Test that the least recently used entry is evicted when the cache is full."""
+        ttl_cache = TTLCache(60, 2)
+        ttl_cache.set('a', 1)
+        ttl_cache.set('b', 2)
+        ttl_cache.get('a')
+        ttl_cache.set('c', 3)
+        self.assertEqual(ttl_cache.get('a'), 1)
+        self.assertIs(ttl_cache.get('b'), MISSING)
+        self.assertEqual(ttl_cache.get('c'), 3)
+        self.assertEqual(len(ttl_cache), 2)
+
+    def test_delete_and_clear(self):
+        ttl_cache = TTLCache(60, 10)
+        ttl_cache.set('a', 1)
+        ttl_cache.set('b', 2)
+        ttl_cache.delete('a')
+        ttl_cache.delete('missing')
+        self.assertIs(ttl_cache.get('a'), MISSING)
+        ttl_cache.clear()
+        self.assertIs(ttl_cache.get('b'), MISSING)
+
+    def test_disabled(self):
+        for ttl, max_size in [(0, 10), (60, 0)]:
+            with self.subTest(ttl=ttl, max_size=max_size):
+                ttl_cache = TTLCache(ttl, max_size)
+                ttl_cache.set('a', 1)
+                self.assertFalse(ttl_cache.enabled)
+                self.assertIs(ttl_cache.get('a'), MISSING)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+"""
+Unit tests for CDN cache purging, runnable without DigitalOcean credentials.
+
+Run with: python -m unittest tests.test_cdn -v
+"""
+
+import asyncio
+import unittest
+from unittest import mock
+
+import httpx
+
+from s3_bucket_bot import cdn
+
+
+class TestCoalescePaths(unittest.TestCase):
+    """Tests for the deduplication of purged paths."""
+
+    def test_duplicates_and_slashes(self):
+        self.assertEqual(cdn.coalesce_paths(['/a.png', 'a.png', ' b.png ', '']), ['a.png', 'b.png'])
+
+    def test_wildcard_covers_paths(self):
+        """Test that a wildcard drops the paths and the narrower wildcards under it."""
+        paths = ['images/a.png', 'images/2024/*', 'images/*', 'imagesx.png', 'other/b.png']
+
+        self.assertEqual(cdn.coalesce_paths(paths), ['images/*', 'imagesx.png', 'other/b.png'])
+
+
+class TestEndpointLookup(unittest.TestCase):
+    """Tests for finding the CDN endpoint of the bucket."""
+
+    ORIGIN = 'bucket.ams3.digitaloceanspaces.com'
+
+    def lookup(self, pages):
+        """Look up the endpoint id with the API answering pages, a dict of endpoint lists by page number."""
+        requests = []
+
+        def handler(request):
+            requests.append(request.url)
+            page = int(request.url.params.get('page', 1))
+            data = {'endpoints': pages[page], 'links': {}}
+            if page < len(pages):
+                data['links'] = {'pages': {'next': f'https://api.example.com/v2/cdn/endpoints?page={page + 1}&per_page=200'}}
+            return httpx.Response(200, json=data)
+
+        async def run():
+            async with httpx.AsyncClient(base_url='https://api.example.com/v2',
+                                         transport=httpx.MockTransport(handler)) as client:
+                with mock.patch.object(cdn, 'get_http_client', lambda: client):
+                    return await cdn.get_endpoint_id()
+
+        with mock.patch.object(cdn, '_endpoint', None), \
+                mock.patch.object(cdn, 'get_origin', lambda: self.ORIGIN):
+            return asyncio.run(run()), requests
+
+    def test_first_page(self):
+        endpoint_id, requests = self.lookup({1: [{'id': 'a', 'origin': self.ORIGIN}], 2: []})
+        self.assertEqual(endpoint_id, 'a')
+        self.assertEqual(len(requests), 1)
+
+    def test_follows_next_page(self):
+        """Test that the lookup follows links.pages.next when the endpoint is not on the first page."""
+        pages = {1: [{'id': 'a', 'origin': 'other.example.com'}], 2: [], 3: [{'id': 'c', 'origin': self.ORIGIN}]}
+
+        endpoint_id, requests = self.lookup(pages)
+        self.assertEqual(endpoint_id, 'c')
+        self.assertEqual([url.params.get('page') for url in requests], [None, '2', '3'])
+
+    def test_not_found(self):
+        with self.assertRaises(cdn.CDNError):
+            self.lookup({1: [{'id': 'a', 'origin': 'other.example.com'}], 2: []})
+
+
+class TestPurgeQueue(unittest.TestCase):
+    """Tests for the background purge queue."""
+
+    def test_stop_during_backoff_keeps_paths(self):
+        """Test that the paths of a purge waiting to be retried are purged when the queue stops."""
+        purged = []
+
+        async def purge(paths):
+            if not purged:
+                purged.append(None)
+                raise cdn.CDNError('Temporary failure')
+            purged.append(sorted(paths))
+            return sorted(paths)
+
+        async def run():
+            queue = cdn.PurgeQueue(debounce=0, max_retries=5)
+            queue.start()
+            queue.enqueue(['a.png', 'b.png'])
+            # Let the first attempt fail, the retry then waits for at least half a second
+            while not purged:
+                await asyncio.sleep(0.01)
+            await queue.stop()
+
+        with mock.patch.object(cdn, 'purge', purge):
+            asyncio.run(run())
+
+        self.assertEqual(purged, [None, ['a.png', 'b.png']])
+
+
+if __name__ == '__main__':
+    unittest.main()
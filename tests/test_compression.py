@@ -0,0 +1,76 @@
+"""
+Unit tests for the precompressed variants of uploads, runnable without S3 credentials.
+
+Run with: python -m unittest tests.test_compression -v
+"""
+
+import gzip
+import asyncio
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from s3_bucket_bot import bot, compression
+from s3_bucket_bot.compression import GZIP, Compressors, choose_encodings, parse_encodings, variant_key
+from s3_bucket_bot.transfer import TransferSettings
+
+
+class TestEncodings(unittest.TestCase):
+    """Tests for the choice of the compressed variants."""
+
+    def test_parse_encodings(self):
+        self.assertEqual(parse_encodings('gzip'), (GZIP,))
+        self.assertEqual(parse_encodings('gz,gzip'), (GZIP,))
+        self.assertEqual(parse_encodings('off'), ())
+        with self.assertRaises(ValueError):
+            parse_encodings('gzip,zstd')
+
+    def test_choose_encodings(self):
+        self.assertEqual(choose_encodings((GZIP,), 'text/css', 4096), (GZIP,))
+        self.assertEqual(choose_encodings((GZIP,), 'image/jpeg', 4096), ())
+        self.assertEqual(choose_encodings((GZIP,), 'application/json', 10), ())
+        self.assertEqual(choose_encodings((), 'text/css', 4096), ())
+
+    def test_variant_key(self):
+        self.assertEqual(variant_key('site/app.js', GZIP), 'site/app.js.gz')
+
+    def test_compressors(self):
+        data = b'body { margin: 0; }\n' * 1000
+        compressors = Compressors([GZIP])
+        compressors.compress(data[:100])
+        compressors.compress(data[100:])
+
+        compressed = compressors.finish()
+
+        self.assertEqual(gzip.decompress(compressed[GZIP]), data)
+
+
+class TestUploadCompressedVariants(unittest.TestCase):
+    """Tests for the upload of the variants next to the original, without S3 calls."""
+
+    def test_variants_keep_the_original(self):
+        """Test that the variants get their own key, the Content-Type of the original and a Content-Encoding."""
+        upload = bot.Upload(None, None, SimpleNamespace(file_size=4096), 'site/app.js', 'text/javascript',
+                            TransferSettings(compress=(GZIP,)))
+        put_object = mock.AsyncMock()
+        with mock.patch.object(bot, 's3_put_object', put_object), \
+                mock.patch.object(bot, 'schedule_purge') as schedule_purge:
+            lines = asyncio.run(bot.upload_compressed_variants(upload, (GZIP,), {GZIP: b'compressed'}))
+
+        put_object.assert_awaited_once_with('site/app.js.gz', b'compressed', 'text/javascript', 'public-read', GZIP)
+        schedule_purge.assert_called_once_with('site/app.js.gz')
+        self.assertEqual(len(lines), 1)
+        self.assertTrue(lines[0].endswith('site/app.js.gz'))
+
+    def test_failed_variant_is_reported(self):
+        upload = bot.Upload(None, None, SimpleNamespace(file_size=4096), 'site/app.js', 'text/javascript',
+                            TransferSettings(compress=(GZIP,)))
+        with mock.patch.object(bot, 's3_put_object', mock.AsyncMock(side_effect=OSError('gone'))), \
+                self.assertLogs(bot.logger, 'ERROR'):
+            lines = asyncio.run(bot.upload_compressed_variants(upload, (GZIP,), {GZIP: b'compressed'}))
+
+        self.assertEqual(lines, ['site/app.js.gz: gone'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+"""
+Unit tests for the dedup index, runnable without S3 credentials.
+
+Run with: python -m unittest tests.test_dedup -v
+"""
+
+import os
+import asyncio
+import hashlib
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from s3_bucket_bot import bot, s3bucket
+from s3_bucket_bot.dedup import DedupIndex, hash_file
+from s3_bucket_bot.transfer import TransferSettings
+
+
+class TestDedupIndex(unittest.TestCase):
+    """Tests for the index of uploaded files."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.index = DedupIndex(os.path.join(self.tmp_dir.name, 'dedup.sqlite3'))
+
+    def tearDown(self):
+        self.index.close()
+        self.tmp_dir.cleanup()
+
+    def test_lookup_by_file_unique_id(self):
+        """Test that a file is found by its file_unique_id, most recent upload first."""
+        self.index.record('file1', 'a.txt', '"etag"', 10)
+        self.index.record('file1', 'b.txt', '"etag"', 10)
+        self.index.record('file2', 'c.txt', '"other"', 20)
+
+        self.assertEqual([record['key'] for record in self.index.lookup('file1')], ['b.txt', 'a.txt'])
+
+    def test_lookup_by_content_hash(self):
+        """Test that a file is found by its content hash, whatever its file_unique_id."""
+        self.index.record('file1', 'a.txt', '"etag"', 10, 'hash1')
+        self.index.record('file2', 'b.txt', '"other"', 20, 'hash2')
+
+        records = self.index.lookup(content_hash='hash1')
+
+        self.assertEqual([(record['file_unique_id'], record['key']) for record in records], [('file1', 'a.txt')])
+
+    def test_forget(self):
+        self.index.record('file1', 'a.txt', '"etag"', 10)
+        self.index.forget('file1', 'a.txt')
+
+        self.assertEqual(self.index.lookup('file1'), [])
+
+    def test_hash_file(self):
+        path = os.path.join(self.tmp_dir.name, 'file.bin')
+        data = os.urandom(3 * 1024 * 1024 + 17)
+        with open(path, 'wb') as f:
+            f.write(data)
+
+        self.assertEqual(hash_file(path), hashlib.sha256(data).hexdigest())
+
+
+
+class TestReusedHeaders(unittest.TestCase):
+    """Tests for the checks of the headers and ACL of a reused object, without S3 calls."""
+
+    def setUp(self):
+        self.upload = bot.Upload(None, None, SimpleNamespace(file_unique_id='file1'), 'docs/a.txt', 'text/plain',
+                                 TransferSettings())
+        self.head = {'ETag': '"etag"', 'ContentType': 'text/plain', 'ContentLength': 10, 'Metadata': {}}
+
+    def check(self, head, acl='public-read'):
+        with mock.patch.object(bot, 's3_get_file_acl', mock.AsyncMock(return_value=acl)):
+            return asyncio.run(bot.has_upload_headers(self.upload, 'docs/b.txt', head))
+
+    def test_same_headers(self):
+        self.assertTrue(self.check(self.head))
+        # Storage providers without ACLs
+        self.assertTrue(self.check(self.head, acl=None))
+
+    def test_different_headers(self):
+        self.assertFalse(self.check(dict(self.head, ContentType='application/octet-stream')))
+        self.assertFalse(self.check(dict(self.head, CacheControl='no-cache')))
+        self.assertFalse(self.check(dict(self.head, Metadata={'owner': 'someone'})))
+
+    def test_private_object(self):
+        """Test that an object made private since is not reused by a public upload."""
+        self.assertFalse(self.check(self.head, acl='private'))
+
+    def test_cache_control_rule(self):
+        """Test that an object is reused only if it has the Cache-Control a rule gives to the new key."""
+        rules = [{'prefix': 'docs/', 'cache_control': 'public, max-age=60'}]
+        with mock.patch.object(s3bucket, 'CACHE_CONTROL_RULES', rules):
+            self.assertFalse(self.check(self.head))
+            self.assertTrue(self.check(dict(self.head, CacheControl='public, max-age=60')))
+
+
+if __name__ == '__main__':
+    unittest.main()
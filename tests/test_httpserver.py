@@ -0,0 +1,131 @@
+"""
+Unit tests for the built-in HTTP server, run on a local port.
+
+Run with: python -m unittest tests.test_httpserver -v
+"""
+
+import asyncio
+import unittest
+from http import HTTPStatus
+from unittest import mock
+
+from s3_bucket_bot import httpserver
+from s3_bucket_bot.httpserver import HTTPServer, Response
+
+
+async def echo(request):
+    return Response.json({'method': request.method, 'path': request.path, 'query': request.query,
+                          'body': request.body.decode(), 'client': request.client, 'scheme': request.scheme})
+
+
+async def fail(request):
+    raise RuntimeError('boom')
+
+
+class TestHTTPServer(unittest.IsolatedAsyncioTestCase):
+    """Tests for the request parser, the routing and keep-alive connections."""
+
+    async def asyncSetUp(self):
+        self.server = HTTPServer('127.0.0.1', 0)
+        self.server.route('POST', '/echo', echo)
+        self.server.route('GET', '/fail', fail)
+        await self.server.start()
+        self.port = self.server._server.sockets[0].getsockname()[1]
+
+    async def asyncTearDown(self):
+        await self.server.stop()
+
+    async def send(self, *requests):
+        """Send raw requests on one connection and read until the server closes it.
+
+        :return: Raw responses
+        """
+        reader, writer = await asyncio.open_connection('127.0.0.1', self.port)
+        try:
+            for request in requests:
+                writer.write(request)
+            await writer.drain()
+            return await asyncio.wait_for(reader.read(), 5)
+        finally:
+            writer.close()
+
+    def status(self, response):
+        return int(response.split(b' ', 2)[1])
+
+    async def test_request_is_parsed(self):
+        response = await self.send(b'POST /echo?a=1&a=2 HTTP/1.1\r\nContent-Length: 5\r\n'
+                                   b'X-Forwarded-For: 10.0.0.1, 10.0.0.2\r\nX-Forwarded-Proto: https\r\n'
+                                   b'Connection: close\r\n\r\nhello')
+
+        self.assertEqual(self.status(response), HTTPStatus.OK)
+        self.assertIn(b'"query": {"a": ["1", "2"]}', response)
+        self.assertIn(b'"body": "hello"', response)
+        self.assertIn(b'"client": "10.0.0.1"', response)
+        self.assertIn(b'"scheme": "https"', response)
+
+    async def test_keep_alive(self):
+        """Test that several requests are answered on one HTTP/1.1 connection."""
+        response = await self.send(b'POST /echo HTTP/1.1\r\nContent-Length: 1\r\n\r\na',
+                                   b'POST /echo HTTP/1.1\r\nContent-Length: 1\r\nConnection: close\r\n\r\nb')
+
+        self.assertEqual(response.count(b'HTTP/1.1 200 OK'), 2)
+        self.assertIn(b'Connection: keep-alive', response)
+
+    async def test_http_1_0_closes(self):
+        response = await self.send(b'POST /echo HTTP/1.0\r\nContent-Length: 0\r\n\r\n')
+
+        self.assertIn(b'Connection: close', response)
+
+    async def test_routing_errors(self):
+        self.assertEqual(self.status(await self.send(b'GET /missing HTTP/1.1\r\nConnection: close\r\n\r\n')),
+                         HTTPStatus.NOT_FOUND)
+        self.assertEqual(self.status(await self.send(b'GET /echo HTTP/1.1\r\nConnection: close\r\n\r\n')),
+                         HTTPStatus.METHOD_NOT_ALLOWED)
+        self.assertEqual(self.status(await self.send(b'GET /fail HTTP/1.1\r\nConnection: close\r\n\r\n')),
+                         HTTPStatus.INTERNAL_SERVER_ERROR)
+
+    async def test_invalid_requests(self):
+        self.assertEqual(self.status(await self.send(b'GARBAGE\r\n\r\n')), HTTPStatus.BAD_REQUEST)
+        self.assertEqual(self.status(await self.send(b'POST /echo HTTP/1.1\r\nContent-Length: x\r\n\r\n')),
+                         HTTPStatus.BAD_REQUEST)
+        self.assertEqual(self.status(await self.send(b'POST /echo HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n')),
+                         HTTPStatus.LENGTH_REQUIRED)
+        too_large = httpserver.HTTP_MAX_BODY_SIZE + 1
+        self.assertEqual(self.status(await self.send(f'POST /echo HTTP/1.1\r\nContent-Length: {too_large}\r\n\r\n'
+                                                     .encode())),
+                         HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+        headers = b''.join(f'X-Header-{i}: {i}\r\n'.encode() for i in range(httpserver.MAX_HEADER_COUNT + 1))
+        self.assertEqual(self.status(await self.send(b'POST /echo HTTP/1.1\r\n' + headers + b'\r\n')),
+                         HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE)
+
+    async def test_long_lines(self):
+        long_value = b'x' * httpserver.MAX_LINE_LENGTH
+        self.assertEqual(self.status(await self.send(b'GET /' + long_value + b' HTTP/1.1\r\n\r\n')),
+                         HTTPStatus.REQUEST_URI_TOO_LONG)
+        self.assertEqual(self.status(await self.send(b'GET /echo HTTP/1.1\r\nX-Long: ' + long_value + b'\r\n\r\n')),
+                         HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE)
+
+    async def test_slow_client_is_disconnected(self):
+        """Test that a client sending its headers and body too slowly is disconnected."""
+        reader, writer = await asyncio.open_connection('127.0.0.1', self.port)
+        with mock.patch.object(httpserver, 'HTTP_REQUEST_TIMEOUT', 0.2):
+            writer.write(b'POST /echo HTTP/1.1\r\nContent-Length: 10\r\n\r\nhello')
+            await writer.drain()
+
+            self.assertEqual(await asyncio.wait_for(reader.read(), 5), b'')
+        writer.close()
+
+    async def test_stop_closes_idle_connections(self):
+        reader, writer = await asyncio.open_connection('127.0.0.1', self.port)
+        writer.write(b'POST /echo HTTP/1.1\r\nContent-Length: 0\r\n\r\n')
+        await writer.drain()
+        await reader.readuntil(b'{')
+
+        await asyncio.wait_for(self.server.stop(), 5)
+
+        self.assertEqual(self.server._connections, {})
+        writer.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
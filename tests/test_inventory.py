@@ -0,0 +1,109 @@
+"""
+Unit tests for the bucket inventory index, runnable without S3 credentials.
+
+Run with: python -m unittest tests.test_inventory -v
+"""
+
+import os
+import tempfile
+import unittest
+
+from s3_bucket_bot.inventory import Inventory, _glob_prefix, _prefix_range
+
+
+def entry(key, size):
+    return {'key': key, 'size': size, 'last_modified': '2024-01-01T00:00:00+00:00', 'etag': '"etag"'}
+
+
+class TestKeyRanges(unittest.TestCase):
+    """Tests for the translation of prefixes and glob patterns to key ranges."""
+
+    def test_prefix_range(self):
+        self.assertEqual(_prefix_range('photos/'), ('photos/', 'photos0'))
+        self.assertEqual(_prefix_range('a'), ('a', 'b'))
+        self.assertEqual(_prefix_range(''), ('', None))
+
+    def test_glob_prefix(self):
+        self.assertEqual(_glob_prefix('photos/*.jpg'), 'photos/')
+        self.assertEqual(_glob_prefix('photos/20?4/a.jpg'), 'photos/20')
+        self.assertEqual(_glob_prefix('photos/[ab].jpg'), 'photos/')
+        self.assertEqual(_glob_prefix('*.jpg'), '')
+        self.assertEqual(_glob_prefix('photos/a.jpg'), 'photos/a.jpg')
+
+
+class TestInventory(unittest.TestCase):
+    """Tests for the queries answered from the index."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.inventory = Inventory(os.path.join(self.tmp_dir.name, 'inventory.sqlite3'))
+        self.inventory.upsert([
+            entry('photos/2023/a.jpg', 100),
+            entry('photos/2024/b.jpg', 200),
+            entry('photos/2024/c.png', 300),
+            entry('photos/readme.txt', 10),
+            entry('photos0.jpg', 1000),
+            entry('videos/d.mp4', 5000),
+        ], synced_at=100)
+
+    def tearDown(self):
+        self.inventory.close()
+        self.tmp_dir.cleanup()
+
+    def test_find_star_matches_slashes(self):
+        entries, total = self.inventory.find('photos/*.jpg')
+
+        self.assertEqual(total, 2)
+        self.assertEqual([e['key'] for e in entries], ['photos/2023/a.jpg', 'photos/2024/b.jpg'])
+
+    def test_find_stays_in_prefix_range(self):
+        """Test that keys right after the range of the literal prefix are not matched."""
+        entries, total = self.inventory.find('photos*')
+
+        self.assertEqual(total, 5)
+        self.assertIn('photos0.jpg', [e['key'] for e in entries])
+        self.assertEqual(self.inventory.find('photos/*')[1], 4)
+
+    def test_find_limit(self):
+        entries, total = self.inventory.find('*', limit=2)
+
+        self.assertEqual(total, 6)
+        self.assertEqual([e['key'] for e in entries], ['photos/2023/a.jpg', 'photos/2024/b.jpg'])
+
+    def test_find_literal_key(self):
+        self.assertEqual(self.inventory.find('videos/d.mp4')[1], 1)
+        self.assertEqual(self.inventory.find('videos/d')[1], 0)
+
+    def test_usage_by_segment(self):
+        count, size, segments = self.inventory.usage('photos/')
+
+        self.assertEqual((count, size), (4, 610))
+        self.assertEqual(segments, [('2024/', 2, 500), ('2023/', 1, 100), ('', 1, 10)])
+
+    def test_usage_of_bucket(self):
+        count, size, segments = self.inventory.usage('')
+
+        self.assertEqual((count, size), (6, 6610))
+        self.assertEqual(segments[0], ('videos/', 1, 5000))
+
+    def test_usage_of_missing_prefix(self):
+        self.assertEqual(self.inventory.usage('music/'), (0, 0, []))
+
+    def test_deletes_and_sweep(self):
+        """Test that deletes apply right away and sweep drops the objects missing from a listing."""
+        self.inventory.mark_changed(['videos/d.mp4'], deleted=True)
+        self.inventory.upsert([entry('photos/readme.txt', 10)], synced_at=200)
+
+        self.assertEqual(self.inventory.sweep(200), 4)
+        self.assertEqual(self.inventory.usage(''), (1, 10, [('photos/', 1, 10)]))
+
+    def test_changed_keys(self):
+        self.inventory.mark_changed(['photos/new.jpg', 'photos/new.jpg'])
+
+        self.assertEqual(self.inventory.changed(), ['photos/new.jpg'])
+        self.inventory.remove_changed('photos/new.jpg')
+        self.assertEqual(self.inventory.changed(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
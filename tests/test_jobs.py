@@ -0,0 +1,106 @@
+"""
+Unit tests for the job queue, runnable without S3 credentials.
+
+Run with: python -m unittest tests.test_jobs -v
+"""
+
+import os
+import time
+import tempfile
+import unittest
+
+from s3_bucket_bot.jobs import JobQueue, PENDING, DONE, FAILED
+
+
+class TestJobQueue(unittest.TestCase):
+    """Tests for claiming, retrying and pruning jobs."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.queue = JobQueue(os.path.join(self.tmp_dir.name, 'jobs.sqlite3'), lease_timeout=60, max_attempts=3)
+
+    def tearDown(self):
+        self.queue.close()
+        self.tmp_dir.cleanup()
+
+    def test_claim_in_order(self):
+        first = self.queue.enqueue('upload', {'n': 1}, chat_id=1, message_id=10)
+        second = self.queue.enqueue('delete', {'n': 2})
+
+        job = self.queue.claim('worker')
+        self.assertEqual((job.id, job.kind, job.payload, job.attempts), (first, 'upload', {'n': 1}, 1))
+        self.assertEqual((job.chat_id, job.message_id), (1, 10))
+        self.assertEqual(self.queue.claim('worker').id, second)
+        self.assertIsNone(self.queue.claim('worker'))
+
+    def test_claim_by_kind(self):
+        self.queue.enqueue('upload', {})
+        purge = self.queue.enqueue('purge', {})
+
+        self.assertEqual(self.queue.claim('worker', kinds=['purge']).id, purge)
+        self.assertIsNone(self.queue.claim('worker', kinds=['purge']))
+
+    def test_expired_lease_is_claimed_again(self):
+        """Test that the job of a worker that stopped renewing its lease goes to another worker."""
+        self.queue.lease_timeout = -1
+        job_id = self.queue.enqueue('upload', {})
+        self.queue.claim('dead')
+
+        job = self.queue.claim('alive')
+
+        self.assertEqual((job.id, job.attempts), (job_id, 2))
+
+    def test_heartbeat_stores_progress(self):
+        job_id = self.queue.enqueue('upload', {}, chat_id=1)
+        self.queue.claim('worker')
+        self.queue.heartbeat(job_id, 'Uploading 50%')
+
+        self.assertEqual([(job['id'], job['progress']) for job in self.queue.running()], [(job_id, 'Uploading 50%')])
+
+    def test_failed_job_is_retried_later(self):
+        job_id = self.queue.enqueue('upload', {})
+        job = self.queue.claim('worker')
+
+        self.assertEqual(self.queue.fail(job_id, Exception('timeout'), job.attempts), PENDING)
+        # Retried after a backoff, not right away
+        self.assertIsNone(self.queue.claim('worker'))
+        self.assertEqual(self.queue.finished(), [])
+
+    def test_job_fails_after_max_attempts(self):
+        job_id = self.queue.enqueue('upload', {})
+
+        self.assertEqual(self.queue.fail(job_id, Exception('timeout'), 3), FAILED)
+        self.assertEqual([(job['id'], job['error']) for job in self.queue.finished()], [(job_id, 'timeout')])
+
+    def test_permanent_failure_is_not_retried(self):
+        job_id = self.queue.enqueue('upload', {})
+        job = self.queue.claim('worker')
+
+        self.assertEqual(self.queue.fail(job_id, ValueError('Unknown job kind'), job.attempts, retry=False), FAILED)
+        self.assertEqual([job['status'] for job in self.queue.finished()], [FAILED])
+
+    def test_release_does_not_count_the_attempt(self):
+        job_id = self.queue.enqueue('upload', {})
+        self.queue.claim('worker')
+        self.queue.release(job_id)
+
+        self.assertEqual(self.queue.claim('worker').attempts, 1)
+
+    def test_delivery_and_prune(self):
+        job_id = self.queue.enqueue('copy', {})
+        self.queue.claim('worker')
+        self.queue.complete(job_id, 'Copied 3 files.')
+
+        finished = self.queue.finished()
+        self.assertEqual([(job['status'], job['result']) for job in finished], [(DONE, 'Copied 3 files.')])
+        self.queue.mark_delivered(job_id)
+        self.assertEqual(self.queue.finished(), [])
+
+        # Kept for the retention period, deleted after it
+        self.assertEqual(self.queue.prune(max_age=1), 0)
+        time.sleep(0.01)
+        self.assertEqual(self.queue.prune(max_age=0), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
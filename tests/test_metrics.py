@@ -0,0 +1,88 @@
+"""
+Unit tests for the Prometheus metrics, runnable without S3 credentials.
+
+Run with: python -m unittest tests.test_metrics -v
+"""
+
+import asyncio
+import unittest
+
+from s3_bucket_bot import metrics
+from s3_bucket_bot.metrics import Registry, Counter, Gauge, Histogram
+
+
+class TestMetrics(unittest.TestCase):
+    """Tests for the text exposition format."""
+
+    def setUp(self):
+        self.registry = Registry()
+
+    def test_counter(self):
+        counter = Counter('test_total', 'Test counter.', ['kind'], registry=self.registry)
+        counter.inc(kind='a')
+        counter.inc(2, kind='a')
+        counter.inc(kind='b"\n')
+
+        self.assertEqual(self.registry.render(), '# HELP test_total Test counter.\n'
+                                                 '# TYPE test_total counter\n'
+                                                 'test_total{kind="a"} 3\n'
+                                                 'test_total{kind="b\\"\\n"} 1\n')
+
+    def test_wrong_labels(self):
+        counter = Counter('test_total', 'Test counter.', ['kind'], registry=self.registry)
+
+        with self.assertRaises(ValueError):
+            counter.inc(other='a')
+
+    def test_gauge_callback(self):
+        Gauge('test_value', 'Test gauge.', registry=self.registry, callback=lambda: 1.5)
+        Gauge('test_labelled', 'Test gauge.', ['name'], registry=self.registry,
+              callback=lambda: {('a',): 1, ('b',): 2})
+
+        lines = self.registry.render().splitlines()
+
+        self.assertIn('test_value 1.5', lines)
+        self.assertIn('test_labelled{name="a"} 1', lines)
+        self.assertIn('test_labelled{name="b"} 2', lines)
+
+    def test_broken_callback_does_not_hide_other_metrics(self):
+        def broken():
+            raise OSError('gone')
+
+        Gauge('test_broken', 'Broken gauge.', registry=self.registry, callback=broken)
+        Counter('test_total', 'Test counter.', registry=self.registry).inc()
+
+        with self.assertLogs(metrics.logger, 'ERROR'):
+            text = self.registry.render()
+
+        self.assertIn('test_total 1\n', text)
+
+    def test_histogram(self):
+        histogram = Histogram('test_seconds', 'Test histogram.', ['op'], registry=self.registry, buckets=(1, 0.1))
+        for value in (0.05, 0.5, 5):
+            histogram.observe(value, op='get')
+
+        lines = self.registry.render().splitlines()
+
+        self.assertEqual(lines[2:], ['test_seconds_bucket{op="get",le="0.1"} 1',
+                                     'test_seconds_bucket{op="get",le="1.0"} 2',
+                                     'test_seconds_bucket{op="get",le="+Inf"} 3',
+                                     'test_seconds_count{op="get"} 3',
+                                     'test_seconds_sum{op="get"} 5.55'])
+
+    def test_track_handler(self):
+        """Test that handlers are timed and their errors counted."""
+        @metrics.track_handler('test_failing')
+        async def handler(update, context):
+            raise RuntimeError('boom')
+
+        with self.assertRaises(RuntimeError):
+            asyncio.run(handler(None, None))
+
+        text = metrics.REGISTRY.render()
+        self.assertIn('s3bot_handler_errors_total{handler="test_failing"} 1', text)
+        self.assertIn('s3bot_handler_duration_seconds_count{handler="test_failing"} 1', text)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+"""
+Unit tests for the client-side rate limiters, runnable without S3 credentials.
+
+Run with: python -m unittest tests.test_ratelimit -v
+"""
+
+import asyncio
+import unittest
+
+import httpx
+
+from s3_bucket_bot.ratelimit import Limiter, send_request
+
+
+class TestLimiter(unittest.TestCase):
+    """Tests for the AIMD concurrency window."""
+
+    def setUp(self):
+        self.limiter = Limiter('test', max_concurrency=8)
+        self.limiter.window = 4.0
+
+    def test_success_widens_the_window(self):
+        self.limiter.acquire()
+        self.limiter.release()
+
+        self.assertEqual(self.limiter.window, 4.25)
+        self.assertEqual(self.limiter.active, 0)
+
+    def test_throttle_halves_the_window(self):
+        self.limiter.acquire()
+        self.limiter.release(True, retry_after=0)
+
+        self.assertEqual(self.limiter.window, 2.0)
+        self.assertEqual(self.limiter.throttles, 1)
+
+    def test_failure_keeps_the_window(self):
+        """Test that a call without answer frees its slot without counting as a success."""
+        self.limiter.throttles = 2
+        self.limiter.acquire()
+        self.limiter.release(failed=True)
+
+        self.assertEqual((self.limiter.window, self.limiter.throttles, self.limiter.active), (4.0, 2, 0))
+
+    def test_send_request_failure(self):
+        async def send():
+            raise httpx.ConnectError('refused')
+
+        with self.assertRaises(httpx.ConnectError):
+            asyncio.run(send_request(self.limiter, send))
+
+        self.assertEqual((self.limiter.window, self.limiter.active), (4.0, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
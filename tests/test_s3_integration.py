@@ -10,21 +10,44 @@ Run with: python -m unittest tests.test_s3_integration -v
 import unittest
 import uuid
 import os
+import io
+import asyncio
+import tarfile
+import tempfile
+import httpx
 from s3_bucket_bot.s3bucket import (
     upload_file,
     delete_file,
+    delete_files,
     file_exist,
     copy_file,
     make_public,
     make_private,
     get_file_acl,
     list_files,
+    list_files_page,
+    iter_files,
     get_meta,
     get_obj_url,
+    presign_get,
+    presign_put,
     BUCKET_NAME,
     AWS_SERVER_PUBLIC_KEY,
     ACLNotSupportedError,
+    metadata_cache,
 )
+from s3_bucket_bot.sync import sync_path, extract_archive
+from s3_bucket_bot import images, s3bucket
+from s3_bucket_bot.compression import compress_stream
+from s3_bucket_bot.transfer import stream_upload
+from botocore.awsrequest import AWSResponse
+
+
+class EmptyRawResponse:
+    """Raw body of a fake botocore response."""
+
+    def stream(self, **kwargs):
+        yield b''
 
 
 def generate_test_path(extension='txt'):
@@ -145,6 +168,27 @@ class TestS3Integration(unittest.TestCase):
 
         os.unlink(local_file)
 
+    def test_file_exist_uses_cache(self):
+        """Test repeated checks are served from the metadata cache and deletes update it."""
+        if not metadata_cache.enabled:
+            self.skipTest('Metadata cache disabled')
+
+        local_file = self.create_test_file()
+        s3_path = generate_test_path('txt')
+        self.track_s3_file(s3_path)
+
+        upload_file(local_file, s3_path, 'text/plain', 'private')
+        self.assertTrue(file_exist(s3_path))
+        hits = metadata_cache.stats()['hits']
+
+        self.assertTrue(file_exist(s3_path))
+        self.assertEqual(metadata_cache.stats()['hits'], hits + 1)
+
+        delete_file(s3_path)
+        self.assertFalse(file_exist(s3_path))
+
+        os.unlink(local_file)
+
     def test_file_exist_returns_false(self):
         """Test file_exist returns False for non-existing file."""
         s3_path = f'tests/nonexistent-{uuid.uuid4()}.txt'
@@ -168,6 +212,22 @@ class TestS3Integration(unittest.TestCase):
 
         os.unlink(local_file)
 
+    def test_delete_files(self):
+        """Test deleting several files with one request."""
+        local_file = self.create_test_file()
+        paths = [generate_test_path('txt') for _ in range(3)]
+        for path in paths:
+            upload_file(local_file, path, 'text/plain', 'private')
+
+        deleted, errors = delete_files(paths)
+
+        self.assertEqual(sorted(deleted), sorted(paths))
+        self.assertEqual(errors, [])
+        for path in paths:
+            self.assertFalse(file_exist(path))
+
+        os.unlink(local_file)
+
     # --- ACL Tests ---
 
     def test_make_public(self):
@@ -227,6 +287,14 @@ class TestS3Integration(unittest.TestCase):
 
         os.unlink(local_file)
 
+    def test_copy_file_missing_source(self):
+        """Test copy returns False when the source does not exist."""
+        src_path = f'tests/nonexistent-{uuid.uuid4()}.txt'
+        dest_path = generate_test_path('txt')
+
+        self.assertFalse(copy_file(src_path, dest_path))
+        self.assertFalse(file_exist(dest_path))
+
     def test_copy_file_preserves_acl(self):
         """Test that copy preserves ACL."""
         if not self.acl_supported:
@@ -285,6 +353,46 @@ class TestS3Integration(unittest.TestCase):
 
         os.unlink(local_file)
 
+    def test_list_files_page(self):
+        """Test listing files page by page with continuation tokens."""
+        local_file = self.create_test_file()
+        test_prefix = f'tests/page-test-{uuid.uuid4()}'
+        paths = [f'{test_prefix}/file{i}.txt' for i in range(3)]
+        for path in paths:
+            self.track_s3_file(path)
+            upload_file(local_file, path, 'text/plain', 'private')
+
+        first, token = list_files_page(test_prefix, limit=2)
+        self.assertEqual(len(first), 2)
+        self.assertIsNotNone(token)
+
+        second, token = list_files_page(test_prefix, limit=2, continuation_token=token)
+        self.assertEqual(len(second), 1)
+        self.assertIsNone(token)
+        self.assertEqual(sorted(e['key'] for e in first + second), paths)
+
+        # A page can also start after a given key
+        after, token = list_files_page(test_prefix, limit=2, start_after=paths[0])
+        self.assertEqual([e['key'] for e in after], paths[1:])
+        self.assertIsNone(token)
+
+        os.unlink(local_file)
+
+    def test_iter_files(self):
+        """Test iterating over all files across pages."""
+        local_file = self.create_test_file()
+        test_prefix = f'tests/iter-test-{uuid.uuid4()}'
+        paths = [f'{test_prefix}/file{i}.txt' for i in range(3)]
+        for path in paths:
+            self.track_s3_file(path)
+            upload_file(local_file, path, 'text/plain', 'private')
+
+        keys = [entry['key'] for entry in iter_files(test_prefix, page_size=1)]
+
+        self.assertEqual(sorted(keys), paths)
+
+        os.unlink(local_file)
+
     def test_list_files_empty_result(self):
         """Test list returns empty for non-matching prefix."""
         entries = list_files(f'tests/nonexistent-prefix-{uuid.uuid4()}', limit=10)
@@ -329,6 +437,144 @@ class TestS3Integration(unittest.TestCase):
         self.assertIsInstance(url, str)
         self.assertIn(s3_path, url)
 
+    def test_presign_get(self):
+        """Test downloading a private file with a presigned URL."""
+        local_file = self.create_test_file('Signed content')
+        s3_path = generate_test_path('txt')
+        self.track_s3_file(s3_path)
+        upload_file(local_file, s3_path, 'text/plain', 'private')
+
+        response = httpx.get(presign_get(s3_path, 60))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.text, 'Signed content')
+        os.unlink(local_file)
+
+    def test_presign_put(self):
+        """Test uploading a file with a presigned URL."""
+        s3_path = generate_test_path('txt')
+        self.track_s3_file(s3_path)
+
+        response = httpx.put(presign_put(s3_path, 60, 'text/plain'), content=b'Uploaded directly',
+                             headers={'Content-Type': 'text/plain'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(get_meta(s3_path)['ContentType'], 'text/plain')
+
+    # --- Sync Tests ---
+
+    def test_sync_path(self):
+        """Test that a second sync only uploads the changed files and deletes the orphans."""
+        prefix = f'tests/{uuid.uuid4()}/'
+        with tempfile.TemporaryDirectory() as directory:
+            for name in ('a.txt', 'b.txt'):
+                with open(os.path.join(directory, name), 'w') as f:
+                    f.write(name)
+            self.created_files += [prefix + 'a.txt', prefix + 'b.txt']
+            report = asyncio.run(sync_path(directory, prefix))
+            self.assertEqual(sorted(report.uploaded), ['a.txt', 'b.txt'])
+
+            with open(os.path.join(directory, 'a.txt'), 'w') as f:
+                f.write('changed')
+            os.unlink(os.path.join(directory, 'b.txt'))
+            report = asyncio.run(sync_path(directory, prefix, delete=True, checksum=True))
+
+        self.assertEqual(report.uploaded, ['a.txt'])
+        self.assertEqual(report.deleted, ['b.txt'])
+        self.assertFalse(file_exist(prefix + 'b.txt'))
+
+    def test_extract_archive_stream(self):
+        """Test extracting a tar.gz archive from a stream of chunks."""
+        prefix = f'tests/{uuid.uuid4()}/'
+        buffer = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode='w:gz') as archive:
+            for name, data in (('index.html', b'<html></html>'), ('css/site.css', b'body {}')):
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                archive.addfile(info, io.BytesIO(data))
+        self.created_files += [prefix + 'index.html', prefix + 'css/site.css']
+
+        async def chunks():
+            data = buffer.getvalue()
+            for i in range(0, len(data), 16):
+                yield data[i:i + 16]
+
+        report = asyncio.run(extract_archive('site.tar.gz', prefix, chunks=chunks()))
+
+        self.assertEqual(sorted(report.uploaded), ['css/site.css', 'index.html'])
+        self.assertEqual(get_meta(prefix + 'css/site.css')['ContentType'], 'text/css')
+
+    def test_stream_upload_compressed(self):
+        """Test that a compressed upload gets its Content-Encoding and Cache-Control headers."""
+        s3_path = generate_test_path('css')
+        self.track_s3_file(s3_path)
+        content = b'body { margin: 0; }\n' * 1000
+
+        async def chunks():
+            yield content
+
+        rules, s3bucket.CACHE_CONTROL_RULES = s3bucket.CACHE_CONTROL_RULES, [
+            {'prefix': 'tests/', 'mime_type': 'text/*', 'cache_control': 'public, max-age=60'}]
+        try:
+            asyncio.run(stream_upload(compress_stream(chunks(), 'gzip'), s3_path, 'text/css', 'public-read',
+                                      content_encoding='gzip'))
+        finally:
+            s3bucket.CACHE_CONTROL_RULES = rules
+
+        meta = get_meta(s3_path)
+        self.assertEqual(meta['ContentEncoding'], 'gzip')
+        self.assertEqual(meta['CacheControl'], 'public, max-age=60')
+        self.assertLess(meta['ContentLength'], len(content))
+        # httpx decodes the Content-Encoding
+        self.assertEqual(httpx.get(presign_get(s3_path, 60)).content, content)
+
+    # --- Rate Limiting Tests ---
+
+    def test_throttled_call_is_retried(self):
+        """Test that an S3 call answered with SlowDown is retried and halves the concurrency window."""
+        s3_path = generate_test_path('txt')
+        self.track_s3_file(s3_path)
+        client = s3bucket.get_s3_client()
+        limiter = s3bucket.s3_limiter
+        window = limiter.window
+        throttled = []
+
+        def slow_down(request, **kwargs):
+            if not throttled:
+                throttled.append(request)
+                return AWSResponse(request.url, 503, {'Retry-After': '0'}, EmptyRawResponse())
+
+        client.meta.events.register('before-send.s3', slow_down, unique_id='test-slow-down')
+        try:
+            s3bucket.put_object(s3_path, b'throttled', 'text/plain')
+        finally:
+            client.meta.events.unregister('before-send.s3', unique_id='test-slow-down')
+
+        self.assertEqual(len(throttled), 1)
+        self.assertTrue(file_exist(s3_path))
+        self.assertLess(limiter.window, window)
+        self.assertEqual(limiter.active, 0)
+
+    # --- Image Variant Tests ---
+
+    @unittest.skipIf(images.Image is None, 'Pillow is not installed.')
+    def test_create_variants(self):
+        """Test rendering and uploading image variants next to the original."""
+        source = io.BytesIO()
+        images.Image.new('RGB', (1200, 800), (200, 30, 40)).save(source, format='JPEG')
+        s3_path = generate_test_path('jpg')
+        variants = images.parse_variants('thumb:320:webp')
+        self.track_s3_file(variants[0].key(s3_path))
+        try:
+            images.VARIANTS, previous = variants, images.VARIANTS
+            results = asyncio.run(images.create_variants(s3_path, source.getvalue()))
+        finally:
+            images.VARIANTS = previous
+            images.shutdown()
+
+        self.assertEqual(results, [(s3_path[:-len('.jpg')] + '.thumb.webp', None)])
+        self.assertEqual(get_meta(results[0][0])['ContentType'], 'image/webp')
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,137 @@
+"""
+Unit tests for the S3 helpers, with a stubbed client, runnable without S3 credentials.
+
+Run with: python -m unittest tests.test_s3bucket -v
+"""
+
+import unittest
+from unittest import mock
+
+from botocore.exceptions import ClientError
+
+from s3_bucket_bot import s3bucket
+from s3_bucket_bot.cache import TTLCache
+from s3_bucket_bot.s3bucket import MAX_PART_SIZE, MAX_PARTS, copy_part_size
+
+GB = 1024 ** 3
+
+
+def client_error(status, operation='HeadObject'):
+    return ClientError({'Error': {'Code': str(status)}, 'ResponseMetadata': {'HTTPStatusCode': status}}, operation)
+
+
+class S3BucketTestCase(unittest.TestCase):
+    """Base class replacing the S3 client, the metadata cache and the change listeners."""
+
+    def setUp(self):
+        self.client = mock.Mock()
+        self.changes = []
+        patches = [
+            mock.patch.object(s3bucket, 'get_s3_client', lambda: self.client),
+            mock.patch.object(s3bucket, 'metadata_cache', TTLCache(60, 100)),
+            mock.patch.object(s3bucket, '_change_listeners', [lambda keys, deleted: self.changes.append(keys)]),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+
+class TestCopyFile(S3BucketTestCase):
+    """Tests for server-side copies."""
+
+    def test_copy_part_size(self):
+        """Test that the copy part size is raised so that large objects fit in MAX_PARTS parts."""
+        self.assertEqual(copy_part_size(10 * GB), s3bucket.S3_COPY_PART_SIZE)
+        size = 4 * 1024 * GB
+        self.assertLessEqual(-(-size // copy_part_size(size)), MAX_PARTS)
+        self.assertEqual(copy_part_size(100 * 1024 * GB), MAX_PART_SIZE)
+
+    def test_copy_invalidates_destination(self):
+        self.client.head_object.return_value = {'ContentLength': 10, 'ETag': '"etag"'}
+        self.client.get_object_acl.return_value = {'Grants': []}
+
+        self.assertTrue(s3bucket.copy_file('a.txt', 'b.txt'))
+        self.assertEqual(self.changes, [['b.txt']])
+
+    def test_missing_source_does_not_invalidate(self):
+        """Test that listeners are not told about a destination a failed copy did not change."""
+        self.client.head_object.side_effect = client_error(404)
+
+        self.assertFalse(s3bucket.copy_file('missing.txt', 'b.txt'))
+        self.assertEqual(self.changes, [])
+
+    def test_failed_copy_does_not_invalidate(self):
+        self.client.get_object_acl.return_value = {'Grants': []}
+        self.client.copy_object.side_effect = client_error(500, 'CopyObject')
+
+        with self.assertRaises(ClientError):
+            s3bucket.copy_file('a.txt', 'b.txt', size=10)
+        self.assertEqual(self.changes, [])
+
+    def test_multipart_copy_parts(self):
+        """Test that a large copy is split into at most MAX_PARTS parts covering the whole object."""
+        size = 3 * 1024 * GB
+        self.client.head_object.return_value = {'ContentLength': size, 'ETag': '"etag"'}
+        self.client.get_object_acl.return_value = {'Grants': []}
+        self.client.create_multipart_upload.return_value = {'UploadId': 'upload-id'}
+        self.client.upload_part_copy.return_value = {'CopyPartResult': {'ETag': '"part"'}}
+
+        self.assertTrue(s3bucket.copy_file('big.bin', 'copy.bin'))
+
+        calls = sorted(self.client.upload_part_copy.call_args_list, key=lambda call: call.kwargs['PartNumber'])
+        ranges = [call.kwargs['CopySourceRange'] for call in calls]
+        self.assertLessEqual(len(ranges), MAX_PARTS)
+        self.assertEqual(ranges[0], f'bytes=0-{copy_part_size(size) - 1}')
+        self.assertTrue(ranges[-1].endswith(f'-{size - 1}'))
+        self.assertEqual(self.changes, [['copy.bin']])
+
+
+
+class TestMetadataCache(S3BucketTestCase):
+    """Tests for the caching of head_object results."""
+
+    def test_head_object_is_cached(self):
+        self.client.head_object.return_value = {'ContentLength': 10}
+
+        self.assertEqual(s3bucket.head_object('a.txt'), {'ContentLength': 10})
+        self.assertEqual(s3bucket.head_object('a.txt'), {'ContentLength': 10})
+        self.assertEqual(self.client.head_object.call_count, 1)
+
+    def test_missing_object_is_cached_briefly(self):
+        """Test that a 404 is cached for METADATA_CACHE_MISSING_TTL seconds, not the whole cache TTL."""
+        self.client.head_object.side_effect = client_error(404)
+        now = [1000.0]
+
+        with mock.patch.object(s3bucket.metadata_cache, 'ttl', 60), \
+                mock.patch.object(s3bucket, 'METADATA_CACHE_MISSING_TTL', 5), \
+                mock.patch('s3_bucket_bot.cache.time.monotonic', lambda: now[0]):
+            self.assertIsNone(s3bucket.head_object('a.txt'))
+            self.assertIsNone(s3bucket.head_object('a.txt'))
+            self.assertEqual(self.client.head_object.call_count, 1)
+
+            self.client.head_object.side_effect = None
+            self.client.head_object.return_value = {'ContentLength': 10}
+            now[0] += 6
+            self.assertEqual(s3bucket.head_object('a.txt'), {'ContentLength': 10})
+            self.assertEqual(self.client.head_object.call_count, 2)
+
+    def test_other_errors_are_not_cached(self):
+        self.client.head_object.side_effect = client_error(500)
+
+        for _ in range(2):
+            with self.assertRaises(ClientError):
+                s3bucket.head_object('a.txt')
+        self.assertEqual(self.client.head_object.call_count, 2)
+
+    def test_write_invalidates(self):
+        self.client.head_object.side_effect = client_error(404)
+        self.assertIsNone(s3bucket.head_object('a.txt'))
+
+        s3bucket.invalidate('a.txt')
+        self.client.head_object.side_effect = None
+        self.client.head_object.return_value = {'ContentLength': 10}
+        self.assertEqual(s3bucket.head_object('a.txt'), {'ContentLength': 10})
+
+
+if __name__ == '__main__':
+    unittest.main()
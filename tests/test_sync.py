@@ -0,0 +1,82 @@
+"""
+Unit tests for directory and archive sync helpers, runnable without S3 credentials.
+
+Run with: python -m unittest tests.test_sync -v
+"""
+
+import io
+import hashlib
+import tarfile
+import unittest
+
+from s3_bucket_bot.archive import safe_name, iter_members, is_archive, is_streamable
+from s3_bucket_bot.sync import compute_etag
+
+MB = 1024 * 1024
+
+
+class TestSafeName(unittest.TestCase):
+    """Tests for the normalization of archive member names."""
+
+    def test_relative_names(self):
+        self.assertEqual(safe_name('site/index.html'), 'site/index.html')
+        self.assertEqual(safe_name('./site//css/../index.html'), 'site/index.html')
+        self.assertEqual(safe_name('site\\img\\a.png'), 'site/img/a.png')
+
+    def test_unsafe_names(self):
+        for name in ('/etc/passwd', '../outside.txt', 'site/../../outside.txt', '..', '.', '', 'site/'):
+            with self.subTest(name=name):
+                self.assertIsNone(safe_name(name))
+
+
+class TestArchives(unittest.TestCase):
+
+    def test_archive_types(self):
+        self.assertTrue(is_archive('site.TAR.GZ'))
+        self.assertTrue(is_streamable('site.tgz'))
+        self.assertTrue(is_archive('site.zip'))
+        self.assertFalse(is_streamable('site.zip'))
+        self.assertFalse(is_archive('site.gz'))
+
+    def test_iter_members_of_stream(self):
+        """Test that a compressed tar stream yields its safe regular files only."""
+        buffer = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode='w:gz') as archive:
+            for name, data in (('site/index.html', b'<html>'), ('../evil.sh', b'rm -rf'), ('site/a.css', b'body')):
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                archive.addfile(info, io.BytesIO(data))
+            directory = tarfile.TarInfo('site/img')
+            directory.type = tarfile.DIRTYPE
+            archive.addfile(directory)
+        buffer.seek(0)
+
+        members = [(member.name, member.size, f.read()) for member, f in iter_members('site.tgz', buffer)]
+
+        self.assertEqual(members, [('site/index.html', 6, b'<html>'), ('site/a.css', 4, b'body')])
+
+
+class TestComputeEtag(unittest.TestCase):
+    """Tests for the ETag S3 gives to single and multipart uploads."""
+
+    def test_single_part(self):
+        data = b'x' * 1000
+
+        self.assertEqual(compute_etag([data[:300], data[300:]], 8 * MB), hashlib.md5(data).hexdigest())
+
+    def test_empty(self):
+        self.assertEqual(compute_etag([], 8 * MB), hashlib.md5(b'').hexdigest())
+
+    def test_multipart(self):
+        """Test that parts are split at the part size, whatever the chunk boundaries."""
+        data = bytes(range(256)) * (9 * 4096)
+        part_size = 5 * MB
+        parts = [data[i:i + part_size] for i in range(0, len(data), part_size)]
+        expected = hashlib.md5(b''.join(hashlib.md5(part).digest() for part in parts)).hexdigest()
+        chunks = [data[i:i + 777777] for i in range(0, len(data), 777777)]
+
+        self.assertEqual(compute_etag(chunks, part_size), f'{expected}-{len(parts)}')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,197 @@
+"""
+Unit tests for the tracing spans and their OTLP/JSON export, runnable without S3 credentials.
+
+Run with: python -m unittest tests.test_tracing -v
+"""
+
+import os
+import json
+import asyncio
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+import boto3
+from botocore.awsrequest import AWSResponse
+from botocore.exceptions import ClientError
+
+from s3_bucket_bot import aio, bot, tracing, worker
+from s3_bucket_bot.jobs import JobQueue
+from s3_bucket_bot.tracing import JsonLinesExporter, STATUS_OK, STATUS_ERROR
+
+
+class TracingTestCase(unittest.TestCase):
+    """Base class exporting the spans to a temporary file."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, 'spans.jsonl')
+        exporter = JsonLinesExporter(self.path)
+        patch = mock.patch.object(tracing, 'exporter', exporter)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.addCleanup(exporter.close)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def spans(self):
+        """Exported spans by name."""
+        tracing.exporter.close()
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path) as f:
+            lines = [json.loads(line) for line in f]
+        spans = [line['resourceSpans'][0]['scopeSpans'][0]['spans'][0] for line in lines]
+        return {span['name']: span for span in spans}
+
+    def assertChildOf(self, child, parent):
+        self.assertEqual(child['traceId'], parent['traceId'])
+        self.assertEqual(child['parentSpanId'], parent['spanId'])
+
+
+class TestSpans(TracingTestCase):
+    """Tests for the nesting and status of spans."""
+
+    def test_nested_spans(self):
+        with tracing.span('parent', attribute=1):
+            with tracing.span('child'):
+                tracing.set_attributes(**{'s3.key': 'a.txt'})
+
+        spans = self.spans()
+        self.assertChildOf(spans['child'], spans['parent'])
+        self.assertNotIn('parentSpanId', spans['parent'])
+        self.assertEqual(spans['parent']['status'], {'code': STATUS_OK})
+        self.assertEqual(spans['parent']['attributes'], [{'key': 'attribute', 'value': {'intValue': '1'}}])
+        self.assertEqual(spans['child']['attributes'], [{'key': 's3.key', 'value': {'stringValue': 'a.txt'}}])
+
+    def test_error_status(self):
+        with self.assertRaises(ValueError), tracing.span('failing'):
+            raise ValueError('boom')
+
+        self.assertEqual(self.spans()['failing']['status'], {'code': STATUS_ERROR, 'message': 'ValueError: boom'})
+
+    def test_spans_follow_aio_run(self):
+        """Test that a span opened in an executor thread is a child of the span of the coroutine."""
+        def blocking():
+            with tracing.span('thread'):
+                pass
+
+        async def handler():
+            with tracing.span('handler'):
+                await aio.run(aio.METADATA, blocking)
+
+        asyncio.run(handler())
+
+        spans = self.spans()
+        self.assertChildOf(spans['thread'], spans['handler'])
+
+    def test_traced_checks_at_call_time(self):
+        """Test that functions decorated while tracing was disabled are traced once it is enabled."""
+        with mock.patch.object(tracing, 'exporter', None):
+            @tracing.traced('decorated.sync')
+            def sync_function():
+                return tracing.current_span()
+
+            @tracing.traced('decorated.async')
+            async def async_function():
+                return tracing.current_span()
+
+            self.assertIsNone(sync_function())
+
+        self.assertEqual(sync_function().name, 'decorated.sync')
+        self.assertEqual(asyncio.run(async_function()).name, 'decorated.async')
+        self.assertEqual(set(self.spans()), {'decorated.sync', 'decorated.async'})
+
+    def test_disabled(self):
+        with mock.patch.object(tracing, 'exporter', None):
+            with tracing.span('ignored') as current:
+                self.assertIsNone(current)
+                self.assertIsNone(tracing.current_traceparent())
+
+        self.assertEqual(self.spans(), {})
+
+
+class FakeRaw:
+    def stream(self):
+        return iter([b''])
+
+
+class TestS3Spans(TracingTestCase):
+    """Tests for the spans of S3 calls, from the botocore event hooks, with canned HTTP responses."""
+
+    def setUp(self):
+        super().setUp()
+        client = boto3.session.Session(aws_access_key_id='key', aws_secret_access_key='secret',
+                                       region_name='us-east-1').client('s3')
+        self.client = tracing.instrument_s3_client(client)
+        self.status = 200
+        # Answering before-send skips the HTTP request, the other events fire as usual
+        self.client.meta.events.register('before-send.s3', self.send)
+
+    def send(self, request, **kwargs):
+        return AWSResponse(request.url, self.status, {'Content-Length': '10'}, FakeRaw())
+
+    def test_call_span(self):
+        with tracing.span('handler'):
+            self.client.head_object(Bucket='bucket', Key='a.txt')
+
+        spans = self.spans()
+        call = spans['S3.HeadObject']
+        self.assertChildOf(call, spans['handler'])
+        self.assertEqual(call['kind'], tracing.SPAN_KIND_CLIENT)
+        self.assertEqual(call['status'], {'code': STATUS_OK})
+        attributes = {attribute['key']: attribute['value'] for attribute in call['attributes']}
+        self.assertEqual(attributes['rpc.method'], {'stringValue': 'HeadObject'})
+        self.assertEqual(attributes['http.response.status_code'], {'intValue': '200'})
+
+    def test_error_span(self):
+        self.status = 404
+
+        with tracing.span('handler'), self.assertRaises(ClientError):
+            self.client.head_object(Bucket='bucket', Key='missing.txt')
+
+        self.assertEqual(self.spans()['S3.HeadObject']['status'], {'code': STATUS_ERROR, 'message': '404'})
+
+    def test_calls_outside_of_a_trace(self):
+        self.client.head_object(Bucket='bucket', Key='a.txt')
+
+        self.assertEqual(self.spans(), {})
+
+
+class TestJobTrace(TracingTestCase):
+    """Tests for queued jobs joining the trace of the update that queued them."""
+
+    def setUp(self):
+        super().setUp()
+        self.queue = JobQueue(os.path.join(self.tmp_dir.name, 'jobs.sqlite3'))
+        self.addCleanup(self.queue.close)
+
+    def test_job_joins_the_trace_of_the_update(self):
+        status_message = SimpleNamespace(chat_id=1, message_id=2)
+        message = SimpleNamespace(reply_text=mock.AsyncMock(return_value=status_message))
+
+        async def handler(bot, job):
+            with tracing.span('handler'):
+                return 'done'
+
+        async def run():
+            with mock.patch.object(bot, 'job_queue', self.queue):
+                with tracing.span('update'):
+                    await bot.enqueue_job(message, 'test', {}, 'Queued')
+            job = self.queue.claim('worker')
+            with mock.patch.object(worker, 'job_queue', self.queue), \
+                    mock.patch.dict(worker.JOB_HANDLERS, {'test': handler}):
+                await worker.run_job(None, job)
+
+        asyncio.run(run())
+
+        spans = self.spans()
+        self.assertChildOf(spans['job.test'], spans['update'])
+        self.assertEqual(spans['job.test']['kind'], tracing.SPAN_KIND_CONSUMER)
+        self.assertChildOf(spans['handler'], spans['job.test'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,232 @@
+"""
+Unit tests for the transfer engine settings, part sizing and resumable uploads, runnable without S3 credentials.
+
+Run with: python -m unittest tests.test_transfer -v
+"""
+
+import os
+import asyncio
+import tempfile
+import threading
+import unittest
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+
+from s3_bucket_bot import s3bucket, transfer
+from s3_bucket_bot.transfer import TransferSettings, MIN_PART_SIZE, MAX_PART_SIZE, MAX_PARTS, parse_size
+
+MB = 1024 * 1024
+
+
+class TestTransferSettings(unittest.TestCase):
+    """Tests for the part size limits of S3."""
+
+    def test_parse_size(self):
+        self.assertEqual(parse_size('64M'), 64 * MB)
+        self.assertEqual(parse_size('1.5G'), 1536 * MB)
+        self.assertEqual(parse_size('10KiB'), 10240)
+        with self.assertRaises(ValueError):
+            parse_size('lots')
+
+    def test_part_size_is_clamped(self):
+        self.assertEqual(TransferSettings(part_size=1).validated().part_size, MIN_PART_SIZE)
+        self.assertEqual(TransferSettings().with_options({'part-size': '6G'}).part_size, MAX_PART_SIZE)
+
+    def test_part_size_for_large_files(self):
+        """Test that the part size is raised so that large uploads fit in MAX_PARTS parts."""
+        settings = TransferSettings(part_size=8 * MB)
+
+        self.assertIs(settings.for_size(None), settings)
+        self.assertIs(settings.for_size(8 * MB * MAX_PARTS), settings)
+        size = 100 * 1024 ** 3
+        part_size = settings.for_size(size).part_size
+        self.assertGreater(part_size, 8 * MB)
+        self.assertLessEqual(-(-size // part_size), MAX_PARTS)
+        self.assertEqual(settings.for_size(5 * 1024 ** 4 * 10).part_size, MAX_PART_SIZE)
+
+
+class TestStreamUpload(unittest.TestCase):
+    """Tests for the parts of streams of unknown size, with a fake multipart upload."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.parts = []
+        patches = [
+            mock.patch.object(transfer, 'journal', transfer.UploadJournal(self.tmp_dir.name)),
+            mock.patch.object(transfer, 'PART_SIZE_GROWTH_INTERVAL', 2),
+            mock.patch.object(s3bucket, 'create_multipart_upload', lambda *args: 'upload-id'),
+            mock.patch.object(s3bucket, 'upload_part', self.upload_part),
+            mock.patch.object(s3bucket, 'complete_multipart_upload', lambda *args: None),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def upload_part(self, object_name, upload_id, number, body):
+        self.parts.append((number, len(body)))
+        return f'"etag{number}"'
+
+    def test_part_size_grows(self):
+        async def chunks():
+            for _ in range(35):
+                yield b'x' * MB
+
+        settings = TransferSettings(part_size=MIN_PART_SIZE, max_concurrency=1, max_buffers=1)
+        asyncio.run(transfer.stream_upload(chunks(), 'tests/stream.bin', settings=settings))
+
+        self.assertEqual(sorted(self.parts), [(1, 5 * MB), (2, 5 * MB), (3, 10 * MB), (4, 10 * MB), (5, 5 * MB)])
+
+
+
+class TestResumableUploads(unittest.TestCase):
+    """Tests for journaled multipart uploads of local files, interrupted and resumed, with a fake S3."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.journal = transfer.UploadJournal(os.path.join(self.tmp_dir.name, 'uploads'))
+        self.uploads = {}
+        self.completed = {}
+        self.aborted = []
+        self.settings = TransferSettings(part_size=MIN_PART_SIZE, max_concurrency=1, max_buffers=1)
+        patches = [
+            mock.patch.object(transfer, 'journal', self.journal),
+            mock.patch.object(s3bucket, 'create_multipart_upload', self.create_multipart_upload),
+            mock.patch.object(s3bucket, 'upload_part', self.upload_part),
+            mock.patch.object(s3bucket, 'complete_multipart_upload', self.complete_multipart_upload),
+            mock.patch.object(s3bucket, 'abort_multipart_upload', lambda key, upload_id: self.aborted.append(upload_id)),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        # Part whose upload blocks until release_part is set, calling on_interrupt when it starts
+        self.interrupt_at = None
+        self.on_interrupt = None
+        self.release_part = threading.Event()
+
+    def tearDown(self):
+        self.release_part.set()
+        self.tmp_dir.cleanup()
+
+    def create_multipart_upload(self, object_name, mime_type=None, acl=None, content_encoding=None):
+        upload_id = f'upload-{len(self.uploads) + 1}'
+        self.uploads[upload_id] = []
+        return upload_id
+
+    def upload_part(self, object_name, upload_id, number, body):
+        if number == self.interrupt_at:
+            self.on_interrupt()
+            self.release_part.wait(5)
+        self.uploads[upload_id].append(number)
+        return f'"etag{number}"'
+
+    def complete_multipart_upload(self, object_name, upload_id, parts):
+        self.completed[upload_id] = sorted(parts)
+
+    def make_file(self, name, size):
+        path = os.path.join(self.tmp_dir.name, name)
+        with open(path, 'wb') as f:
+            f.write(b'x' * size)
+        return path
+
+    async def interrupted_upload(self, path, object_name, meta=None):
+        """Upload a file and cancel the upload when its second part starts, like a shutdown."""
+        loop = asyncio.get_running_loop()
+        started = asyncio.Event()
+        self.interrupt_at = 2
+        # upload_part runs in an executor thread
+        self.on_interrupt = lambda: loop.call_soon_threadsafe(started.set)
+        task = asyncio.create_task(transfer.upload_file(path, object_name, settings=self.settings, meta=meta))
+        await started.wait()
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+        self.interrupt_at = None
+        self.release_part.set()
+
+    def test_interrupted_upload_is_resumed(self):
+        """Test that a resumed upload sends the parts missing from the journal only, then completes."""
+        path = self.make_file('video.bin', 3 * MIN_PART_SIZE - 10)
+
+        async def run():
+            await self.interrupted_upload(path, 'tests/video.bin', meta={'chat_id': 1})
+            [entry] = self.journal.entries()
+            self.assertEqual((entry['object_name'], entry['meta'], list(entry['parts'])),
+                             ('tests/video.bin', {'chat_id': 1}, ['1']))
+
+            resumed = []
+
+            async def callback(entry):
+                resumed.append(entry['meta'])
+
+            self.assertEqual(await transfer.resume_uploads(callback, settings=self.settings), 1)
+            return resumed
+
+        resumed = asyncio.run(run())
+
+        self.assertEqual(resumed, [{'chat_id': 1}])
+        # Part 2 reached S3 after the cancellation, but was not journaled, so it is sent again
+        self.assertEqual(sorted(self.uploads['upload-1']), [1, 2, 2, 3])
+        self.assertEqual(self.completed['upload-1'], [(1, '"etag1"'), (2, '"etag2"'), (3, '"etag3"')])
+        self.assertEqual(self.journal.entries(), [])
+
+    def test_resume_match(self):
+        """Test that only the journal entries selected by match are resumed."""
+        first = self.make_file('a.bin', 2 * MIN_PART_SIZE)
+        second = self.make_file('b.bin', 2 * MIN_PART_SIZE)
+
+        async def run():
+            await self.interrupted_upload(first, 'tests/a.bin', meta={'job_id': 1})
+            self.release_part.clear()
+            await self.interrupted_upload(second, 'tests/b.bin', meta={'job_id': 2})
+            return await transfer.resume_uploads(settings=self.settings,
+                                                 match=lambda entry: entry['meta'].get('job_id') == 2)
+
+        self.assertEqual(asyncio.run(run()), 1)
+        self.assertEqual(list(self.completed), ['upload-2'])
+        self.assertEqual([entry['object_name'] for entry in self.journal.entries()], ['tests/a.bin'])
+
+    def test_changed_source_is_aborted(self):
+        path = self.make_file('a.bin', 2 * MIN_PART_SIZE)
+
+        async def run():
+            await self.interrupted_upload(path, 'tests/a.bin')
+            self.make_file('a.bin', 10)
+            return await transfer.resume_uploads(settings=self.settings)
+
+        self.assertEqual(asyncio.run(run()), 0)
+        self.assertEqual(self.aborted, ['upload-1'])
+        self.assertEqual(self.completed, {})
+        self.assertEqual(self.journal.entries(), [])
+
+    def test_failed_upload_is_aborted(self):
+        """Test that an upload failing for another reason than a shutdown is aborted and leaves no journal entry."""
+        path = self.make_file('a.bin', 2 * MIN_PART_SIZE)
+
+        with mock.patch.object(s3bucket, 'upload_part', side_effect=OSError('broken pipe')), \
+                self.assertRaises(OSError):
+            asyncio.run(transfer.upload_file(path, 'tests/a.bin', settings=self.settings))
+
+        self.assertEqual(self.aborted, ['upload-1'])
+        self.assertEqual(self.journal.entries(), [])
+
+    def test_abort_stale_uploads(self):
+        """Test that old uploads unknown to the journal are aborted, recent and journaled ones are kept."""
+        now = datetime.now(timezone.utc)
+        self.journal.save(transfer._new_journal_entry('journaled', 'tests/a.bin', None, None, MIN_PART_SIZE,
+                                                      None, None, None))
+        uploads = [
+            {'Key': 'tests/a.bin', 'UploadId': 'journaled', 'Initiated': now - timedelta(days=3)},
+            {'Key': 'tests/b.bin', 'UploadId': 'stale', 'Initiated': now - timedelta(hours=25)},
+            {'Key': 'tests/c.bin', 'UploadId': 'recent', 'Initiated': now - timedelta(hours=1)},
+        ]
+
+        with mock.patch.object(s3bucket, 'list_multipart_uploads', lambda: uploads):
+            self.assertEqual(asyncio.run(transfer.abort_stale_uploads(24)), 1)
+
+        self.assertEqual(self.aborted, ['stale'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+"""
+Unit tests for the webhook endpoint, runnable without a Telegram token.
+
+Run with: python -m unittest tests.test_webhook -v
+"""
+
+import json
+import asyncio
+import unittest
+import types
+from http import HTTPStatus
+from unittest import mock
+
+from s3_bucket_bot import webhook
+from s3_bucket_bot.httpserver import HTTPError, Request
+
+WEBHOOK_URL = 'https://bot.example.com/telegram'
+SECRET = 'secret-token'
+
+
+def make_application():
+    return types.SimpleNamespace(bot=None, running=True, update_queue=asyncio.Queue())
+
+
+def make_update_request(secret):
+    body = json.dumps({'update_id': 1}).encode()
+    headers = {'content-type': 'application/json', 'x-telegram-bot-api-secret-token': secret}
+    return Request('POST', '/telegram', 'HTTP/1.1', headers, body, ('127.0.0.1', 1234))
+
+
+@mock.patch.object(webhook, 'TELEGRAM_WEBHOOK_URL', WEBHOOK_URL)
+class TestWebhook(unittest.TestCase):
+    """Tests for the webhook configuration and the secret token check."""
+
+    def test_secret_is_required(self):
+        with mock.patch.object(webhook, 'TELEGRAM_WEBHOOK_SECRET', None):
+            with self.assertRaises(ValueError):
+                webhook.check_webhook_config()
+
+    def test_https_is_required(self):
+        with mock.patch.object(webhook, 'TELEGRAM_WEBHOOK_SECRET', SECRET), \
+                mock.patch.object(webhook, 'TELEGRAM_WEBHOOK_URL', 'http://bot:8080/telegram'):
+            with self.assertRaises(ValueError):
+                webhook.check_webhook_config()
+            # The local Bot API server accepts plain HTTP
+            webhook.check_webhook_config(local_api=True)
+
+    def test_update_is_queued(self):
+        application = make_application()
+        server = webhook.create_server(application, SECRET)
+
+        response = asyncio.run(server._dispatch(make_update_request(SECRET)))
+
+        self.assertEqual(response.status, HTTPStatus.OK)
+        self.assertEqual(application.update_queue.get_nowait().update_id, 1)
+
+    def test_invalid_secret_is_rejected(self):
+        application = make_application()
+        server = webhook.create_server(application, SECRET)
+
+        with self.assertRaises(HTTPError) as context:
+            asyncio.run(server._dispatch(make_update_request('wrong')))
+
+        self.assertEqual(context.exception.status, HTTPStatus.FORBIDDEN)
+        self.assertTrue(application.update_queue.empty())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+"""
+Unit tests for the job workers, runnable without S3 credentials.
+
+Run with: python -m unittest tests.test_worker -v
+"""
+
+import unittest
+
+import httpx
+import botocore.exceptions
+from telegram.error import BadRequest, RetryAfter, TimedOut
+
+from s3_bucket_bot.worker import is_transient
+
+
+def client_error(code, status):
+    return botocore.exceptions.ClientError({'Error': {'Code': code}, 'ResponseMetadata': {'HTTPStatusCode': status}},
+                                           'PutObject')
+
+
+def http_status_error(status):
+    request = httpx.Request('GET', 'https://example.com/file')
+    return httpx.HTTPStatusError('error', request=request, response=httpx.Response(status, request=request))
+
+
+class TestIsTransient(unittest.TestCase):
+    """Tests for the errors that make the queue retry a job."""
+
+    def test_network_errors_are_transient(self):
+        self.assertTrue(is_transient(botocore.exceptions.EndpointConnectionError(endpoint_url='https://s3')))
+        self.assertTrue(is_transient(botocore.exceptions.ReadTimeoutError(endpoint_url='https://s3')))
+        self.assertTrue(is_transient(httpx.ConnectError('refused')))
+        self.assertTrue(is_transient(TimedOut()))
+        self.assertTrue(is_transient(ConnectionResetError()))
+
+    def test_throttling_and_server_errors_are_transient(self):
+        self.assertTrue(is_transient(client_error('SlowDown', 503)))
+        self.assertTrue(is_transient(client_error('InternalError', 500)))
+        self.assertTrue(is_transient(http_status_error(429)))
+        self.assertTrue(is_transient(http_status_error(502)))
+        self.assertTrue(is_transient(RetryAfter(5)))
+
+    def test_permanent_errors(self):
+        self.assertFalse(is_transient(ValueError('Unknown job kind: foo')))
+        self.assertFalse(is_transient(KeyError('src')))
+        self.assertFalse(is_transient(client_error('NoSuchKey', 404)))
+        self.assertFalse(is_transient(client_error('AccessDenied', 403)))
+        self.assertFalse(is_transient(http_status_error(404)))
+        self.assertFalse(is_transient(BadRequest('Wrong file_id specified')))
+
+
+if __name__ == '__main__':
+    unittest.main()